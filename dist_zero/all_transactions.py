@@ -1,6 +1,7 @@
 from dist_zero.node.data.transactions.helpers import *
 from dist_zero.node.data.transactions.split_kid import *
 from dist_zero.node.data.transactions.add_leaf import *
+from dist_zero.node.data.transactions.remove_leaf import *
 from dist_zero.node.data.transactions.new_dataset import *
 from dist_zero.node.data.transactions.send_start_subscription import *
 from dist_zero.node.data.transactions.receive_start_subscription import *
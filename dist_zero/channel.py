@@ -0,0 +1,177 @@
+'''
+Channels for the messages that nodes on one machine send to nodes on another machine.
+
+Rather than sequencing, acknowledging and retransmitting each stream of messages between a pair of nodes separately,
+a `NodeManager` multiplexes the messages of all its nodes for the same remote machine onto a single `MachineChannel`.
+The receiving `NodeManager` delivers each message of a channel exactly once, as soon as it first arrives, and
+demultiplexes it to the node it is addressed to.  A lost datagram therefore holds back only the messages between the
+pair of nodes it was carrying a message for, as the `Importer` of each node restores the order of its own stream.
+
+The channel is the only layer that retransmits messages between machines.  Its own `Exporter` runs the adaptive
+retransmission timeouts, selective acknowledgements and loss recovery that each node's `Exporter` would otherwise run,
+once per pair of machines instead of once per pair of nodes.  Since the channel delivers every message exactly once,
+the `Exporter` of a node never retransmits to a node on another machine (see `Exporter.reliable`), and simulated
+network errors on those messages are applied to the datagrams of the channel instead.
+
+Only retransmission is shared.  Each pair of nodes still keeps its own sequence numbers, and its `Importer` still
+sends its own acknowledgements, which the channel carries like any other node message.  That is on purpose:
+node level acknowledgements are what drive branching (see `Linker`), the flow control window of each `Exporter`, and
+the hand off of pending messages when a node migrates, and none of those can be derived from the sequence numbers of
+a channel that interleaves the streams of many nodes.  Acknowledgements are already piggybacked and batched per node,
+so each node pair costs little more than a sequence number on each message.
+'''
+
+import logging
+
+from dist_zero import linker, messages
+
+logger = logging.getLogger(__name__)
+
+
+class MachineChannel(object):
+  '''
+  The end on one machine of the channel between that machine and one other machine.
+
+  Each direction of a channel is a single stream of sequence messages, from one `Exporter` on the sending machine
+  to one `Importer` on the receiving machine.  The two directions are linked by separate `Linker` instances so that
+  acknowledgements of received messages never wait on messages sent in the other direction.
+
+  The messages carried by a channel are ``machine_deliver_to_node`` and ``machine_start_node`` messages.
+  '''
+
+  def __init__(self, controller, machine_id, send_to_machine, transport, deliver):
+    '''
+    :param controller: The `MachineController` on this end of the channel.
+    :type controller: `MachineController`
+    :param str machine_id: The id of the machine on the other end of the channel.
+    :param func send_to_machine: A function send_to_machine(message, transport) that sends a machine message.
+    :param transport: A :ref:`transport` that the other machine can use to send to this machine.
+    :type transport: :ref:`transport`
+    :param func deliver: A function deliver(message) to call exactly once on each machine :ref:`message` received on
+      this channel, as soon as it first arrives.
+    '''
+    self.machine_id = machine_id
+    self._controller = controller
+    self._send_to_machine = send_to_machine
+    self._own_transport = transport
+    self._deliver = deliver
+
+    self._transport = None # None, or a transport for sending to the other machine
+    # Until the other machine is known to have a transport for this machine, messages carry one.
+    self._peer_has_transport = False
+
+    self._elapsed_ms = controller.now_ms # The time through which the linkers have been elapsed
+
+    self._sending = _ChannelEnd(self)
+    self._receiving = _ChannelEnd(self)
+    self._exporter = None # Created once there is a transport for the other machine.
+    # Map the sequence number of each message that should not be sent with self._send_to_machine the first time
+    # to the function that should send it instead.
+    self._first_senders = {}
+    self._importer = self._receiving.linker.new_importer(self._handle())
+
+  def _handle(self):
+    return {'id': self.machine_id, 'controller_id': self.machine_id, 'transport': self._transport, 'session_key': None}
+
+  def send(self, message, transport, send_datagram=None):
+    '''
+    Send a machine message on this channel.
+
+    :param message: A ``machine_deliver_to_node`` or ``machine_start_node`` :ref:`message`.
+    :type message: :ref:`message`
+    :param transport: A :ref:`transport` for sending to the other machine.
+    :type transport: :ref:`transport`
+    :param func send_datagram: If provided, a function like ``send_to_machine`` to send the message with the first
+      time.  Retransmissions are always sent with ``send_to_machine``.  It is used to simulate network errors.
+    '''
+    self._learn_transport(transport)
+    if send_datagram is not None:
+      self._first_senders[self._exporter.internal_sequence_number] = send_datagram
+    self._exporter.export_message(message, self._sending.linker.advance_sequence_number())
+
+  def receive(self, message):
+    '''
+    Receive a message of type 'machine_channel' sent by the other end of this channel.
+
+    :param message: The 'machine_channel' :ref:`message`.
+    :type message: :ref:`message`
+    '''
+    # Whichever machine sent this message knew how to send to this one.
+    self._peer_has_transport = True
+    if 'transport' in message:
+      self._learn_transport(message['transport'])
+
+    value = message['value']
+    if value['type'] == 'acknowledge':
+      self._sending.linker.receive_sequence_message(value, self.machine_id)
+    else:
+      if self._importer.will_import(value['sequence_number']):
+        # PERF(KK): Deliver without waiting for the messages sent before it, so that a lost datagram never holds
+        # back messages for unrelated nodes.
+        self._deliver(value['message'])
+      self._receiving.linker.receive_sequence_message(value, self.machine_id)
+
+  def _learn_transport(self, transport):
+    if self._transport is None:
+      self._transport = transport
+      self._exporter = self._sending.linker.new_exporter(self._handle())
+
+  def _send_sequence_message(self, value):
+    if self._transport is None:
+      # This can only happen for acknowledgements.  The other machine will retransmit.
+      logger.warning(
+          "Not sending on the channel to machine {machine_id} before learning its transport.",
+          extra={'machine_id': self.machine_id})
+      return
+
+    send_to_machine = self._send_to_machine
+    if self._first_senders and value['type'] == 'receive':
+      send_to_machine = self._first_senders.pop(value['sequence_number'], send_to_machine)
+
+    send_to_machine(
+        message=messages.machine.machine_channel(
+            machine_id=self._controller.id,
+            value=value,
+            transport=None if self._peer_has_transport else self._own_transport),
+        transport=self._transport)
+
+  def _deliver_sequence_message(self, message, sequence_number, sender_id):
+    # The message was delivered when it first arrived, and may be acknowledged right away.
+    self._receiving.linker.advance_sequence_number()
+
+  def elapse(self):
+    '''Elapse time on this channel up to the current time of its `MachineController`.'''
+    ms = self._controller.now_ms - self._elapsed_ms
+    if ms > 0:
+      self._elapsed_ms = self._controller.now_ms
+      self._sending.linker.elapse(ms)
+      self._receiving.linker.elapse(ms)
+
+  def stats(self):
+    '''
+    :return: A dictionary of statistics about this channel.
+    :rtype: dict
+    '''
+    return {
+        'sent_messages': self._sending.least_unused_sequence_number,
+        'acknowledged_messages': self._sending.linker.least_unacknowledged_sequence_number(),
+        'received_messages': self._receiving.least_unused_sequence_number,
+        'n_retransmissions': self._sending.linker.n_retransmissions,
+        'n_reorders': self._receiving.linker.n_reorders,
+        'n_duplicates': self._receiving.linker.n_duplicates,
+        'retransmission': self._sending.linker.retransmission_stats(),
+    }
+
+
+class _ChannelEnd(object):
+  '''Stands in for the `Node` of one of the two linkers of a `MachineChannel`.'''
+
+  def __init__(self, channel):
+    self.id = channel.machine_id
+    self._controller = channel._controller
+    self._channel = channel
+    self.least_unused_sequence_number = 0
+    self.linker = linker.Linker(self, logger=logger, deliver=channel._deliver_sequence_message)
+
+  def send(self, receiver, message):
+    self._channel._send_sequence_message(message['value'])
@@ -0,0 +1,394 @@
+'''
+Wire codecs for the messages exchanged between `MachineController` instances.
+
+A codec turns machine :ref:`message` dictionaries into bytes and back.
+The node message inside a ``machine_deliver_to_node`` envelope is encoded exactly once, by `Codec.encode_payload`,
+and the resulting bytes (possibly encrypted) are carried through the envelope untouched.
+Envelopes never re-encode or escape their payload.
+
+Node messages may contain python `bytes` values (e.g. the capnproto outputs of a reactive ``Net``).
+Codecs carry those values as opaque byte strings.
+
+All machines in a system must use the same codec.  It is selected by the ``WIRE_CODEC`` environment variable
+(see `dist_zero.settings`).
+'''
+
+import base64
+import json
+import struct
+
+from dist_zero import errors, messages, settings
+
+_BYTES_KEY = '__dz_bytes__'
+
+
+class Codec(object):
+  '''Abstract base class for wire codecs.'''
+
+  name = None
+  '''The name by which settings refer to this codec.'''
+
+  def encode(self, message):
+    '''
+    Encode a machine message.
+
+    :param message: A machine :ref:`message`.  If it is a ``machine_deliver_to_node`` message, its inner
+      message may be the `bytes` returned by `Codec.encode_payload` (possibly encrypted).
+    :type message: :ref:`message`
+    :return: The encoded message.
+    :rtype: bytes
+    '''
+    raise errors.AbstractSuperclass(self.__class__)
+
+  def decode(self, data):
+    '''
+    Decode a machine message that was encoded by `Codec.encode`.
+
+    The inner message of a ``machine_deliver_to_node`` message is left as it was passed to `Codec.encode`.
+
+    :param bytes data: The encoded message.
+    :return: The machine :ref:`message`.
+    :rtype: :ref:`message`
+    '''
+    raise errors.AbstractSuperclass(self.__class__)
+
+  def encode_payload(self, message):
+    '''
+    Encode a node message.
+
+    :param message: Any node :ref:`message`.  It may contain `bytes` values.
+    :type message: :ref:`message`
+    :rtype: bytes
+    '''
+    raise errors.AbstractSuperclass(self.__class__)
+
+  def decode_payload(self, data):
+    '''
+    Decode a node message that was encoded by `Codec.encode_payload`.
+
+    :param bytes data: The encoded message.
+    :rtype: :ref:`message`
+    '''
+    raise errors.AbstractSuperclass(self.__class__)
+
+
+class JsonCodec(Codec):
+  '''
+  A codec that encodes everything as json.
+
+  It is slower and produces larger datagrams than `BinaryCodec`, but its output is human readable.
+  Byte strings are base64 encoded.
+  '''
+
+  name = 'json'
+
+  def encode(self, message):
+    return json.dumps(message, default=_bytes_to_base64_json).encode(messages.ENCODING)
+
+  def decode(self, data):
+    return json.loads(data.decode(messages.ENCODING), object_hook=_base64_json_to_bytes)
+
+  def encode_payload(self, message):
+    return self.encode(message)
+
+  def decode_payload(self, data):
+    return self.decode(data)
+
+
+class BinaryCodec(Codec):
+  '''
+  A compact codec that encodes each message in a single pass.
+
+  Envelopes are encoded as a fixed size binary header followed by the node ids and the raw payload bytes.
+  Payloads use a self describing binary format in the style of msgpack: each value is a one byte type tag
+  followed by a fixed size number, or by a length and that many bytes, items or key value pairs.
+  Small integers and the lengths of short strings and containers are packed into the tag itself.
+  Like the json codec, it turns tuples into lists and dictionary keys into strings.
+  '''
+
+  name = 'binary'
+
+  VERSION = 2
+
+  _KIND_DELIVER = 1
+  '''Envelope kind for ``machine_deliver_to_node`` messages.'''
+  _KIND_OTHER = 2
+  '''Envelope kind for all other machine messages.'''
+
+  _FLAG_HAS_SENDER = 1
+  '''Set iff the envelope has a sending_node_id.'''
+  _FLAG_PLAIN_PAYLOAD = 2
+  '''Set iff the payload of the envelope was a message instead of opaque bytes.'''
+
+  # version, kind, flags, length of node_id, length of sending_node_id
+  _ENVELOPE_HEADER = struct.Struct('!BBBHH')
+
+  def encode(self, message):
+    if message['type'] == 'machine_deliver_to_node':
+      node_id = message['node_id'].encode(messages.ENCODING)
+      sending_node_id = message['sending_node_id']
+      flags = 0
+      if sending_node_id is None:
+        sender = b''
+      else:
+        flags |= BinaryCodec._FLAG_HAS_SENDER
+        sender = sending_node_id.encode(messages.ENCODING)
+
+      payload = message['message']
+      if not isinstance(payload, (bytes, bytearray)):
+        flags |= BinaryCodec._FLAG_PLAIN_PAYLOAD
+        payload = self.encode_payload(payload)
+
+      return b''.join([
+          BinaryCodec._ENVELOPE_HEADER.pack(BinaryCodec.VERSION, BinaryCodec._KIND_DELIVER, flags, len(node_id),
+                                            len(sender)),
+          node_id,
+          sender,
+          payload,
+      ])
+    else:
+      return BinaryCodec._ENVELOPE_HEADER.pack(BinaryCodec.VERSION, BinaryCodec._KIND_OTHER, 0, 0,
+                                               0) + self.encode_payload(message)
+
+  def decode(self, data):
+    data = memoryview(data)
+    version, kind, flags, node_id_length, sender_length = BinaryCodec._ENVELOPE_HEADER.unpack_from(data)
+    if version != BinaryCodec.VERSION:
+      raise errors.InternalError(f"Unrecognized binary codec version {version}.")
+
+    offset = BinaryCodec._ENVELOPE_HEADER.size
+    if kind == BinaryCodec._KIND_OTHER:
+      return self.decode_payload(data[offset:])
+    elif kind == BinaryCodec._KIND_DELIVER:
+      node_id = str(data[offset:offset + node_id_length], messages.ENCODING)
+      offset += node_id_length
+      if flags & BinaryCodec._FLAG_HAS_SENDER:
+        sending_node_id = str(data[offset:offset + sender_length], messages.ENCODING)
+      else:
+        sending_node_id = None
+      offset += sender_length
+
+      if flags & BinaryCodec._FLAG_PLAIN_PAYLOAD:
+        payload = self.decode_payload(data[offset:])
+      else:
+        payload = data[offset:].tobytes()
+
+      return messages.machine.machine_deliver_to_node(
+          node_id=node_id, message=payload, sending_node_id=sending_node_id)
+    else:
+      raise errors.InternalError(f"Unrecognized binary codec envelope kind {kind}.")
+
+  def encode_payload(self, message):
+    parts = []
+    _encode_value(message, parts)
+    return b''.join(parts)
+
+  def decode_payload(self, data):
+    data = memoryview(data)
+    value, offset = _decode_value(data, 0)
+    if offset != len(data):
+      raise errors.InternalError(f"Binary payload has {len(data) - offset} trailing bytes.")
+    return value
+
+
+# Each value in a binary payload starts with a one byte tag.  As in msgpack, small integers, short strings and small
+# containers fit their value, length or count into the tag itself.
+_TAG_MAX_FIX_INT = 0x7f # tags 0x00 through 0x7f are the non negative integers less than 0x80
+_TAG_FIX_STR = 0x80 # tags 0x80 through 0x9f are strings of fewer than 32 bytes, followed by the encoded string
+_TAG_FIX_LIST = 0xa0 # tags 0xa0 through 0xaf are lists of fewer than 16 values, followed by the values
+_TAG_FIX_DICT = 0xb0 # tags 0xb0 through 0xbf are dicts of fewer than 16 pairs, followed by keys and values
+_TAG_NONE = 0xc0
+_TAG_FALSE = 0xc1
+_TAG_TRUE = 0xc2
+_TAG_INT32 = 0xc3 # followed by a signed 4 byte integer
+_TAG_INT64 = 0xc4 # followed by a signed 8 byte integer
+_TAG_BIG_INT = 0xc5 # followed by a length and the signed big endian bytes of the integer
+_TAG_FLOAT = 0xc6 # followed by an 8 byte double
+_TAG_STR = 0xc7 # followed by a length and the encoded string
+_TAG_BYTES = 0xc8 # followed by a length and the raw bytes
+_TAG_LIST = 0xc9 # followed by a count and that many values
+_TAG_DICT = 0xca # followed by a count and that many pairs of a string key and a value
+
+_FIX_STR_LIMIT = 32
+_FIX_CONTAINER_LIMIT = 16
+
+_TAGGED_INT32 = struct.Struct('!Bi')
+_TAGGED_INT64 = struct.Struct('!Bq')
+_TAGGED_FLOAT = struct.Struct('!Bd')
+_TAGGED_LENGTH = struct.Struct('!BI')
+_LENGTH = struct.Struct('!I')
+
+# The encodings of all values that are a single tag.
+_TAG_BYTES_BY_VALUE = {
+    None: bytes([_TAG_NONE]),
+    False: bytes([_TAG_FALSE]),
+    True: bytes([_TAG_TRUE]),
+}
+_FIX_INT_BYTES = [bytes([i]) for i in range(_TAG_MAX_FIX_INT + 1)]
+
+
+def _encode_str(value, parts):
+  encoded = value.encode(messages.ENCODING)
+  if len(encoded) < _FIX_STR_LIMIT:
+    parts.append(bytes((_TAG_FIX_STR + len(encoded), )))
+  else:
+    parts.append(_TAGGED_LENGTH.pack(_TAG_STR, len(encoded)))
+  parts.append(encoded)
+
+
+def _encode_value(value, parts):
+  '''Append the binary encoding of a python value to a list of byte strings.'''
+  # NOTE(KK): Test for exact types first, as they are by far the most common in messages.
+  t = type(value)
+  if t is str:
+    _encode_str(value, parts)
+  elif t is dict:
+    if len(value) < _FIX_CONTAINER_LIMIT:
+      parts.append(bytes((_TAG_FIX_DICT + len(value), )))
+    else:
+      parts.append(_TAGGED_LENGTH.pack(_TAG_DICT, len(value)))
+    for key, item in value.items():
+      # Match the json codec, which turns every key into a string.
+      _encode_str(key if type(key) is str else json.dumps(key), parts)
+      _encode_value(item, parts)
+  elif t is int:
+    if 0 <= value <= _TAG_MAX_FIX_INT:
+      parts.append(_FIX_INT_BYTES[value])
+    elif -(1 << 31) <= value < (1 << 31):
+      parts.append(_TAGGED_INT32.pack(_TAG_INT32, value))
+    elif -(1 << 63) <= value < (1 << 63):
+      parts.append(_TAGGED_INT64.pack(_TAG_INT64, value))
+    else:
+      encoded = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+      parts.append(_TAGGED_LENGTH.pack(_TAG_BIG_INT, len(encoded)))
+      parts.append(encoded)
+  elif value is None or t is bool:
+    parts.append(_TAG_BYTES_BY_VALUE[value])
+  elif t is float:
+    parts.append(_TAGGED_FLOAT.pack(_TAG_FLOAT, value))
+  elif t is list or t is tuple:
+    if len(value) < _FIX_CONTAINER_LIMIT:
+      parts.append(bytes((_TAG_FIX_LIST + len(value), )))
+    else:
+      parts.append(_TAGGED_LENGTH.pack(_TAG_LIST, len(value)))
+    for item in value:
+      _encode_value(item, parts)
+  elif isinstance(value, (bytes, bytearray)):
+    parts.append(_TAGGED_LENGTH.pack(_TAG_BYTES, len(value)))
+    parts.append(bytes(value))
+  else:
+    # Possibly a subclass of a builtin type, e.g. a namedtuple.  Encode it as its base type, with tuples as lists.
+    for base in (dict, list, tuple, int, float, str):
+      if isinstance(value, base):
+        _encode_value(list(value) if base is tuple else base(value), parts)
+        break
+    else:
+      raise errors.InternalError(f"Object of type {t.__name__} can not be encoded by the binary codec.")
+
+
+def _decode_value(data, offset):
+  '''
+  Decode one value from a binary payload.
+
+  :param memoryview data: The binary payload.
+  :param int offset: The offset in data at which the value starts.
+  :return: The value, and the offset just after it.
+  :rtype: tuple
+  '''
+  tag = data[offset]
+  offset += 1
+  if tag <= _TAG_MAX_FIX_INT:
+    return tag, offset
+  elif tag < _TAG_FIX_LIST:
+    end = offset + tag - _TAG_FIX_STR
+    return str(data[offset:end], messages.ENCODING), end
+  elif tag < _TAG_FIX_DICT:
+    return _decode_list(data, offset, tag - _TAG_FIX_LIST)
+  elif tag < _TAG_NONE:
+    return _decode_dict(data, offset, tag - _TAG_FIX_DICT)
+  elif tag == _TAG_NONE:
+    return None, offset
+  elif tag == _TAG_FALSE:
+    return False, offset
+  elif tag == _TAG_TRUE:
+    return True, offset
+  elif tag == _TAG_INT32:
+    return _TAGGED_INT32.unpack_from(data, offset - 1)[1], offset + 4
+  elif tag == _TAG_INT64:
+    return _TAGGED_INT64.unpack_from(data, offset - 1)[1], offset + 8
+  elif tag == _TAG_FLOAT:
+    return _TAGGED_FLOAT.unpack_from(data, offset - 1)[1], offset + 8
+  elif tag in (_TAG_STR, _TAG_BYTES, _TAG_BIG_INT, _TAG_LIST, _TAG_DICT):
+    length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    if tag == _TAG_LIST:
+      return _decode_list(data, offset, length)
+    elif tag == _TAG_DICT:
+      return _decode_dict(data, offset, length)
+
+    end = offset + length
+    if tag == _TAG_STR:
+      return str(data[offset:end], messages.ENCODING), end
+    elif tag == _TAG_BYTES:
+      return data[offset:end].tobytes(), end
+    else:
+      return int.from_bytes(data[offset:end], 'big', signed=True), end
+  else:
+    raise errors.InternalError(f"Unrecognized binary codec value tag {tag}.")
+
+
+def _decode_list(data, offset, count):
+  result = []
+  for i in range(count):
+    item, offset = _decode_value(data, offset)
+    result.append(item)
+  return result, offset
+
+
+def _decode_dict(data, offset, count):
+  result = {}
+  for i in range(count):
+    key, offset = _decode_value(data, offset)
+    result[key], offset = _decode_value(data, offset)
+  return result, offset
+
+
+def _bytes_to_base64_json(value):
+  if isinstance(value, (bytes, bytearray)):
+    return {_BYTES_KEY: base64.b64encode(value).decode(messages.ENCODING)}
+  else:
+    raise TypeError(f"Object of type {value.__class__.__name__} is not JSON serializable")
+
+
+def _base64_json_to_bytes(obj):
+  if len(obj) == 1 and _BYTES_KEY in obj:
+    return base64.b64decode(obj[_BYTES_KEY])
+  else:
+    return obj
+
+
+_CODEC_CLASSES = {codec_class.name: codec_class for codec_class in [JsonCodec, BinaryCodec]}
+
+_default_codec = None
+
+
+def from_name(name):
+  '''
+  :param str name: The name of a codec.
+  :return: A new instance of the codec with that name.
+  :rtype: `Codec`
+  '''
+  if name not in _CODEC_CLASSES:
+    raise errors.InternalError(f"Unrecognized wire codec \"{name}\".  Expected one of {list(_CODEC_CLASSES.keys())}")
+  return _CODEC_CLASSES[name]()
+
+
+def default_codec():
+  '''
+  :return: The `Codec` instance configured by ``WIRE_CODEC``.
+  :rtype: `Codec`
+  '''
+  global _default_codec
+  if _default_codec is None:
+    _default_codec = from_name(settings.WIRE_CODEC)
+  return _default_codec
@@ -97,6 +97,19 @@ class ConcreteType(object):
     '''
     raise RuntimeError(f"Abstract Superclass {self.__class__}")
 
+  def compact_transitions(self, python_transitions):
+    '''
+    Merge consecutive transitions into fewer transitions with the same effect.
+
+    Types that do not know how to merge their transitions return them unchanged.
+
+    :param list python_transitions: A list of python objects, each identifying a transition of ``self.type``
+      as in `ConcreteType.generate_allocate_transition`.
+    :return: A list of python transitions with the same effect as ``python_transitions`` when applied in order.
+    :rtype: list
+    '''
+    return list(python_transitions)
+
   def initialize_capnp(self, compiler):
     '''
     Initialize the capnp structures for this type.
@@ -312,6 +325,20 @@ class ConcreteBasicType(ConcreteType):
   def generate_free_state(self, compiler, block, stateRvalue):
     pass
 
+  def compact_transitions(self, python_transitions):
+    combine = self._basic_type.combine_transitions
+    if combine is None or len(python_transitions) < 2:
+      return list(python_transitions)
+
+    total_inc = None
+    for python_transition in python_transitions:
+      for key, val in python_transition:
+        if key != 'inc':
+          raise errors.InternalError(f"ConcreteBasicType expected a transition of type 'inc', got '{key}'")
+        total_inc = val if total_inc is None else combine(total_inc, val)
+
+    return [] if total_inc is None else [[('inc', total_inc)]]
+
   def generate_apply_transition(self, block, stateLvalue, stateRvalue, transition):
     block.AddAssignment(stateLvalue, self._basic_type._apply_transition(transition, stateRvalue))
 
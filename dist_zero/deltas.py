@@ -1,3 +1,5 @@
+from collections import deque
+
 from dist_zero import errors
 
 
@@ -8,19 +10,23 @@ class Deltas(object):
   '''
 
   def __init__(self):
-    # Map from sender_id to a list of pairs (remote_sequence_number, message)
-    self._sender_id_to_rsn_message_pairs = {}
+    # Map from sender_id to a deque of the messages that have not been popped for that sender, in order.
+    self._sender_id_to_messages = {}
 
     # Map from sender_id to the leaste sequence_number that has not been popped for that sender.
+    # It is the sequence number of the first message in self._sender_id_to_messages[sender_id].
     self._first_unpopped = {}
 
+    # The sender ids with unpopped messages, as the keys of a dict to keep them in a deterministic order.
+    self._sender_ids_with_data = {}
+
   def add_sender(self, sender_id):
     '''
     Start tracking deltas for a new sender.
     '''
-    if sender_id in self._sender_id_to_rsn_message_pairs or sender_id in self._first_unpopped:
+    if sender_id in self._sender_id_to_messages or sender_id in self._first_unpopped:
       raise errors.InternalError("Sender was already added")
-    self._sender_id_to_rsn_message_pairs[sender_id] = []
+    self._sender_id_to_messages[sender_id] = deque()
     self._first_unpopped[sender_id] = 0
 
   def add_message(self, sender_id, sequence_number, message):
@@ -28,20 +34,24 @@ class Deltas(object):
     Store a message in self for use later on.
     '''
     if self.first_unseen_rsn(sender_id) == sequence_number:
-      self._sender_id_to_rsn_message_pairs[sender_id].append((sequence_number, message))
+      self._sender_id_to_messages[sender_id].append(message)
+      self._sender_ids_with_data[sender_id] = True
     else:
       raise errors.InternalError("add_message was not called on the next sequential sequence number.")
 
   def first_unseen_rsn(self, sender_id):
-    pairs = self._sender_id_to_rsn_message_pairs[sender_id]
-    if pairs:
-      rsn, msg = pairs[-1]
-      return rsn + 1
-    else:
-      return self._first_unpopped[sender_id]
+    return self._first_unpopped[sender_id] + len(self._sender_id_to_messages[sender_id])
 
-  def has_data(self):
-    return any(self._sender_id_to_rsn_message_pairs.values())
+  def has_data(self, before=None):
+    '''
+    :param dict before: None or a dict in the format of the ``before`` argument to `Deltas.pop_deltas`.
+    :return: True iff `Deltas.pop_deltas` would return any deltas.
+    :rtype: bool
+    '''
+    if not before:
+      return bool(self._sender_ids_with_data)
+    else:
+      return any(self._n_poppable(sender_id, before) for sender_id in self._sender_ids_with_data)
 
   def covers(self, before):
     '''
@@ -52,6 +62,35 @@ class Deltas(object):
     '''
     return all(self.first_unseen_rsn(sender_id) >= sequence_number for sender_id, sequence_number in before.items())
 
+  def _n_poppable(self, sender_id, before):
+    '''The number of messages from ``sender_id`` that may be popped under the ``before`` argument to pop_deltas.'''
+    n_messages = len(self._sender_id_to_messages[sender_id])
+    cap_number = before.get(sender_id, None) if before else None
+    if cap_number is None:
+      return n_messages
+    else:
+      # Sequence numbers for a sender are consecutive, so the cap can be found without searching.
+      return max(0, min(n_messages, cap_number - self._first_unpopped[sender_id]))
+
+  def iter_deltas(self, before=None):
+    '''
+    Remove deltas from self and generate them in order, without collecting them into a list.
+
+    Each delta is removed just before it is generated.  If the generator is not run to completion,
+    the deltas it has not yet generated stay in self.
+
+    :param dict before: As in `Deltas.pop_deltas`.
+    :return: A generator of the messages that `Deltas.pop_deltas` would return.
+    '''
+    for sender_id in list(self._sender_ids_with_data):
+      messages = self._sender_id_to_messages[sender_id]
+      for i in range(self._n_poppable(sender_id, before)):
+        delta_message = messages.popleft()
+        self._first_unpopped[sender_id] += 1
+        if not messages:
+          self._sender_ids_with_data.pop(sender_id)
+        yield delta_message
+
   def pop_deltas(self, before=None):
     '''
     Remove deltas from self, combine them, and return the result.
@@ -63,18 +102,4 @@ class Deltas(object):
     :return: A list of messages that have elapsed before before (or ever if before is None).
     :rtype: list
     '''
-    increment = []
-    for sender_id, pairs in list(self._sender_id_to_rsn_message_pairs.items()):
-      new_pairs = []
-      cap_number = before and before.get(sender_id, None)
-      # PERF(KK): binary search would be faster
-      for rsn, delta_message in pairs:
-        if cap_number is None or rsn < cap_number:
-          increment.append(delta_message)
-          self._first_unpopped[sender_id] = max(self._first_unpopped[sender_id], rsn + 1)
-        else:
-          new_pairs.append((rsn, delta_message))
-
-      self._sender_id_to_rsn_message_pairs[sender_id] = new_pairs
-
-    return increment
+    return list(self.iter_deltas(before=before))
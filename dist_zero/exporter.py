@@ -1,4 +1,7 @@
+from collections import deque
+
 from dist_zero import messages, errors
+from dist_zero.importer import Importer
 
 
 class Exporter(object):
@@ -12,17 +15,56 @@ class Exporter(object):
   and watch to see whether the message is acknowleded.  If after enough time the message is not acknowledged,
   it will resubmit it.
 
+  Retransmission works as in TCP (RFC 6298).  The exporter keeps a single retransmission timer,
+  which it starts when it sends a message while nothing is pending, and restarts whenever an acknowledgement
+  arrives for new messages.  When the timer expires, the exporter doubles the retransmission timeout, restarts
+  the timer and retransmits only the gaps: the pending messages the receiver has not reported receiving
+  (see `Importer.received_ranges`) below the last one it has reported, or if there are none, the least
+  unreported message.  Until every message that was pending at the timeout is acknowledged, each acknowledgement
+  that covers only some of them retransmits the next gap right away (as in TCP NewReno),
+  so that several lost messages are recovered in as many round trips instead of as many timeouts.
+
+  Without waiting for the timer, a pending message that the receiver has not reported receiving is retransmitted
+  once the receiver reports receiving a message `DUPLICATE_THRESHOLD` later (as with SACK in TCP).
+  Each gap is retransmitted at most once between timeouts.
+
+  The retransmission timeout adapts to the round trip time to the receiver: the exporter times one message at
+  a time, and keeps a smoothed round trip time and its variation.  Following Karn's algorithm,
+  retransmitted messages are never timed.  An acknowledgement of new messages undoes any backoff.
+
+  An exporter whose receiver is reached through a layer that already delivers every message exactly once
+  (see `Exporter.reliable`) never retransmits.  It still tracks acknowledgements, as its `Linker` needs them.
+
+  Flow control:
+
+  The receiver advertises a window with each acknowledgement.  Messages beyond the window are queued
+  instead of sent, and are sent as later acknowledgements open the window.  While messages are queued, the exporter
+  is blocked, and its `Linker` applies backpressure to the node (see `Linker.is_backpressured`).
+  If a blocked exporter has nothing pending, it sends one queued message every retransmission timeout
+  so that a lost window update can not block it forever.
   '''
 
   PENDING_EXPIRATION_TIME_MS = 2 * 1000
   '''
   When a message has been sent, it will be put into a pending state.
-  PENDING_EXPIRATION_TIME_MS milliseconds after a message is sent, if it still hasn't been acknowledged,
-  it will be considered expired.
+  If the retransmission timer expires while it still hasn't been acknowledged, it will be considered expired.
+  PENDING_EXPIRATION_TIME_MS is the retransmission timeout before any round trip time has been measured.
 
   Expired messages will be retransmitted during calls to `Exporter.retransmit_expired_pending_messages`
   '''
 
+  DUPLICATE_THRESHOLD = 3
+  '''
+  How many messages later a received message must be before the exporter concludes that a message it has not
+  received was lost, rather than reordered.
+  '''
+
+  MIN_RETRANSMISSION_TIMEOUT_MS = 30
+  '''The least retransmission timeout, however short the measured round trip times.'''
+
+  MAX_RETRANSMISSION_TIMEOUT_MS = 60 * 1000
+  '''The greatest retransmission timeout, however long the measured round trip times or backoff.'''
+
   def __init__(self, receiver, linker):
     '''
     :param receiver: The :ref:`handle` of the node receiving from this data node.
@@ -32,6 +74,11 @@ class Exporter(object):
     :type linker: `Linker`
     '''
     self._receiver = receiver
+    self.reliable = False
+    '''
+    True iff every message sent to the receiver is delivered exactly once by the layer below, e.g. a `MachineChannel`.
+    Reliable exporters never retransmit, nor probe the receiver's window, as no message or window update is lost.
+    '''
 
     self._linker = linker
     self.logger = self._linker.logger
@@ -40,43 +87,257 @@ class Exporter(object):
     # Otherwise, the list of Exporter instances to duplicate to.
     self.duplicated_exporters = None
 
-    # A list of tuples (time_sent_ms, internal_sequence_number_sent, message)
-    # of all messages that have been sent but not acknowledged, along with
-    # the time and sequence number at which they were sent.
-    self._pending_messages = []
+    # A deque of the messages that have been sent but not acknowledged.  Messages are sent in order,
+    # so the i'th entry has internal sequence number self._least_internal_unacknowledged_sequence_number + i
+    self._pending_messages = deque()
+    # A deque of pairs (internal_sequence_number, message) of messages that have not been sent because they
+    # lie beyond the receiver's window.
+    self._queued_messages = deque()
+    # The receiver's window.  Until it is advertised, assume the largest window any `Importer` advertises.
+    self._window = Importer.RECEIVE_WINDOW
+    self._timer_started_ms = self._linker.now_ms # When the retransmission timer was last started
     self._internal_sequence_number = 0
-    self._internal_sequence_number_to_sequence_number = {}
+    # Internal sequence numbers are consecutive, so instead of a dict, keep a deque whose i'th entry
+    # gives the sequence number for internal sequence number self._least_internal_unacknowledged_sequence_number + 1 + i
+    self._sequence_numbers = deque()
 
     # See `Exporter.least_unacknowledged_sequence_number`
     self._least_internal_unacknowledged_sequence_number = 0
     self._least_unacknowledged_sequence_number = self._linker.least_unused_sequence_number
 
+    # Round trip time estimation.  See `Exporter.retransmission_stats`
+    self._srtt_ms = None
+    self._rttvar_ms = None
+    self._rto_ms = Exporter.PENDING_EXPIRATION_TIME_MS
+    # None, or a pair (internal_sequence_number, time_sent_ms) for the message whose round trip is being timed.
+    self._timed_message = None
+    # None, or the internal sequence number following the messages that were pending at the last timeout.
+    self._recovery_point = None
+
+    # A sorted list of disjoint pairs (start, stop) of ranges of internal sequence numbers
+    # that the receiver most recently reported receiving.
+    self._received_ranges = []
+    # Every gap below this internal sequence number has been retransmitted since the last timeout.
+    self._loss_scan_point = 0
+
   @property
   def internal_sequence_number(self):
     return self._internal_sequence_number
 
+  def set_reliable(self, reliable):
+    '''
+    Change whether the receiver is reached through a layer that delivers every message exactly once.
+    See `Exporter.reliable`
+
+    :param bool reliable: The new value of `Exporter.reliable`.
+    '''
+    if reliable and not self.reliable:
+      # The pending messages were sent while they could still be lost, and will never be retransmitted once the
+      # exporter is reliable.  Send any the receiver has not reported receiving once more, this time reliably.
+      for internal_sequence_number in self._gaps(self._least_internal_unacknowledged_sequence_number,
+                                                 self._least_unsent_internal_sequence_number()):
+        self._retransmit(internal_sequence_number)
+      self._recovery_point = None
+      if self._queued_messages and not self._pending_messages:
+        # The window update that would unblock the exporter may have been lost as well.  Probe the window once.
+        self._export_message_self_only(
+            message=self._queued_messages.popleft()[1],
+            internal_sequence_number=self._least_internal_unacknowledged_sequence_number,
+            time_round_trip=False)
+    self.reliable = reliable
+
   def switch_linker(self, linker):
     self._linker = linker
 
+  def switch_receiver(self, receiver):
+    '''
+    Use a new handle for the receiver, after it has moved to another machine.
+
+    :param receiver: The new :ref:`handle` of the same receiver.
+    :type receiver: :ref:`handle`
+    '''
+    if receiver['id'] != self.receiver_id:
+      raise errors.InternalError("An exporter can only switch to a handle for the same receiver.")
+    self._receiver = receiver
+
+  def snapshot(self):
+    '''
+    :return: The state of this exporter.  See `Linker.restore`
+    :rtype: dict
+    '''
+    now_ms = self._linker.now_ms
+    return {
+        'receiver': self._receiver,
+        'pending_messages': list(self._pending_messages),
+        # Stored as an age, since the restored exporter's clock will be different.
+        'retransmission_timer_age_ms': now_ms - self._timer_started_ms,
+        'queued_messages': list(self._queued_messages),
+        'window': self._window,
+        'internal_sequence_number': self._internal_sequence_number,
+        # Pairs instead of a dict, as json would turn the integer keys into strings.
+        'internal_sequence_number_to_sequence_number': [
+            [self._least_internal_unacknowledged_sequence_number + 1 + i, sequence_number]
+            for i, sequence_number in enumerate(self._sequence_numbers)
+        ],
+        'least_internal_unacknowledged_sequence_number': self._least_internal_unacknowledged_sequence_number,
+        'least_unacknowledged_sequence_number': self._least_unacknowledged_sequence_number,
+        # Whether the pending messages were sent reliably.
+        'reliable': self.reliable,
+        # The estimates are a better guess than the defaults, even though the round trips will change.
+        'retransmission': self.retransmission_stats(),
+        'duplicated_receiver_ids': None if self.duplicated_exporters is None else
+        [duplicated_exporter.receiver_id for duplicated_exporter in self.duplicated_exporters],
+    }
+
+  def restore(self, snapshot):
+    '''
+    Restore the state of an exporter from the output of `Exporter.snapshot`.
+    The duplicated exporters are restored separately by `Linker.restore`.
+    Received ranges are not restored, as the receiver will report them again.
+    '''
+    now_ms = self._linker.now_ms
+    self._pending_messages = deque(snapshot['pending_messages'])
+    self._timer_started_ms = now_ms - snapshot['retransmission_timer_age_ms']
+    self._queued_messages = deque((sn, msg) for sn, msg in snapshot['queued_messages'])
+    self._window = snapshot['window']
+    self._internal_sequence_number = snapshot['internal_sequence_number']
+    self._sequence_numbers = deque(
+        sequence_number for _isn, sequence_number in sorted(snapshot['internal_sequence_number_to_sequence_number']))
+    self._least_internal_unacknowledged_sequence_number = snapshot['least_internal_unacknowledged_sequence_number']
+    self._least_unacknowledged_sequence_number = snapshot['least_unacknowledged_sequence_number']
+    self.reliable = snapshot['reliable']
+    retransmission = snapshot['retransmission']
+    self._srtt_ms, self._rttvar_ms, self._rto_ms = retransmission['srtt_ms'], retransmission['rttvar_ms'], \
+        retransmission['rto_ms']
+
   def has_pending_messages(self):
-    '''return True iff this exporter has pending messages for which it is waiting for an acknowledgement.'''
-    return True if self._pending_messages else False
+    '''
+    return True iff this exporter has pending or queued messages for which it is waiting for an acknowledgement.
+    '''
+    return True if self._pending_messages or self._queued_messages else False
 
-  def retransmit_expired_pending_messages(self):
+  def is_blocked(self):
+    '''return True iff this exporter has queued messages that lie beyond the receiver's window.'''
+    return True if self._queued_messages else False
+
+  def ms_until_expiration(self):
+    '''
+    :return: The number of milliseconds until the retransmission timer expires, and the exporter should
+      retransmit a pending message or probe the receiver's window.  It may be negative.
+      Only call this method when the exporter has pending messages.
+    :rtype: int
     '''
-    Retransmit any pending messages that have been pending for too long.
+    return self._timer_started_ms + self._rto_ms - self._linker.now_ms
 
-    :param int time_ms: The current time in milliseconds on the sending `Node`
+  def retransmission_stats(self):
+    '''
+    :return: The round trip time estimates of this exporter, with keys
+      'srtt_ms' (smoothed round trip time, or None if no round trip has been measured),
+      'rttvar_ms' (round trip time variation, or None) and 'rto_ms' (the current retransmission timeout).
+    :rtype: dict
     '''
-    cutoff_send_time_ms = self._linker.now_ms - Exporter.PENDING_EXPIRATION_TIME_MS
-    while self._pending_messages and self._pending_messages[0][0] <= cutoff_send_time_ms:
-      t, internal_sequence_number, message = self._pending_messages.pop(0)
-      self._linker.n_retransmissions += 1
+    return {'srtt_ms': self._srtt_ms, 'rttvar_ms': self._rttvar_ms, 'rto_ms': self._rto_ms}
+
+  def _measure_round_trip(self, rtt_ms):
+    '''Update the round trip time estimates and the retransmission timeout with a new measurement.'''
+    if self._srtt_ms is None:
+      self._srtt_ms = rtt_ms
+      self._rttvar_ms = rtt_ms / 2
+    else:
+      self._rttvar_ms = 0.75 * self._rttvar_ms + 0.25 * abs(self._srtt_ms - rtt_ms)
+      self._srtt_ms = 0.875 * self._srtt_ms + 0.125 * rtt_ms
+    self._set_rto_from_estimates()
+
+  def _set_rto_from_estimates(self):
+    if self._srtt_ms is None:
+      self._rto_ms = Exporter.PENDING_EXPIRATION_TIME_MS
+    else:
+      self._set_rto(self._srtt_ms + 4 * self._rttvar_ms)
+
+  def _set_rto(self, rto_ms):
+    self._rto_ms = min(Exporter.MAX_RETRANSMISSION_TIMEOUT_MS, max(Exporter.MIN_RETRANSMISSION_TIMEOUT_MS, rto_ms))
 
+  def retransmit_expired_pending_messages(self):
+    '''
+    If the retransmission timer has expired, retransmit the least unacknowledged message,
+    or if the exporter is blocked with nothing pending, probe the receiver's window.
+    '''
+    if self.reliable or self.ms_until_expiration() > 0 or not self.has_pending_messages():
+      return
+
+    # Back off, and keep the longer timeout until a new acknowledgement arrives.
+    self._set_rto(2 * self._rto_ms)
+    self._timed_message = None
+    self._timer_started_ms = self._linker.now_ms
+
+    internal_sequence_number = self._least_internal_unacknowledged_sequence_number
+    if self._pending_messages:
+      self._recovery_point = self._least_unsent_internal_sequence_number()
+      self._loss_scan_point = internal_sequence_number
+      received_stop = self._received_ranges[-1][1] if self._received_ranges else internal_sequence_number
+      if not self._retransmit_gaps(received_stop):
+        self._retransmit_gaps(self._recovery_point, limit=1)
+    else:
+      # Probe the receiver's window, in case the update that would have unblocked this exporter was lost.
       self.logger.warning(
-          "Retransmitting message {internal_sequence_number}",
+          "Probing the receive window with message {internal_sequence_number}",
           extra={'internal_sequence_number': internal_sequence_number})
-      self._export_message_self_only(message=message, internal_sequence_number=internal_sequence_number)
+      self._export_message_self_only(
+          message=self._queued_messages.popleft()[1],
+          internal_sequence_number=internal_sequence_number,
+          time_round_trip=False)
+
+  def _least_unsent_internal_sequence_number(self):
+    return self._least_internal_unacknowledged_sequence_number + len(self._pending_messages)
+
+  def _gaps(self, start, stop):
+    '''Generate the internal sequence numbers in [start, stop) that the receiver has not reported receiving.'''
+    for received_start, received_stop in self._received_ranges:
+      if received_start >= stop:
+        break
+      elif received_stop > start:
+        yield from range(start, received_start)
+        start = max(start, received_stop)
+    yield from range(start, stop)
+
+  def _retransmit_gaps(self, stop, limit=None):
+    '''
+    Retransmit the gaps from the loss scan point up to stop, and advance the loss scan point.
+
+    :param int stop: Retransmit no gaps at or after this internal sequence number.
+    :param int limit: If provided, the most gaps to retransmit.
+    :return: The number of retransmitted messages.
+    :rtype: int
+    '''
+    if self.reliable:
+      return 0
+
+    start = max(self._loss_scan_point, self._least_internal_unacknowledged_sequence_number)
+    stop = min(stop, self._least_unsent_internal_sequence_number())
+    if start >= stop:
+      return 0
+
+    n_retransmitted = 0
+    for internal_sequence_number in self._gaps(start, stop):
+      if limit is not None and n_retransmitted == limit:
+        stop = internal_sequence_number
+        break
+      self._retransmit(internal_sequence_number)
+      n_retransmitted += 1
+
+    self._loss_scan_point = stop
+    return n_retransmitted
+
+  def _retransmit(self, internal_sequence_number):
+    if self._timed_message is not None and self._timed_message[0] == internal_sequence_number:
+      self._timed_message = None
+    self._linker.n_retransmissions += 1
+    self.logger.warning(
+        "Retransmitting message {internal_sequence_number}",
+        extra={'internal_sequence_number': internal_sequence_number})
+    self._send(
+        message=self._pending_messages[internal_sequence_number - self._least_internal_unacknowledged_sequence_number],
+        internal_sequence_number=internal_sequence_number)
 
   @property
   def least_unacknowledged_sequence_number(self):
@@ -97,32 +358,67 @@ class Exporter(object):
     '''The id of the node receiving from this exporter'''
     return self._receiver['id']
 
-  def acknowledge(self, internal_sequence_number):
+  def acknowledge(self, internal_sequence_number, window=None, received=None):
     '''
     Acknowledge the receipt of all sequence numbers less than sequence_number.
 
     :param int internal_sequence_number: Some internal sequence number for which all
       smaller sequence numbers should now be acknowledged.
+    :param int window: If provided, the receive window advertised by the receiver.
+    :param list received: If provided, the ranges of internal sequence numbers the receiver has received,
+      as in `messages.linker.sequence_message_acknowledge`
     '''
     self.logger.debug(
         "exporter acknowledges all sequence numbers below {acknowledged_sequence_number}",
         extra={'acknowledged_sequence_number': internal_sequence_number})
 
-    if internal_sequence_number > self._least_internal_unacknowledged_sequence_number:
+    advanced = internal_sequence_number > self._least_internal_unacknowledged_sequence_number
+    if advanced:
+      self._timer_started_ms = self._linker.now_ms
+      if self._timed_message is not None and internal_sequence_number > self._timed_message[0]:
+        self._measure_round_trip(self._linker.now_ms - self._timed_message[1])
+        self._timed_message = None
+      else:
+        self._set_rto_from_estimates()
+
+      # Each entry is popped once, so acknowledgements take amortized constant time per message.
+      for i in range(internal_sequence_number - self._least_internal_unacknowledged_sequence_number):
+        self._least_unacknowledged_sequence_number = self._sequence_numbers.popleft()
+        if self._pending_messages:
+          self._pending_messages.popleft()
       self._least_internal_unacknowledged_sequence_number = internal_sequence_number
-      self._least_unacknowledged_sequence_number = self._internal_sequence_number_to_sequence_number[
-          internal_sequence_number]
-      # Clear out extra entries in self._internal_sequence_number_to_sequence_number to keep it from growing unboundedly.
-      # PERF(KK): An ordered list could change the asymptotics here... but the dictionary may never be large enough
-      #   for that perf improvement to matter.
-      self._internal_sequence_number_to_sequence_number = {
-          k: v
-          for k, v in self._internal_sequence_number_to_sequence_number.items() if k >= internal_sequence_number
-      }
-
-      # PERF(KK): binary search is possible here.
-      self._pending_messages = [(t, sn, msg) for t, sn, msg in self._pending_messages
-                                if sn >= self._least_internal_unacknowledged_sequence_number]
+
+      while self._queued_messages and self._queued_messages[0][0] < self._least_internal_unacknowledged_sequence_number:
+        # A probe may have been acknowledged along with messages that were queued after it.
+        self._queued_messages.popleft()
+
+    if received is not None:
+      self._received_ranges = [(start, stop) for start, stop in received if stop > internal_sequence_number]
+
+    if self._recovery_point is not None:
+      if self._least_internal_unacknowledged_sequence_number < self._recovery_point:
+        if advanced:
+          # The next gap among the messages pending at the timeout was likely lost as well.
+          self._retransmit_gaps(self._recovery_point, limit=1)
+      else:
+        self._recovery_point = None
+
+    if self._received_ranges:
+      self._retransmit_gaps(self._received_ranges[-1][1] - Exporter.DUPLICATE_THRESHOLD)
+
+    if window is not None:
+      self._window = window
+
+    self._send_queued_messages()
+
+  def _in_window(self, internal_sequence_number):
+    return internal_sequence_number < self._least_internal_unacknowledged_sequence_number + self._window
+
+  def _send_queued_messages(self):
+    '''Send any queued messages that now lie inside the receiver's window.'''
+    while self._queued_messages and self._in_window(self._queued_messages[0][0]):
+      internal_sequence_number, message = self._queued_messages.popleft()
+      self._export_message_self_only(message=message, internal_sequence_number=internal_sequence_number)
 
   def export_message(self, message, sequence_number):
     '''
@@ -140,19 +436,37 @@ class Exporter(object):
       for duplicated_exporter in self.duplicated_exporters:
         duplicated_exporter.export_message(message, sequence_number)
 
-    self._export_message_self_only(message, self._internal_sequence_number)
+    if not self.has_pending_messages():
+      # Every lower sequence number was either acknowledged or never sent to this receiver.
+      self._least_unacknowledged_sequence_number = sequence_number
+
+    if self._queued_messages or not self._in_window(self._internal_sequence_number):
+      self._queued_messages.append((self._internal_sequence_number, message))
+    else:
+      self._export_message_self_only(message, self._internal_sequence_number)
 
     self._internal_sequence_number += 1
-    self._internal_sequence_number_to_sequence_number[self._internal_sequence_number] = sequence_number + 1
+    self._sequence_numbers.append(sequence_number + 1)
 
-  def _export_message_self_only(self, message, internal_sequence_number):
+  def _export_message_self_only(self, message, internal_sequence_number, time_round_trip=True):
     '''
     Export a message to the receiver of self, but no duplicated receiver.
 
     :param message: The message
     :type message: :ref:`message`
     :param int internal_sequence_number: The sequence number of the new message.
+    :param bool time_round_trip: Whether the message may be timed to measure the round trip time.
     '''
-    self._pending_messages.append((self._linker.now_ms, internal_sequence_number, message))
-    sequence_message = messages.linker.sequence_message_send(message=message, sequence_number=internal_sequence_number)
+    if not self._pending_messages:
+      self._timer_started_ms = self._linker.now_ms
+    if time_round_trip and self._timed_message is None:
+      self._timed_message = (internal_sequence_number, self._linker.now_ms)
+    self._pending_messages.append(message)
+    self._send(message, internal_sequence_number)
+
+  def _send(self, message, internal_sequence_number):
+    sequence_message = messages.linker.sequence_message_send(
+        message=message,
+        sequence_number=internal_sequence_number,
+        acknowledgement=self._linker.piggyback_acknowledgement(self.receiver_id))
     self._linker.send(self._receiver, sequence_message)
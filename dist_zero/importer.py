@@ -1,4 +1,4 @@
-from dist_zero import messages
+from dist_zero import errors, messages
 
 
 class Importer(object):
@@ -9,8 +9,34 @@ class Importer(object):
   As messages arrive from the sender, the underlying `Node` should pass them to the `Importer.import_message` method.
   Internally, the `Importer` will de-duplicate and re-order messages, and eventually call a method like `Node.deliver` on
   each message, exactly once, and in the right order.
+
+  Flow control:
+
+  Each acknowledgement also advertises a receive window (see `Linker.receive_window`).  The sender
+  must not send messages beyond the window.  Regardless of the window it advertises, an importer never buffers
+  more than `Importer.RECEIVE_WINDOW` messages; any later messages are dropped, and will be retransmitted.
+
+  Acknowledgements are delayed.  The `Linker` decides which messages may be acknowledged
+  (see `Importer.allow_acknowledgement`), and either piggybacks an acknowledgement on a message to the sender
+  (see `Importer.piggyback_acknowledgement`) or sends it with its next batch of acknowledgements.
+
+  Selective acknowledgement:
+
+  Each acknowledgement also lists ranges of messages that the importer has received but can not yet acknowledge,
+  either because it is still waiting on earlier messages, or because its `Linker` is still waiting on the
+  acknowledgements of the messages they caused.  The sender will not retransmit them.  When messages arrive out of
+  order, the importer reports them with the next batch of acknowledgements, even if it has nothing new to acknowledge.
+  '''
+
+  RECEIVE_WINDOW = 1024
+  '''
+  The largest window an importer advertises, and the largest number of messages beyond
+  the least undelivered one that it will buffer.
   '''
 
+  MAX_RECEIVED_RANGES = 16
+  '''The largest number of ranges of received messages in a single acknowledgement.'''
+
   def __init__(self, linker, sender, first_sequence_number=0, remote_sequence_number_to_early_message=None):
     '''
     :param linker: The linker associated with this importer
@@ -27,6 +53,10 @@ class Importer(object):
     self.logger = self._linker.logger
 
     self._least_undelivered_remote_sequence_number = first_sequence_number # see `Importer.least_undelivered_remote_sequence_number`
+    self._least_acknowledged_remote_sequence_number = 0 # The sequence number of the last acknowledgement sent.
+    # All messages below this sequence number may be acknowledged.  See `Importer.allow_acknowledgement`
+    self._least_unacknowledgeable_remote_sequence_number = 0
+    self._has_unreported_messages = False # Whether messages have been received since the last acknowledgement
 
     if remote_sequence_number_to_early_message is not None:
       self._remote_sequence_number_to_early_message = {
@@ -43,11 +73,66 @@ class Importer(object):
   def switch_linker(self, linker):
     self._linker = linker
 
+  def snapshot(self):
+    '''
+    :return: The state of this importer.  See `Linker.restore`
+    :rtype: dict
+    '''
+    return {
+        'sender': self._sender,
+        'least_undelivered_remote_sequence_number': self._least_undelivered_remote_sequence_number,
+        # Pairs instead of a dict, as json would turn the integer keys into strings.
+        'early_messages': list(self._remote_sequence_number_to_early_message.items()),
+    }
+
   @property
   def least_undelivered_remote_sequence_number(self):
     '''The least sequence number (in the sender's sequence) that has never been delivered.'''
     return self._least_undelivered_remote_sequence_number
 
+  def allow_acknowledgement(self, remote_sequence_number):
+    '''
+    Allow the importer to acknowledge messages.  The acknowledgement will be sent later.
+
+    :param int remote_sequence_number: A sequence number from the sender.
+      All messages with sequence numbers less than remote_sequence_number must
+      be acknowledged by the underlying `Node`.
+    '''
+    self._least_unacknowledgeable_remote_sequence_number = max(self._least_unacknowledgeable_remote_sequence_number,
+                                                               remote_sequence_number)
+
+  def n_acknowledgeable_messages(self):
+    ''':return: The number of messages that may be acknowledged, but have not been.'''
+    return self._least_unacknowledgeable_remote_sequence_number - self._least_acknowledged_remote_sequence_number
+
+  def needs_acknowledgement(self):
+    '''
+    :return: True iff the importer has new messages to acknowledge, or to report as received.
+    :rtype: bool
+    '''
+    return self._has_unreported_messages or \
+        self._least_unacknowledgeable_remote_sequence_number > self._least_acknowledged_remote_sequence_number
+
+  def send_acknowledgement(self):
+    '''Send an acknowledgement of all the messages that may be acknowledged.'''
+    self.acknowledge(
+        max(self._least_acknowledged_remote_sequence_number, self._least_unacknowledgeable_remote_sequence_number))
+
+  def piggyback_acknowledgement(self):
+    '''
+    If the importer needs to acknowledge messages, consider the acknowledgement sent, and return it to be
+    piggybacked on a message to the sender.
+
+    :return: None, or the value of a `messages.linker.sequence_message_acknowledge` message.
+    :rtype: dict
+    '''
+    if self.needs_acknowledgement():
+      return self._acknowledgement(
+          max(self._least_acknowledged_remote_sequence_number, self._least_unacknowledgeable_remote_sequence_number)
+      )['value']
+    else:
+      return None
+
   def acknowledge(self, remote_sequence_number):
     '''
     Send an acknowledgement to the associated sender.
@@ -62,7 +147,52 @@ class Importer(object):
             'remote_sequence_number': remote_sequence_number,
             'sender_id': self.sender_id
         })
-    self._linker.send(self._sender, messages.linker.sequence_message_acknowledge(remote_sequence_number))
+    self._linker.send(self._sender, self._acknowledgement(remote_sequence_number))
+
+  def _acknowledgement(self, remote_sequence_number):
+    self._least_acknowledged_remote_sequence_number = remote_sequence_number
+    self._has_unreported_messages = False
+    return messages.linker.sequence_message_acknowledge(
+        remote_sequence_number, window=self._linker.receive_window(), received=self.received_ranges())
+
+  def received_ranges(self):
+    '''
+    :return: Ranges [start, stop] of the messages this importer has received but not acknowledged, at most
+      `Importer.MAX_RECEIVED_RANGES` of them, lowest first.
+    :rtype: list
+    '''
+    result = []
+    if self._least_acknowledged_remote_sequence_number < self._least_undelivered_remote_sequence_number:
+      result.append([self._least_acknowledged_remote_sequence_number, self._least_undelivered_remote_sequence_number])
+
+    for rsn in sorted(self._remote_sequence_number_to_early_message.keys()):
+      if result and result[-1][1] == rsn:
+        result[-1][1] += 1
+      elif len(result) == Importer.MAX_RECEIVED_RANGES:
+        break
+      else:
+        result.append([rsn, rsn + 1])
+
+    return result
+
+  def update_window(self):
+    '''
+    Advertise the current receive window to the sender without acknowledging any new messages.
+    Importers that have never acknowledged a message do not need to advertise a window.
+    '''
+    if self._least_acknowledged_remote_sequence_number > 0:
+      self.acknowledge(self._least_acknowledged_remote_sequence_number)
+
+  def will_import(self, remote_sequence_number):
+    '''
+    :param int remote_sequence_number: A sequence number from the sender.
+    :return: True iff `Importer.import_message` would keep a message with that sequence number,
+      i.e. the message lies within the receive window and has not been received before.
+    :rtype: bool
+    '''
+    return self._least_undelivered_remote_sequence_number <= remote_sequence_number < \
+        self._least_undelivered_remote_sequence_number + Importer.RECEIVE_WINDOW and \
+        remote_sequence_number not in self._remote_sequence_number_to_early_message
 
   def import_message(self, message, sender_id):
     '''
@@ -75,7 +205,14 @@ class Importer(object):
     if sender_id != self.sender_id:
       raise errors.InternalError("Impossible!  Importer must only get messages for its own sender.")
     rsn = message['sequence_number']
-    if rsn < self._least_undelivered_remote_sequence_number or rsn in self._remote_sequence_number_to_early_message:
+    if rsn >= self._least_undelivered_remote_sequence_number + Importer.RECEIVE_WINDOW:
+      self.logger.warning(
+          "Dropping message for sequence number {remote_sequence_number} beyond the receive window",
+          extra={
+              'remote_sequence_number': rsn,
+              'sender_id': self.sender_id
+          })
+    elif rsn < self._least_undelivered_remote_sequence_number or rsn in self._remote_sequence_number_to_early_message:
       self._linker.n_duplicates += 1
       self.logger.warning(("Received duplicate message for sequence number {remote_sequence_number}"
                            " from sender {sender_id}"),
@@ -83,6 +220,12 @@ class Importer(object):
                               'remote_sequence_number': rsn,
                               'sender_id': self.sender_id,
                           })
+      if rsn < self._least_acknowledged_remote_sequence_number:
+        # The sender is retransmitting a message that was already acknowledged, so the acknowledgement was likely
+        # lost.  Send it again.
+        self.update_window()
+      else:
+        self._has_unreported_messages = True
     else:
       self._remote_sequence_number_to_early_message[rsn] = message
 
@@ -104,6 +247,7 @@ class Importer(object):
       if message is None:
         # This message was not processed immediately, consider it reordered.
         self._linker.n_reorders += 1
+        self._has_unreported_messages = True
         self.logger.warning(
             "Postponing out of order message for sequence number {remote_sequence_number}",
             extra={
@@ -118,3 +262,14 @@ class Importer(object):
   @property
   def sender(self):
     return self._sender
+
+  def switch_sender(self, sender):
+    '''
+    Use a new handle for the sender, after it has moved to another machine.
+
+    :param sender: The new :ref:`handle` of the same sender.
+    :type sender: :ref:`handle`
+    '''
+    if sender['id'] != self.sender_id:
+      raise errors.InternalError("An importer can only switch to a handle for the same sender.")
+    self._sender = sender
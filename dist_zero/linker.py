@@ -1,3 +1,5 @@
+import bisect
+
 from dist_zero import importer, exporter, errors, messages
 
 
@@ -15,27 +17,41 @@ class Linker(object):
 
   The linker is then expected to make sure that `Exporter` instances retransmit at the right times
   and that `Importer` instances generate proper acknowledgements.
+
+  The linker also applies flow control.  When any of its exporters is blocked by a receiver's window, the linker
+  is backpressured (see `Linker.is_backpressured`): its importers advertise an empty window so that its senders
+  stop sending, and its node should stop generating new messages until the backpressure clears.
+
+  Acknowledgements are delayed.  When an exporter sends to a node that is also a sender to this linker,
+  any acknowledgement due to that sender is piggybacked on the message.  Other acknowledgements are sent in
+  batches (see `Linker.TIME_BETWEEN_ACKNOWLEDGEMENTS_MS`), unless so many messages await acknowledgement that
+  the sender's window may close.
   '''
 
   TIME_BETWEEN_ACKNOWLEDGEMENTS_MS = 50
-  '''The number of ms between acknowledgements sent to senders.'''
+  '''
+  The number of ms between batches of acknowledgements sent to senders.
+  Batches are sent when the time of the `MachineController` crosses a multiple of TIME_BETWEEN_ACKNOWLEDGEMENTS_MS,
+  so that all the nodes on a machine send their batches together, and the batches can share datagrams.
+  '''
 
   TIME_BETWEEN_RETRANSMISSION_CHECKS_MS = 20
   '''The number of ms between checks for whether we should retransmit to receivers.'''
 
-  def __init__(self, node, logger, deliver):
+  def __init__(self, node, logger, deliver, reliable=None):
     '''
     :param object node: An object implementing methods with the format of `Node.send`, `Node.deliver`, `Node.new_handle`
+    :param func reliable: If provided, a function reliable(handle) that returns True iff the layer below delivers
+      every message sent to the node with that :ref:`handle` exactly once.  Exporters to those nodes never retransmit.
     '''
     self._node = node
     self.logger = logger
-
-    self.now_ms = 0
+    self._reliable = reliable
 
     self._importers = {}
     self._exporters = {}
 
-    self.deliver = deliver
+    self._deliver = deliver
 
     self.n_retransmissions = 0
     '''Number of times this node has retransmitted a message'''
@@ -44,24 +60,30 @@ class Linker(object):
     self.n_duplicates = 0
     '''Number of times this node has received a message that was already received'''
 
-    self._time_since_sent_acknowledgements = 0
+    self._next_acknowledgements_ms = None # None, or when to send the next batch of acknowledgements
+    # Whether the least unacknowledged sequence number may have increased
+    # since the last call to `Linker._allow_acknowledgements`
+    self._acknowledgements_may_advance = False
+    # Whether some importer should send its acknowledgement without waiting for the next batch.
+    self._prompt_acknowledgements = False
     self._time_since_retransmitted_expired_pending_messages = 0
     self._initialized = False
 
-    self._branching = []
-    '''
-    An ordered list of pairs
-    (sent_sequence_number, pairs)
+    self._advertised_window = importer.Importer.RECEIVE_WINDOW # The window most recently advertised to senders
 
-    where sent_sequence_number is a sequence number that has been sent on all exporters
-    and pairs is a list of pairs (importer, least_unreceived_sequence_number)
-      where each pair gives the least unreceived sequence number of the importer at the time
-      that sent_sequence_number was generated.
+    self._branching = _Branching()
+    '''
+    For each sequence number that has been sent on all exporters, the least undelivered remote sequence number
+    of each importer at the time that sequence number was generated.
     '''
+    # Map the sender id of each importer that has delivered a message since the last entry in self._branching
+    # to that importer.
+    self._changed_importers = {}
 
   def remove_exporters(self, receiver_ids):
     for receiver_id in receiver_ids:
       self._exporters.pop(receiver_id)
+    self._acknowledgements_may_advance = True
 
   def remove_importers(self, sender_ids):
     '''
@@ -70,13 +92,8 @@ class Linker(object):
     '''
     for sender_id in sender_ids:
       self._importers.pop(sender_id)
-
-    for i in range(len(self._branching)):
-      sent_sequence_number, pairs = self._branching[i]
-      self._branching[i] = (sent_sequence_number,
-                            [(importer, least_unreceived_sequence_number)
-                             for importer, least_unreceived_sequence_number in self._branching[i][1]
-                             if importer.sender_id not in sender_ids])
+      self._changed_importers.pop(sender_id, None)
+    # Entries in self._branching for the removed importers are skipped once they are reached.
 
   def new_handle(self, for_node_id):
     return self._node.new_handle(for_node_id)
@@ -84,6 +101,36 @@ class Linker(object):
   def send(self, receiver, message):
     self._node.send(receiver=receiver, message=message)
 
+  def deliver(self, message, sequence_number, sender_id):
+    '''
+    Deliver a message that arrived in order on the importer for ``sender_id``.  Called by `Importer` instances.
+    '''
+    self._changed_importers[sender_id] = self._importers[sender_id]
+    self._deliver(message=message, sequence_number=sequence_number, sender_id=sender_id)
+
+  def piggyback_acknowledgement(self, receiver_id):
+    '''
+    :param str receiver_id: The id of a node that this linker is about to send a message to.
+    :return: None, or the value of an acknowledgement due to that node, to be piggybacked on the message.
+    :rtype: dict
+    '''
+    importer = self._importers.get(receiver_id, None)
+    if importer is None:
+      return None
+    else:
+      self._allow_acknowledgements()
+      return importer.piggyback_acknowledgement()
+
+  @property
+  def now_ms(self):
+    '''
+    The current time in milliseconds.
+
+    Nodes may go long stretches without having `Linker.elapse` called, so the linker reads the time of its
+    node's `MachineController` instead of counting elapsed time itself.
+    '''
+    return self._node._controller.now_ms
+
   @property
   def least_unused_sequence_number(self):
     return self._node.least_unused_sequence_number
@@ -95,10 +142,13 @@ class Linker(object):
     This method also tracks internally which Importer sequence numbers this sequence number corresponds to.
     '''
     result = self._node.least_unused_sequence_number
-    self._branching.append((result, [(importer, importer.least_undelivered_remote_sequence_number)
-                                     for sender_id, importer in self._importers.items()]))
+    if self._changed_importers:
+      self._branching.record(result, [(importer, importer.least_undelivered_remote_sequence_number)
+                                      for importer in self._changed_importers.values()])
+      self._changed_importers = {}
 
     self._node.least_unused_sequence_number += 1
+    self._acknowledgements_may_advance = True
 
     return result
 
@@ -116,6 +166,7 @@ class Linker(object):
         first_sequence_number=first_sequence_number,
         remote_sequence_number_to_early_message=remote_sequence_number_to_early_message)
     self._importers[sender['id']] = result
+    self._changed_importers[sender['id']] = result
     return result
 
   def new_exporter(self, receiver):
@@ -129,13 +180,17 @@ class Linker(object):
         linker=self,
         receiver=receiver,
     )
+    if self._reliable is not None:
+      result.reliable = self._reliable(receiver)
     self._exporters[receiver['id']] = result
     return result
 
   def receive_sequence_message(self, message, sender_id):
     if message['type'] == 'acknowledge':
       if sender_id in self._exporters:
-        self._exporters[sender_id].acknowledge(message['sequence_number'])
+        self._exporters[sender_id].acknowledge(
+            message['sequence_number'], window=message['window'], received=message['received'])
+        self._acknowledgements_may_advance = True
       else:
         # In past cases where the exporter for a given sender id is not present, it was often
         # the case that the exporter was removed prematurely.
@@ -146,6 +201,9 @@ class Linker(object):
             extra={'unrecognized_sender_id': sender_id})
 
     elif message['type'] == 'receive':
+      if 'acknowledgement' in message:
+        self.receive_sequence_message(message['acknowledgement'], sender_id)
+
       if sender_id in self._importers:
         self._importers[sender_id].import_message(message, sender_id)
       else:
@@ -159,6 +217,36 @@ class Linker(object):
     else:
       raise errors.InternalError('Unrecognized message type "{}"'.format(message['type']))
 
+  def retransmission_stats(self):
+    '''
+    :return: A map from the id of each receiver to the `Exporter.retransmission_stats` of its exporter.
+    :rtype: dict
+    '''
+    return {receiver_id: exporter.retransmission_stats() for receiver_id, exporter in self._exporters.items()}
+
+  def is_backpressured(self):
+    '''
+    :return: True iff some receiver's window has blocked an exporter of this linker.
+      While backpressured, the node should avoid generating new messages.
+    :rtype: bool
+    '''
+    return any(exporter.is_blocked() for exporter in self._exporters.values())
+
+  def receive_window(self):
+    '''
+    :return: The window that importers should advertise to their senders.
+    :rtype: int
+    '''
+    return 0 if self.is_backpressured() else importer.Importer.RECEIVE_WINDOW
+
+  def _update_windows(self):
+    '''If the receive window has changed since it was last advertised, advertise it to all senders.'''
+    window = self.receive_window()
+    if window != self._advertised_window:
+      self._advertised_window = window
+      for importer in self._importers.values():
+        importer.update_window()
+
   def least_unacknowledged_sequence_number(self):
     '''
     The least sequence number that has not been acknowledged by every Exporter responsible for it.
@@ -170,8 +258,8 @@ class Linker(object):
     return result
 
   def absorb_linker(self, linker):
-    self._branching.extend(linker._branching)
-    self._branching.sort()
+    self._branching.merge(linker._branching)
+    self._changed_importers.update(linker._changed_importers)
 
     for k, v in linker._exporters.items():
       v.switch_linker(self)
@@ -181,51 +269,256 @@ class Linker(object):
       v.switch_linker(self)
       self._importers[k] = v
 
+  def snapshot(self):
+    '''
+    Capture the state of this linker, its importers and its exporters, for restoring the linker on another machine.
+
+    :return: A json serializable snapshot.  See `Linker.restore`
+    :rtype: dict
+    '''
+    return {
+        'importers': [importer.snapshot() for importer in self._importers.values()],
+        'exporters': [exporter.snapshot() for exporter in self._exporters.values()],
+        'branching': [[sent_sequence_number, [[importer.sender_id, least_unreceived_sequence_number]
+                                              for importer, least_unreceived_sequence_number in changes
+                                              if self._is_linked(importer)]]
+                      for sent_sequence_number, changes in self._branching.entries()],
+        'n_retransmissions': self.n_retransmissions,
+        'n_reorders': self.n_reorders,
+        'n_duplicates': self.n_duplicates,
+    }
+
+  def restore(self, snapshot):
+    '''
+    Replace the importers and exporters of this linker with those from a snapshot.
+
+    :param dict snapshot: The output of `Linker.snapshot` on the linker of a node with the same id.
+    '''
+    self._importers = {}
+    self._exporters = {}
+
+    for importer_snapshot in snapshot['importers']:
+      self.new_importer(
+          sender=importer_snapshot['sender'],
+          first_sequence_number=importer_snapshot['least_undelivered_remote_sequence_number'],
+          remote_sequence_number_to_early_message=dict(importer_snapshot['early_messages']))
+
+    for exporter_snapshot in snapshot['exporters']:
+      restored_exporter = self.new_exporter(receiver=exporter_snapshot['receiver'])
+      restored_exporter.restore(exporter_snapshot)
+      if self._reliable is not None:
+        # The messages that were pending on the old machine may have been sent unreliably.
+        restored_exporter.set_reliable(self._reliable(restored_exporter.receiver))
+
+    for exporter_snapshot in snapshot['exporters']:
+      if exporter_snapshot['duplicated_receiver_ids'] is not None:
+        self._exporters[exporter_snapshot['receiver']['id']].duplicated_exporters = [
+            self._exporters[receiver_id] for receiver_id in exporter_snapshot['duplicated_receiver_ids']
+        ]
+
+    self._branching = _Branching()
+    for sent_sequence_number, pairs in snapshot['branching']:
+      self._branching.record(sent_sequence_number,
+                             [(self._importers[sender_id], least_unreceived_sequence_number)
+                              for sender_id, least_unreceived_sequence_number in pairs
+                              if sender_id in self._importers])
+
+    self.n_retransmissions = snapshot['n_retransmissions']
+    self.n_reorders = snapshot['n_reorders']
+    self.n_duplicates = snapshot['n_duplicates']
+    self._acknowledgements_may_advance = True
+
+  def handles(self):
+    '''
+    :return: The handles of all the senders and receivers linked to this linker.
+    :rtype: list
+    '''
+    return [importer.sender for importer in self._importers.values()] + \
+        [exporter.receiver for exporter in self._exporters.values()]
+
+  def switch_handle(self, handle):
+    '''
+    Switch to a new handle for a sender or receiver that has moved to another machine.
+
+    :param handle: The new :ref:`handle` of a node.  Importers and exporters for other nodes are unaffected.
+    :type handle: :ref:`handle`
+    '''
+    if handle['id'] in self._importers:
+      self._importers[handle['id']].switch_sender(handle)
+    if handle['id'] in self._exporters:
+      exporter = self._exporters[handle['id']]
+      exporter.switch_receiver(handle)
+      if self._reliable is not None:
+        exporter.set_reliable(self._reliable(handle))
+
   def elapse(self, ms):
     '''
     Elapse time
 
     :param int ms: The number of elapsed milliseconds
     '''
-    self.now_ms += ms
-
-    self._time_since_sent_acknowledgements += ms
     self._time_since_retransmitted_expired_pending_messages += ms
 
-    if self._time_since_sent_acknowledgements > Linker.TIME_BETWEEN_ACKNOWLEDGEMENTS_MS:
+    self._allow_acknowledgements()
+    self._schedule_acknowledgements()
+    if self._prompt_acknowledgements or \
+        (self._next_acknowledgements_ms is not None and self.now_ms >= self._next_acknowledgements_ms):
       self.send_acknowledgement_messages()
-      self._time_since_sent_acknowledgements = 0
 
     if self._time_since_retransmitted_expired_pending_messages > Linker.TIME_BETWEEN_RETRANSMISSION_CHECKS_MS:
       for exporter in self._exporters.values():
         exporter.retransmit_expired_pending_messages()
       self._time_since_retransmitted_expired_pending_messages = 0
 
-  def _branching_index_for_least_unacknowledged_sequence_number(self):
-    least_unacknowledged_sequence_number = self.least_unacknowledged_sequence_number()
+    self._update_windows()
 
-    branching_index = 0
-    while branching_index < len(
-        self._branching) and self._branching[branching_index][0] < least_unacknowledged_sequence_number:
-      # PERF(KK): binary search is possible here.
-      branching_index += 1
+  def ms_until_deadline(self):
+    '''
+    :return: The number of milliseconds that may elapse before `Linker.elapse` next has work to do,
+      or `None` if it will have no work until this linker sends or receives more messages.
+    :rtype: int
+    '''
+    result = None
+    self._allow_acknowledgements()
+    self._schedule_acknowledgements()
+    if self._prompt_acknowledgements:
+      result = 0
+    elif self._next_acknowledgements_ms is not None:
+      result = self._next_acknowledgements_ms - self.now_ms
+
+    ms_until_retransmission_check = None
+    for exporter in self._exporters.values():
+      if not exporter.reliable and exporter.has_pending_messages():
+        ms = exporter.ms_until_expiration()
+        if ms_until_retransmission_check is None or ms < ms_until_retransmission_check:
+          ms_until_retransmission_check = ms
+
+    if ms_until_retransmission_check is not None:
+      ms_until_retransmission_check = max(
+          ms_until_retransmission_check,
+          Linker.TIME_BETWEEN_RETRANSMISSION_CHECKS_MS + 1 - self._time_since_retransmitted_expired_pending_messages)
+      if result is None or ms_until_retransmission_check < result:
+        result = ms_until_retransmission_check
 
-    return branching_index
+    return result
+
+  def _is_linked(self, importer):
+    ''':return: True iff ``importer`` has not been removed from this linker.'''
+    return self._importers.get(importer.sender_id, None) is importer
+
+  def _allow_acknowledgements(self):
+    '''Allow each importer to acknowledge whatever messages it may now acknowledge.'''
+    if not self._acknowledgements_may_advance:
+      return
+    self._acknowledgements_may_advance = False
+
+    # The changes recorded for acknowledged sequence numbers, applied in order, leave each importer
+    # with the acknowledgements we need to allow.
+    for importer, least_undelivered_remote_sequence_number in self._branching.consume(
+        self.least_unacknowledged_sequence_number()):
+      if self._is_linked(importer):
+        importer.allow_acknowledgement(least_undelivered_remote_sequence_number)
+        # Don't let a full window of messages wait for the next batch.
+        if importer.n_acknowledgeable_messages() >= importer.RECEIVE_WINDOW // 2:
+          self._prompt_acknowledgements = True
+
+  def _schedule_acknowledgements(self):
+    '''If acknowledgements are needed and no batch is scheduled, schedule one at the next multiple of the interval.'''
+    if self._next_acknowledgements_ms is None and \
+        any(importer.needs_acknowledgement() for importer in self._importers.values()):
+      now_ms = self.now_ms
+      self._next_acknowledgements_ms = now_ms - now_ms % Linker.TIME_BETWEEN_ACKNOWLEDGEMENTS_MS + \
+          Linker.TIME_BETWEEN_ACKNOWLEDGEMENTS_MS
 
   def send_acknowledgement_messages(self):
-    branching_index = self._branching_index_for_least_unacknowledged_sequence_number()
+    '''Send the acknowledgements of all importers that need to send them.'''
+    self._allow_acknowledgements()
+    for importer in self._importers.values():
+      if importer.needs_acknowledgement():
+        importer.send_acknowledgement()
 
-    if branching_index == 0:
-      # No new messages need to be acknowledged.
-      pass
-    else:
-      # The last pairings of sender_id with least_undelivered_remote_sequence_number before branching_index
-      # will contain all the acknowledgements we need to send.
-      for importer, least_undelivered_remote_sequence_number in self._branching[branching_index - 1][1]:
-        if least_undelivered_remote_sequence_number == 0:
-          # Do not send acknowledgements to importers that have never sent us a message.
-          continue
-        else:
-          importer.acknowledge(least_undelivered_remote_sequence_number)
-
-      self._branching = self._branching[branching_index:]
+    self._prompt_acknowledgements = False
+    self._next_acknowledgements_ms = None
+
+
+class _Branching(object):
+  '''
+  A record of the least undelivered remote sequence numbers of the importers of a `Linker`
+  at the time it generated each of its sequence numbers.
+
+  The record is columnar, and only records changes.  Each entry is a generated sequence number along with the
+  importers that delivered messages since the previous entry, and their new least undelivered remote sequence numbers.
+  Sequence numbers generated while no importer delivered anything have no entry.
+  Entries are consumed in order once their sequence numbers are acknowledged.
+  '''
+
+  def __init__(self):
+    self._sequence_numbers = [] # The sequence number of each entry, in increasing order
+    self._ends = [] # For each entry, the index in the change columns just after its last change
+    self._importers = [] # For each change, the importer that changed
+    self._watermarks = [] # For each change, the new least undelivered remote sequence number of its importer
+    self._start = 0 # The index of the first unconsumed entry
+    self._change_start = 0 # The index of the first unconsumed change
+
+  def record(self, sequence_number, changes):
+    '''
+    Record an entry.
+
+    :param int sequence_number: A sequence number greater than that of any recorded entry.
+    :param list changes: A list of pairs (importer, least_undelivered_remote_sequence_number)
+    '''
+    if changes:
+      for importer, watermark in changes:
+        self._importers.append(importer)
+        self._watermarks.append(watermark)
+      self._sequence_numbers.append(sequence_number)
+      self._ends.append(len(self._importers))
+
+  def consume(self, sequence_number):
+    '''
+    Consume all the entries for sequence numbers less than ``sequence_number``.
+
+    :param int sequence_number: The least sequence number whose entry should not be consumed.
+    :return: The pairs (importer, least_undelivered_remote_sequence_number) of the consumed changes, in order.
+    :rtype: list
+    '''
+    stop = bisect.bisect_left(self._sequence_numbers, sequence_number, self._start)
+    if stop == self._start:
+      return []
+
+    change_start, change_stop = self._change_start, self._ends[stop - 1]
+    result = list(zip(self._importers[change_start:change_stop], self._watermarks[change_start:change_stop]))
+    self._start, self._change_start = stop, change_stop
+    if 2 * self._start >= len(self._sequence_numbers):
+      self._compact()
+    return result
+
+  def _compact(self):
+    '''Drop all consumed entries, so that the columns do not grow without bound.'''
+    self._sequence_numbers = self._sequence_numbers[self._start:]
+    self._ends = [end - self._change_start for end in self._ends[self._start:]]
+    self._importers = self._importers[self._change_start:]
+    self._watermarks = self._watermarks[self._change_start:]
+    self._start, self._change_start = 0, 0
+
+  def entries(self):
+    '''
+    :return: The unconsumed entries, as a list of pairs (sequence_number, changes) in the format of
+      the arguments to `_Branching.record`.
+    :rtype: list
+    '''
+    result = []
+    change_start = self._change_start
+    for i in range(self._start, len(self._sequence_numbers)):
+      result.append((self._sequence_numbers[i], list(zip(self._importers[change_start:self._ends[i]],
+                                                         self._watermarks[change_start:self._ends[i]]))))
+      change_start = self._ends[i]
+    return result
+
+  def merge(self, other):
+    '''Add the unconsumed entries of another `_Branching` instance to self.'''
+    entries = sorted(self.entries() + other.entries(), key=lambda entry: entry[0])
+    self._sequence_numbers, self._ends, self._importers, self._watermarks = [], [], [], []
+    self._start, self._change_start = 0, 0
+    for sequence_number, changes in entries:
+      self.record(sequence_number, changes)
@@ -1,13 +1,14 @@
 import asyncio
 import heapq
+from collections import OrderedDict
 import json
 import logging
-import re
+import time
 
-from cryptography.fernet import Fernet
 from random import Random
 
-from dist_zero import errors, messages, dns, settings
+from dist_zero import errors, messages, dns, settings, codec, session_crypto, spawners, network_errors, placement, \
+    channel
 
 from .node import data, program
 from .node.link.link import LinkNode
@@ -32,6 +33,11 @@ class MachineController(object):
     '''
     raise RuntimeError("Abstract Superclass")
 
+  @property
+  def now_ms(self):
+    '''The number of milliseconds of time that have elapsed on the nodes of this controller.'''
+    raise RuntimeError("Abstract Superclass")
+
   def sleep_ms(self, ms):
     '''
     Return an awaitable that sleeps for some number of milliseconds.
@@ -76,6 +82,29 @@ class MachineController(object):
     '''
     raise RuntimeError("Abstract Superclass")
 
+  def migrate_node(self, node, machine_id, node_config):
+    '''
+    Stop running a `Node` on this machine, and start it on another machine.
+    See `dist_zero.node.migration`
+
+    :param node: A `Node` managed by self.
+    :type node: `Node`
+    :param str machine_id: The id of the `MachineController` that should run the node.
+    :param node_config: The config for restarting the node, including its snapshot.
+    :type node_config: :ref:`message`
+    '''
+    raise RuntimeError("Abstract Superclass")
+
+  def delivers_reliably(self, node_handle):
+    '''
+    :param node_handle: The :ref:`handle` of a node.
+    :type node_handle: :ref:`handle`
+    :return: True iff every message `MachineController.send` sends to that node is delivered exactly once,
+      so that the sending node need not retransmit it.
+    :rtype: bool
+    '''
+    raise RuntimeError("Abstract Superclass")
+
   def new_transport(self, node, for_node_id):
     '''
     Create a new transport for sending to a local node.
@@ -177,6 +206,11 @@ class NodeManager(MachineController):
   MAX_POSTPONE_TIME_MS = 1200
   '''Maximum time a message will be postpone when simulating a network drop or reorder'''
 
+  LOAD_GOSSIP_INTERVAL_MS = 1000
+  '''Milliseconds between measurements of the load on this machine.'''
+  LOAD_GOSSIP_FANOUT = 2
+  '''Number of peers to share loads with after each measurement.'''
+
   def __init__(self, machine_config, spawner, ip_host, send_to_machine, machine_runner=None):
     '''
     :param machine_config: A configuration message of type 'machine_config'
@@ -203,7 +237,7 @@ class NodeManager(MachineController):
 
     self._random = Random(machine_config['random_seed']) if machine_config['random_seed'] is not None else Random()
 
-    self._network_errors_config = self._parse_network_errors_config(machine_config['network_errors_config'])
+    self._network_errors = network_errors.NetworkErrorSimulator(machine_config['network_errors_config'], self._random)
 
     self.system_id = machine_config['system_id']
 
@@ -215,42 +249,82 @@ class NodeManager(MachineController):
 
     self._ip_host = ip_host
 
+    # Used to encrypt whole datagrams sent to this machine.
+    self._session_key = session_crypto.new_session_key()
+    self.cipher = session_crypto.session_cipher(self._session_key)
+
     self._node_by_id = {}
     self._running = True
 
+    # For each node that was migrated away from this machine, a pair (handle, last_used_ms) of its new handle and
+    # the value of self._now_ms when it was last used, in order of last use.  Messages that still arrive here for
+    # those nodes are forwarded.  See `NodeManager._expire_migrated_nodes`
+    self._migrated_node_by_id = OrderedDict()
+
+    # For each node that is not running on this machine, but that messages have arrived for, a pair
+    # (first_held_ms, deliveries) where deliveries is the list of pairs (message, simulate_errors) of the arguments
+    # to self._handle_delivery for those messages, in the order they arrived.  Messages for a node can overtake the
+    # message that starts it, so they are held until it starts.  See `NodeManager._expire_held_deliveries`
+    self._held_deliveries_by_node_id = OrderedDict()
+
+    # Messages for nodes on each other machine are sent on a single channel.  See `dist_zero.channel`
+    self._channel_by_machine_id = {}
+
     self._now_ms = 0 # Current elapsed time in milliseconds
-    # a heap (as in heapq) of tuples (ms_of_occurence, send_receive, args)
-    # where args are the args to self._send_without_error_simulation or self._receive_without_error_simulation
-    # depending on whether send_or_receive is 'send' or 'receive'
+    # a heap (as in heapq) of tuples (ms_of_occurence, n, event_type, args)
+    # where args are the args to self._send_without_error_simulation, self._receive_without_error_simulation,
+    # self._send_to_machine or self._receive_on_channel depending on whether event_type is
+    # 'send', 'receive', 'send_datagram' or 'receive_datagram', and n is unique to each event.
     self._pending_events = []
+    self._n_pending_events = 0
 
     self._send_to_machine = send_to_machine
 
+    self._codec = codec.default_codec()
+
+    # Ordered list of machine_deliver_to_node messages for nodes on this machine that were sent by nodes
+    # on this machine.  Iff nonempty, a call to self._drain_local_deliveries is scheduled on the event loop.
+    self._local_deliveries = []
+
+    # Map the id of each node on this machine with received messages that it has not yet processed
+    # to the list of pairs (message, sender_id) for those messages, in the order they were received.
+    # Iff nonempty, a call to self._drain_inboxes is scheduled on the event loop.
+    self._inbox_by_node_id = {}
+
+    # Nodes are only elapsed when they reach a deadline.
+    # A heap (as in heapq) of pairs (deadline_ms, node_id).  Entries that no longer match
+    # self._deadline_ms_by_node_id are stale and are skipped.
+    self._deadlines = []
+    self._deadline_ms_by_node_id = {} # Map each node id to its earliest deadline
+    self._elapsed_ms_by_node_id = {} # Map each node id to the value of self._now_ms it has been elapsed through
+
+    # For choosing where to spawn new nodes.  See `dist_zero.placement`
+    self._placement_policy = placement.from_system_config(self.system_config)
+    self._load_table = placement.LoadTable(self.id)
+    self._load_version = 0
+    self._n_received_messages = 0 # Since the last load measurement
+    self._last_load_measurement = None # None, or a triple (now_ms, process_time, monotonic_time)
+
     ELAPSE_TIME_MS = 220
     self._stop_elapse_nodes = self.periodically(ELAPSE_TIME_MS, lambda: self.elapse_nodes(ELAPSE_TIME_MS))
+    self._stop_gossip_load = self.periodically(NodeManager.LOAD_GOSSIP_INTERVAL_MS, self._gossip_load)
 
   @property
   def random(self):
     return self._random
 
-  def _parse_network_errors_config(self, network_errors_config):
-    return {
-        direction: {
-            key: {
-                'rate': value['rate'],
-                'regexp': re.compile(value['regexp'])
-            }
-            for key, value in direction_config.items()
-        }
-        for direction, direction_config in network_errors_config.items()
-    }
+  @property
+  def now_ms(self):
+    return self._now_ms
 
   def sleep_ms(self, ms):
     return self._spawner.sleep_ms(ms)
 
   def send(self, node_handle, message, sending_node):
     sending_node_id = None if sending_node is None else sending_node.id
-    error_type = self._get_simulated_network_error(message, direction='outgoing')
+    if sending_node_id in self._elapsed_ms_by_node_id:
+      self._set_deadline(sending_node_id, self._now_ms)
+    error_type = self._network_errors.error_type(message, direction='outgoing')
     send_args = (node_handle, message, sending_node_id)
     if error_type:
       logger.info(
@@ -259,24 +333,62 @@ class NodeManager(MachineController):
               'sender_id': sending_node_id,
               'error_type': error_type
           })
-      if error_type == 'drop':
-        pass
-      elif error_type == 'reorder':
-        heapq.heappush(self._pending_events, (self._postpone_ms(), 'send', json.dumps(send_args)))
-      elif error_type == 'duplicate':
-        self._send_without_error_simulation(node_handle, message, sending_node_id)
-        heapq.heappush(self._pending_events, (self._postpone_ms(), 'send', json.dumps(send_args)))
+      if node_handle['controller_id'] != self.id:
+        # Simulate the error on the datagram that carries the message to the other machine,
+        # so that the channel recovers from it just as it would from a real network error.
+        self._send_without_error_simulation(*send_args, send_datagram=self._simulated_datagram_sender(error_type))
       else:
-        raise errors.InternalError("Unrecognized error type '{}'".format(error_type))
+        self._simulate_error(error_type, 'send', send_args, self._send_without_error_simulation)
     else:
       self._send_without_error_simulation(*send_args)
 
+  def _simulated_datagram_sender(self, error_type):
+    '''
+    :param str error_type: The type of network error to simulate.
+    :return: A function send_datagram(message, transport) like self._send_to_machine that simulates the error.
+    :rtype: func
+    '''
+
+    def _send_datagram(message, transport):
+      self._simulate_error(error_type, 'send_datagram', (message, transport), self._send_to_machine)
+
+    return _send_datagram
+
+  def _simulate_error(self, error_type, event_type, args, f):
+    '''
+    Simulate a network error on an event.
+
+    :param str error_type: The type of network error to simulate.
+    :param str event_type: The type of the event.  See self._pending_events
+    :param tuple args: The args of the event.
+    :param func f: The function that would handle the event right away if there were no error.
+    '''
+    if error_type == 'drop':
+      pass
+    elif error_type == 'reorder':
+      self._postpone(event_type, args)
+    elif error_type == 'duplicate':
+      f(*args)
+      self._postpone(event_type, args)
+    else:
+      raise errors.InternalError("Unrecognized error type '{}'".format(error_type))
+
+  def _postpone(self, event_type, args):
+    # NOTE(KK): The args are kept by reference.  Messages must not be mutated once they are sent.
+    self._n_pending_events += 1
+    heapq.heappush(self._pending_events, (self._postpone_ms(), self._n_pending_events, event_type, args))
+
   def _postpone_ms(self):
     return (self._now_ms + NodeManager.MIN_POSTPONE_TIME_MS + int(
         self._random.random() * (NodeManager.MAX_POSTPONE_TIME_MS - NodeManager.MIN_POSTPONE_TIME_MS)))
 
-  def _send_without_error_simulation(self, node_handle, message, sending_node_id):
-    '''Like `NodeManager.send`, but do not simulate any errors'''
+  def _send_without_error_simulation(self, node_handle, message, sending_node_id, send_datagram=None):
+    '''
+    Like `NodeManager.send`, but do not simulate any errors
+
+    :param func send_datagram: If provided, the function to send the first datagram carrying the message to another
+      machine, in place of self._send_to_machine.  See `MachineChannel.send`
+    '''
     logger.debug(
         "Sending message from {sending_node_id} to {recipient_handle}: {message_type}",
         extra={
@@ -285,12 +397,61 @@ class NodeManager(MachineController):
             'message_type': message['type'],
         })
 
-    encoded_message = self._encrypt(node_handle, json.dumps(message))
+    if node_handle['controller_id'] == self.id:
+      self._deliver_locally(node_id=node_handle['id'], message=message, sending_node_id=sending_node_id)
+      return
+
+    self._load_table.learn_peer(node_handle['controller_id'], node_handle['transport'])
+    encoded_message = self._encrypt(node_handle, self._codec.encode_payload(message))
 
-    self._send_to_machine(
-        message=messages.machine.machine_deliver_to_node(
+    self._channel(node_handle['controller_id']).send(
+        messages.machine.machine_deliver_to_node(
             node_id=node_handle['id'], message=encoded_message, sending_node_id=sending_node_id),
-        transport=node_handle['transport'])
+        transport=node_handle['transport'],
+        send_datagram=send_datagram)
+
+  def _deliver_locally(self, node_id, message, sending_node_id):
+    '''
+    Deliver a message to a node on this machine on a later iteration of the event loop,
+    without encoding, encrypting or sending it over the network.
+    Local messages are delivered in the order they were sent.
+    '''
+    # Copy the message in every mode, so that the receiver never shares data with a sender that goes on to
+    # mutate or reuse it, and simulated tests run the same code as production.
+    message = self._codec.decode_payload(self._codec.encode_payload(message))
+    # PERF(KK): This copy can be taken out once senders are guaranteed never to change a message after sending it.
+
+    self._local_deliveries.append(
+        messages.machine.machine_deliver_to_node(node_id=node_id, message=message, sending_node_id=sending_node_id))
+    if len(self._local_deliveries) == 1:
+      asyncio.get_event_loop().call_soon(self._drain_local_deliveries)
+
+  def _drain_local_deliveries(self):
+    if not self._running:
+      self._local_deliveries = []
+      return
+
+    local_deliveries, self._local_deliveries = self._local_deliveries, []
+    for local_delivery in local_deliveries:
+      # Go through handle_message so that local messages are subject to the same simulated network errors.
+      self.handle_message(local_delivery)
+
+  def _channel(self, machine_id):
+    '''
+    :param str machine_id: The id of another machine.
+    :return: The `MachineChannel` to that machine, creating it if it does not yet exist.
+    :rtype: `MachineChannel`
+    '''
+    result = self._channel_by_machine_id.get(machine_id, None)
+    if result is None:
+      result = channel.MachineChannel(
+          controller=self,
+          machine_id=machine_id,
+          send_to_machine=self._send_to_machine,
+          transport=messages.machine.ip_transport(self._ip_host, session_key=self._session_key),
+          deliver=self._deliver_from_channel)
+      self._channel_by_machine_id[machine_id] = result
+    return result
 
   def spawn_node(self, node_config):
     # In general, the config should be serialized and deserialized at some point.
@@ -298,17 +459,114 @@ class NodeManager(MachineController):
     node_config = json.loads(json.dumps(node_config))
     # PERF(KK): This serialization/deserialization can be taken out when not in simulated mode.
 
-    # TODO(KK): Always running the new Node on the same controller that spawns it is clearly
-    #   broken.  Come up with test cases that nodes are spawned in more reasonable placed and fix it.
-    self.start_node(node_config)
+    machine_id = self._placement_policy.choose(node_config, self._load_table)
+    self._load_table.note_spawned(machine_id)
+    if machine_id == self.id:
+      self.start_node(node_config)
+    else:
+      logger.info(
+          "Placing new '{node_type}' node {node_id} on machine {placed_machine_id}",
+          extra={
+              'node_type': node_config['type'],
+              'node_id': self._format_node_id_for_logs(node_config['id']),
+              'placed_machine_id': machine_id,
+          })
+      self._channel(machine_id).send(
+          messages.machine.machine_start_node(node_config), transport=self._load_table.transport(machine_id))
 
     return node_config['id']
 
+  def _measure_load(self):
+    '''
+    :return: A :ref:`message` of type 'machine_load' describing the current load on this machine.
+    :rtype: :ref:`message`
+    '''
+    measurement = (self._now_ms, time.process_time(), time.monotonic())
+    messages_per_second, cpu_usage = 0.0, 0.0
+    if self._last_load_measurement is not None:
+      last_now_ms, last_process_time, last_monotonic_time = self._last_load_measurement
+      if self._now_ms > last_now_ms:
+        messages_per_second = 1000.0 * self._n_received_messages / (self._now_ms - last_now_ms)
+      if self.mode != spawners.MODE_SIMULATED and measurement[2] > last_monotonic_time:
+        # Simulated machines share a process, so their CPU usage can not be told apart.
+        cpu_usage = (measurement[1] - last_process_time) / (measurement[2] - last_monotonic_time)
+
+    self._last_load_measurement = measurement
+    self._n_received_messages = 0
+    self._load_version += 1
+
+    return messages.machine.machine_load(
+        machine_id=self.id,
+        transport=messages.machine.ip_transport(self._ip_host, session_key=self._session_key),
+        version=self._load_version,
+        n_nodes=len(self._node_by_id),
+        messages_per_second=messages_per_second,
+        cpu_usage=cpu_usage)
+
+  def _gossip_load(self):
+    '''Measure the load on this machine, and share all known loads with a few peers.'''
+    self._load_table.update(self._measure_load())
+    peer_ids = self._load_table.gossip_targets(NodeManager.LOAD_GOSSIP_FANOUT)
+    if peer_ids:
+      gossip = messages.machine.machine_gossip(self._load_table.loads())
+      for peer_id in peer_ids:
+        self._send_to_machine(message=gossip, transport=self._load_table.transport(peer_id))
+
+  def migrate_node(self, node, machine_id, node_config):
+    if machine_id == self.id or not self._load_table.is_known(machine_id):
+      raise errors.InternalError(f"Can not migrate a node to unknown machine \"{machine_id}\".")
+
+    logger.info(
+        "Migrating '{node_type}' node {node_id} to machine {placed_machine_id}",
+        extra={
+            'node_type': node_config['type'],
+            'node_id': self._format_node_id_for_logs(node.id),
+            'placed_machine_id': machine_id,
+        })
+    transport = self._load_table.transport(machine_id)
+    self._channel(machine_id).send(messages.machine.machine_start_node(node_config), transport=transport)
+    self._migrated_node_by_id[node.id] = ({
+        'id': node.id,
+        'controller_id': machine_id,
+        'transport': transport,
+        'session_key': node._session_key,
+    }, self._now_ms)
+    self.terminate_node(node.id)
+
+  def _forward_to_migrated_node(self, node_id, message, sending_node_id):
+    '''
+    Forward a message for a node that is no longer on this machine.
+
+    :return: True iff the node was migrated away from this machine, and the message was forwarded.
+    :rtype: bool
+    '''
+    if node_id not in self._migrated_node_by_id:
+      return False
+    node_handle, _last_used_ms = self._migrated_node_by_id.pop(node_id)
+    self._migrated_node_by_id[node_id] = (node_handle, self._now_ms)
+
+    if not isinstance(message, (bytes, bytearray)):
+      message = self._encrypt(node_handle, self._codec.encode_payload(message))
+    self._channel(node_handle['controller_id']).send(
+        messages.machine.machine_deliver_to_node(
+            node_id=node_id, message=message, sending_node_id=sending_node_id),
+        transport=node_handle['transport'])
+    return True
+
   def terminate_node(self, node_id):
     self._node_by_id.pop(node_id)
+    self._placement_policy.forget(node_id)
+    self._elapsed_ms_by_node_id.pop(node_id)
+    # Any entry left in self._deadlines is now stale.
+    self._deadline_ms_by_node_id.pop(node_id, None)
+
+  def delivers_reliably(self, node_handle):
+    # Messages for other machines are carried by a `MachineChannel`, which retransmits them and delivers them
+    # exactly once.  Messages between nodes on this machine may suffer simulated network errors.
+    return node_handle['controller_id'] != self.id
 
   def new_transport(self, node, for_node_id):
-    return messages.machine.ip_transport(self._ip_host)
+    return messages.machine.ip_transport(self._ip_host, session_key=self._session_key)
 
   def transfer_transport(self, transport, for_node_id):
     return dict(transport)
@@ -322,6 +580,8 @@ class NodeManager(MachineController):
 
   def parse_node(self, node_config):
     node = self._parse_node_config_without_role(node_config)
+    if 'migration_snapshot' in node_config:
+      node.restore(node_config['migration_snapshot'])
     if 'start_participant_role' in node_config:
       node.start_participant_role(node_config['start_participant_role'])
 
@@ -348,6 +608,15 @@ class NodeManager(MachineController):
     node = self.parse_node(node_config)
 
     self._node_by_id[node.id] = node
+    # A node that migrates back to this machine is no longer forwarded anywhere.
+    self._migrated_node_by_id.pop(node.id, None)
+    self._elapsed_ms_by_node_id[node.id] = self._now_ms
+    self._set_deadline(node.id, self._now_ms)
+
+    if node.id in self._held_deliveries_by_node_id:
+      _first_held_ms, deliveries = self._held_deliveries_by_node_id.pop(node.id)
+      for message, simulate_errors in deliveries:
+        self._handle_delivery(message, simulate_errors=simulate_errors)
     return node
 
   def handle_api_message(self, message):
@@ -364,10 +633,24 @@ class NodeManager(MachineController):
             message['message']['type'],
         ))
       node = self._node_by_id[message['node_id']]
+      self._elapse_node(node)
+      self._set_deadline(node.id, self._now_ms)
       return {
           'status': 'ok',
           'data': node.handle_api_message(message['message']),
       }
+    elif message['type'] == 'api_machine_message':
+      self.handle_message(message['message'])
+      return {'status': 'ok', 'data': None}
+    elif message['type'] == 'locate_node':
+      if message['node_id'] in self._node_by_id:
+        location = self.id
+      elif message['node_id'] in self._migrated_node_by_id:
+        node_handle, _last_used_ms = self._migrated_node_by_id[message['node_id']]
+        location = node_handle['controller_id']
+      else:
+        location = None
+      return {'status': 'ok', 'data': location}
     else:
       logger.error("Unrecognized API message type {message_type}", extra={'message_type': message['type']})
       return {
@@ -381,19 +664,30 @@ class NodeManager(MachineController):
     else:
       return node_id[:8]
 
-  def _encrypt(self, node_handle, message):
-    if settings.encrypt_all_messages:
-      fernet = Fernet(node_handle['fernet_key'])
-      encoded_message = fernet.encrypt(message.encode(messages.ENCODING)).decode(messages.ENCODING)
-      return encoded_message
+  def _encrypt(self, node_handle, payload):
+    if settings.encrypt_messages:
+      return session_crypto.session_cipher(node_handle['session_key']).encrypt(payload)
     else:
-      return message
+      return payload
 
-  def _decrypt(self, node, message):
-    if settings.encrypt_all_messages:
-      return node.fernet.decrypt(message.encode(messages.ENCODING)).decode(messages.ENCODING)
+  def _decrypt(self, node, payload):
+    if settings.encrypt_messages:
+      return node.cipher.decrypt(payload)
     else:
-      return message
+      return payload
+
+  def _decode_delivered_message(self, node, payload):
+    '''
+    Decode the inner message of a machine_deliver_to_node message.
+
+    :param node: The `Node` receiving the message.
+    :param payload: Either the encoded (and possibly encrypted) `bytes` generated by another `NodeManager`,
+      or a plain message generated by a `SystemController`.
+    '''
+    if isinstance(payload, (bytes, bytearray)):
+      return self._codec.decode_payload(self._decrypt(node, payload))
+    else:
+      return payload
 
   def handle_message(self, message):
     '''
@@ -404,51 +698,154 @@ class NodeManager(MachineController):
     '''
     if message['type'] == 'machine_start_node':
       self.start_node(message['node_config'])
-    elif message['type'] == 'machine_deliver_to_node':
-      sender_id = message['sending_node_id']
-      node_id = message['node_id']
-      if node_id not in self._node_by_id:
-        # This message could be for a node that was just terminated.
-        logger.warning(
-            "Received a message for a node '{missing_node_id}' not on this machine.",
-            extra={'missing_node_id': node_id})
-        return
-      node = self._node_by_id[node_id]
-
-      decoded_message = json.loads(self._decrypt(node, message['message']))
-
-      error_type = self._get_simulated_network_error(message, direction='outgoing')
-      receive_args = (node_id, decoded_message, sender_id)
+    elif message['type'] == 'machine_gossip':
+      for load in message['loads']:
+        if load['machine_id'] != self.id:
+          self._load_table.update(load)
+    elif message['type'] == 'machine_channel':
+      message, error_type = self._channel_error_type(message)
       if error_type:
         logger.info(
-            'Simulating {error_type} of an outgoing message', extra={
-                'sender_id': sender_id,
+            'Simulating {error_type} of an incomming datagram',
+            extra={
+                'sending_machine_id': message['machine_id'],
                 'error_type': error_type
             })
-        if error_type == 'drop':
-          pass
-        elif error_type == 'reorder':
-          heapq.heappush(self._pending_events, (self._postpone_ms(), 'receive', json.dumps(receive_args)))
-        elif error_type == 'duplicate':
-          self._receive_without_error_simulation(node_id, decoded_message, sender_id)
-          heapq.heappush(self._pending_events, (self._postpone_ms(), 'receive', json.dumps(receive_args)))
-        else:
-          raise errors.InternalError("Unrecognized error type '{}'".format(error_type))
+        self._simulate_error(error_type, 'receive_datagram', (message, ), self._receive_on_channel)
       else:
-        self._receive_without_error_simulation(*receive_args)
+        self._receive_on_channel(message)
+    elif message['type'] == 'machine_deliver_to_node':
+      self._handle_delivery(message, simulate_errors=True)
     else:
       logger.error("Unrecognized message type {unrecognized_type}", extra={'unrecognized_type': message['type']})
 
-  def _receive_without_error_simulation(self, node_id, message, sender_id):
-    '''receive a message to the proper node without any network error simulations'''
+  def _receive_on_channel(self, message):
+    '''Receive a 'machine_channel' message on the channel to the machine that sent it.'''
+    if 'transport' in message:
+      self._load_table.learn_peer(message['machine_id'], message['transport'])
+    self._channel(message['machine_id']).receive(message)
+
+  def _channel_error_type(self, message):
+    '''
+    :param message: A 'machine_channel' :ref:`message` received by this machine.
+    :type message: :ref:`message`
+    :return: A pair (message, error_type) where error_type is the type of network error to simulate on the
+      datagram, or `False`.  Datagrams are matched against the simulated network errors config by the node message
+      they carry.  If that node message had to be decoded, the returned message carries it decoded, so that it is
+      not decoded again when it is delivered.
+    :rtype: tuple
+    '''
+    if not self._network_errors.simulates('incomming'):
+      return message, False
+    value = message['value']
+    if value['type'] != 'receive' or value['message']['type'] != 'machine_deliver_to_node':
+      return message, False
+    delivery = value['message']
+    node = self._node_by_id.get(delivery['node_id'], None)
+    if node is None:
+      return message, False
+    decoded = self._decode_delivered_message(node, delivery['message'])
+    message = dict(message, value=dict(value, message=dict(delivery, message=decoded)))
+    return message, self._network_errors.error_type(decoded, direction='incomming')
+
+  def _deliver_from_channel(self, message):
+    if message['type'] == 'machine_start_node':
+      self.start_node(message['node_config'])
+    else:
+      # Any simulated network errors were applied to the datagrams of the channel.
+      self._handle_delivery(message, simulate_errors=False)
+
+  def _handle_delivery(self, message, simulate_errors):
+    '''
+    Handle a machine_deliver_to_node message.
+
+    :param message: The machine_deliver_to_node :ref:`message`
+    :type message: :ref:`message`
+    :param bool simulate_errors: Whether to simulate network errors on the message.
+    '''
+    sender_id = message['sending_node_id']
+    node_id = message['node_id']
+    if node_id not in self._node_by_id:
+      if not self._forward_to_migrated_node(node_id, message['message'], sender_id):
+        # The message may have overtaken the message that starts the node.
+        self._hold_delivery(node_id, message, simulate_errors)
+      return
+    self._n_received_messages += 1
     node = self._node_by_id[node_id]
-    logger.debug(
-        "Node is now receiving message of type {message_type} from {sender_id}",
-        extra={
-            'message_type': message['type'],
-            'sender_id': sender_id,
-        })
-    node.receive(message=message, sender_id=sender_id)
+
+    decoded_message = self._decode_delivered_message(node, message['message'])
+
+    error_type = self._network_errors.error_type(decoded_message, direction='incomming') if simulate_errors else False
+    receive_args = (node_id, decoded_message, sender_id)
+    if error_type:
+      logger.info(
+          'Simulating {error_type} of an incomming message', extra={
+              'sender_id': sender_id,
+              'error_type': error_type
+          })
+      self._simulate_error(error_type, 'receive', receive_args, self._receive_without_error_simulation)
+    else:
+      self._receive_without_error_simulation(*receive_args)
+
+  def _hold_delivery(self, node_id, message, simulate_errors):
+    '''Hold a machine_deliver_to_node message for a node that has not started on this machine.'''
+    if node_id in self._held_deliveries_by_node_id:
+      self._held_deliveries_by_node_id[node_id][1].append((message, simulate_errors))
+    else:
+      self._held_deliveries_by_node_id[node_id] = (self._now_ms, [(message, simulate_errors)])
+
+  def _expire_held_deliveries(self):
+    '''
+    Drop the messages held for nodes that have not started within ``UNSTARTED_NODE_HOLD_MS`` of the first of them.
+    They were likely for nodes that were terminated.
+    '''
+    expiration_ms = self._now_ms - self.system_config['UNSTARTED_NODE_HOLD_MS']
+    while self._held_deliveries_by_node_id:
+      node_id, (first_held_ms, deliveries) = next(iter(self._held_deliveries_by_node_id.items()))
+      if first_held_ms > expiration_ms:
+        break
+      self._held_deliveries_by_node_id.popitem(last=False)
+      logger.warning(
+          "Dropping {n_messages} messages for a node '{missing_node_id}' that never started on this machine.",
+          extra={
+              'n_messages': len(deliveries),
+              'missing_node_id': node_id
+          })
+
+  def _receive_without_error_simulation(self, node_id, message, sender_id):
+    '''
+    Receive a message to the proper node without any network error simulations.
+
+    The message is put in the node's inbox.  Inboxes are drained once per iteration of the event loop,
+    so that each node can process all the messages it received in the same iteration together.
+    '''
+    if not self._inbox_by_node_id:
+      asyncio.get_event_loop().call_soon(self._drain_inboxes)
+    self._inbox_by_node_id.setdefault(node_id, []).append((message, sender_id))
+
+  def _drain_inboxes(self):
+    '''Have each node with received messages in its inbox process them in a single batch.'''
+    inbox_by_node_id, self._inbox_by_node_id = self._inbox_by_node_id, {}
+    if not self._running:
+      return
+
+    for node_id, inbox in inbox_by_node_id.items():
+      node = self._node_by_id.get(node_id, None)
+      if node is None:
+        # The node was terminated or migrated while the messages were waiting.
+        for message, sender_id in inbox:
+          self._forward_to_migrated_node(node_id, message, sender_id)
+        continue
+
+      logger.debug(
+          "Node is now receiving a batch of {n_messages} messages", extra={
+              'n_messages': len(inbox),
+              'node_id': self._format_node_id_for_logs(node_id),
+          })
+      # Bring the node up to date before it reacts to the messages.
+      self._elapse_node(node)
+      self._set_deadline(node_id, self._now_ms)
+      node.receive_batch(inbox)
 
   async def clean_all(self):
     self._running = False
@@ -459,7 +856,7 @@ class NodeManager(MachineController):
 
   def elapse_nodes(self, ms):
     '''
-    Elapse ms milliseconds of time on all nodes managed by self.
+    Elapse ms milliseconds of time, and elapse time on those nodes managed by self that have reached their deadlines.
 
     Also, simulate any postponed network activity from network errors generated earlier.
 
@@ -469,46 +866,76 @@ class NodeManager(MachineController):
     final_time_ms = self._now_ms + ms
 
     while self._pending_events and self._pending_events[0][0] <= final_time_ms:
-      t, send_or_receive, args = heapq.heappop(self._pending_events)
-      if send_or_receive == 'send':
-        self._send_without_error_simulation(*json.loads(args))
-      elif send_or_receive == 'receive':
-        self._receive_without_error_simulation(*json.loads(args))
+      t, n, event_type, args = heapq.heappop(self._pending_events)
+      if event_type == 'send':
+        self._send_without_error_simulation(*args)
+      elif event_type == 'receive':
+        self._receive_without_error_simulation(*args)
+      elif event_type == 'send_datagram':
+        self._send_to_machine(*args)
+      elif event_type == 'receive_datagram':
+        self._receive_on_channel(*args)
       else:
-        raise errors.InternalError("Unrecognized 'send' or 'receive': {}".format(send_or_receive))
+        raise errors.InternalError("Unrecognized pending event type: {}".format(event_type))
 
-      self._elapse_nodes_without_simulated_network_messages(t - self._now_ms)
       self._now_ms = t
+      self._elapse_nodes_without_simulated_network_messages()
 
-    self._elapse_nodes_without_simulated_network_messages(final_time_ms - self._now_ms)
     self._now_ms = final_time_ms
-
-  def _elapse_nodes_without_simulated_network_messages(self, ms):
-    '''Like elapse_nodes, but do no simulate any postponed network activity.'''
-    # Elapsing time on nodes can create new nodes, thus changing the list of nodes.
-    # Therefore, to avoid updating a dictionary while iterating over it, we make a copy
-    for node in list(self._node_by_id.values()):
+    self._elapse_nodes_without_simulated_network_messages()
+
+  def _elapse_nodes_without_simulated_network_messages(self):
+    '''Elapse time up to self._now_ms on all nodes that have reached their deadlines.'''
+    # Collect the due nodes before elapsing any of them, as elapsing a node can set new deadlines.
+    due_node_ids = []
+    while self._deadlines and self._deadlines[0][0] <= self._now_ms:
+      deadline_ms, node_id = heapq.heappop(self._deadlines)
+      if self._deadline_ms_by_node_id.get(node_id, None) == deadline_ms:
+        self._deadline_ms_by_node_id.pop(node_id)
+        due_node_ids.append(node_id)
+
+    for node_id in due_node_ids:
+      node = self._node_by_id.get(node_id, None)
+      if node is not None:
+        self._elapse_node(node)
+        ms = node.ms_until_deadline()
+        if ms is not None:
+          # Even a node with work to do right away will wait until the next call to elapse_nodes.
+          self._set_deadline(node_id, self._now_ms + max(ms, 1))
+
+    # PERF(KK): There is one channel per peer machine, far fewer than there are nodes, so channels are
+    #   elapsed on every pass instead of by deadline.
+    for machine_channel in self._channel_by_machine_id.values():
+      machine_channel.elapse()
+
+    self._expire_migrated_nodes()
+    self._expire_held_deliveries()
+
+  def _expire_migrated_nodes(self):
+    '''
+    Stop forwarding to the migrated nodes that no message has been forwarded to in ``MIGRATION_FORWARDING_MS``.
+    By then, the nodes that held their old handles have long since switched to their new handles.
+    '''
+    expiration_ms = self._now_ms - self.system_config['MIGRATION_FORWARDING_MS']
+    while self._migrated_node_by_id:
+      node_id, (node_handle, last_used_ms) = next(iter(self._migrated_node_by_id.items()))
+      if last_used_ms > expiration_ms:
+        break
+      self._migrated_node_by_id.popitem(last=False)
+
+  def _elapse_node(self, node):
+    '''Elapse time on a single node up to self._now_ms.'''
+    ms = self._now_ms - self._elapsed_ms_by_node_id[node.id]
+    if ms > 0:
+      self._elapsed_ms_by_node_id[node.id] = self._now_ms
       node.elapse(ms)
 
-  def _get_simulated_network_error(self, message, direction):
-    '''
-    Determine whether we should simulate a network error on a message.
-
-    :param message: Any message that a `Node` on this machine is trying to send.
-    :type message: :ref:`message`
-    :param str direction: 'incomming' or 'outgoing'. Indicates whether the message is being received or sent respectively.
-
-    :return: The error type to simulate, or `None` if we should not simulate a network error at all.
-    :rtype: str
-    '''
-    network_errors_config = self._network_errors_config[direction]
-    for error_type, match_parameters in network_errors_config.items():
-      rate = match_parameters['rate']
-      regexp = match_parameters['regexp']
-      if rate > 0.0 and self._random.random() < rate and regexp.match(json.dumps(message)):
-        return error_type
-
-    return False
+  def _set_deadline(self, node_id, deadline_ms):
+    '''Ensure the node with id ``node_id`` will be elapsed no later than ``deadline_ms``.'''
+    existing_deadline_ms = self._deadline_ms_by_node_id.get(node_id, None)
+    if existing_deadline_ms is None or deadline_ms < existing_deadline_ms:
+      self._deadline_ms_by_node_id[node_id] = deadline_ms
+      heapq.heappush(self._deadlines, (deadline_ms, node_id))
 
   def _ensure_machine_runner(self):
     if self._machine_runner is None:
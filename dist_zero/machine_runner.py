@@ -1,5 +1,4 @@
 import asyncio
-import json
 import logging
 import os
 import socket
@@ -14,7 +13,7 @@ import dist_zero.logging
 
 import dist_zero.spawners.parse
 import dist_zero.load_balancer
-from dist_zero import settings, machine, messages, web_servers, errors, misc
+from dist_zero import settings, machine, messages, web_servers, errors, misc, codec
 from dist_zero.spawners import docker
 
 logger = logging.getLogger(__name__)
@@ -53,6 +52,8 @@ class MachineRunner(object):
 
     self._load_balancer = None
 
+    self._datagram_sender = dist_zero.transport.DatagramSender()
+
     self.node_manager = machine.NodeManager(
         machine_config=machine_config,
         spawner=dist_zero.spawners.parse.from_config(machine_config['spawner']),
@@ -106,17 +107,32 @@ class MachineRunner(object):
 
   def _send_to_machine(self, message, transport):
     dst = (transport['host'], settings.MACHINE_CONTROLLER_DEFAULT_UDP_PORT)
-    dist_zero.transport.send_udp(message, dst)
+    if settings.encrypt_datagrams:
+      session_key = transport.get('session_key', None)
+      if session_key is None:
+        raise errors.InternalError("Can not encrypt a datagram for a machine without its session key.")
+    else:
+      session_key = None
+    self._datagram_sender.send(message, dst, session_key=session_key)
 
   async def _bind_udp(self):
     logger.info("MachineRunner binding UDP port {}".format(self._udp_port), extra={'port': self._udp_port})
 
     runner = self
+    wire_codec = codec.default_codec()
 
     class handler(asyncio.DatagramProtocol):
+      def connection_made(self, transport):
+        # Outgoing messages are sent from the same endpoint.
+        runner._datagram_sender.connection_made(transport)
+
+      def connection_lost(self, exc):
+        runner._datagram_sender.connection_lost()
+
       def datagram_received(self, data, addr):
-        message = json.loads(data.decode(messages.ENCODING))
-        runner.node_manager.handle_message(message)
+        for encoded_message in dist_zero.transport.unpack_datagram(
+            data, runner.node_manager.cipher, require_encryption=settings.encrypt_datagrams):
+          runner.node_manager.handle_message(wire_codec.decode(encoded_message))
 
       def error_received(self, exc):
         logger.error(f"UDP error: {exc}")
@@ -139,13 +155,23 @@ class MachineRunner(object):
     logger.info("MachineRunner binding TCP port {}".format(self._tcp_port), extra={'port': self._tcp_port})
 
     async def handler(reader, writer):
-      buf = await reader.read(settings.MSG_BUFSIZE)
-      message = json.loads(buf.decode(messages.ENCODING))
-      response = self.node_manager.handle_api_message(message)
-      binary = bytes(json.dumps(response), messages.ENCODING)
-      writer.write(binary)
-      await writer.drain()
-      writer.close()
+      # Each connection is persistent, and may carry many pipelined requests.
+      decoder = dist_zero.transport.ApiFrameDecoder()
+      try:
+        while True:
+          data = await reader.read(settings.MSG_BUFSIZE)
+          if not data:
+            break
+          for request_id, message in decoder.feed(data):
+            response = self.node_manager.handle_api_message(message)
+            # Stream the response a frame at a time so that large responses respect flow control.
+            for frame in dist_zero.transport.api_frames(request_id, response):
+              writer.write(frame)
+              await writer.drain()
+      except ConnectionError:
+        logger.warning("tcp API connection was lost")
+      finally:
+        writer.close()
 
     result = await asyncio.start_server(
         handler,
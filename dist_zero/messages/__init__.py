@@ -3,7 +3,7 @@ Functions to build standard messages.
 '''
 from .common import ENCODING
 
-from . import common, sum, machine, data, linker, link, transaction, program
+from . import common, sum, machine, data, linker, link, transaction, program, migration
 
 # Actions
 
@@ -189,6 +189,17 @@ def kid_summary(size, n_kids, availability, messages_per_second, height):
   }
 
 
+def kid_summary_delta(changes):
+  '''
+  Sent by `DataNode` kids to their parents in place of a kid_summary message,
+  once the parent has received a complete kid_summary message.
+
+  :param dict changes: A dictionary mapping some of the fields of a kid_summary message to their new values.
+    Fields that are not present have not changed significantly since the parent last heard of them.
+  '''
+  return {'type': 'kid_summary_delta', 'changes': changes}
+
+
 def bumped_height(proxy, kid_ids):
   '''
   Sent by an `DataNode` to its adjacent node to inform it that the data node has bumped its height
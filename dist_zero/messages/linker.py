@@ -1,4 +1,4 @@
-def sequence_message_send(message, sequence_number):
+def sequence_message_send(message, sequence_number, acknowledgement=None):
   '''
   Informs the receiving `Node` that it has just received a message with a sequence number.
 
@@ -6,22 +6,34 @@ def sequence_message_send(message, sequence_number):
   :type message: :ref:`message`
 
   :param int sequence_number: The sequence number associated with this message.
+
+  :param acknowledgement: If provided, the value of a `sequence_message_acknowledge` message to the recipient
+    that is piggybacked on this message.
+  :type acknowledgement: dict
   '''
-  return {
-      'type': 'sequence_message',
-      'value': {
-          'type': 'receive',
-          'message': message,
-          'sequence_number': sequence_number
-      }
-  }
+  value = {'type': 'receive', 'message': message, 'sequence_number': sequence_number}
+  if acknowledgement is not None:
+    value['acknowledgement'] = acknowledgement
+  return {'type': 'sequence_message', 'value': value}
 
 
-def sequence_message_acknowledge(sequence_number):
+def sequence_message_acknowledge(sequence_number, window, received):
   '''
   This message acknowledges the receipt of all sequence numbers < sequence_number on the recipient.
 
   :param int sequence_number: The least sequence number that sender has not acknowledged.
     All lower sequence numbers are acknowledged.
+  :param int window: The receive window.  The recipient may send messages with sequence numbers
+    less than sequence_number + window.
+  :param list received: A sorted list of disjoint pairs [start, stop] of ranges of sequence numbers
+    that the sender has received, but not acknowledged.  The recipient need not retransmit them.
   '''
-  return {'type': 'sequence_message', 'value': {'type': 'acknowledge', 'sequence_number': sequence_number}}
+  return {
+      'type': 'sequence_message',
+      'value': {
+          'type': 'acknowledge',
+          'sequence_number': sequence_number,
+          'window': window,
+          'received': received,
+      }
+  }
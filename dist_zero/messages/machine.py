@@ -10,8 +10,15 @@ def server_address(domain, ip, port):
   return {'domain': domain, 'ip': ip, 'port': port}
 
 
-def ip_transport(host):
-  return {'type': 'ip_transport', 'host': host}
+def ip_transport(host, session_key=None):
+  '''
+  A transport for sending to a machine over ip.
+
+  :param str host: The host of the receiving machine.
+  :param str session_key: If provided, the session key of the receiving machine.
+    It is used to encrypt whole datagrams when ``ENCRYPTION_GRANULARITY`` is 'datagram'.
+  '''
+  return {'type': 'ip_transport', 'host': host, 'session_key': session_key}
 
 
 # Machine configs
@@ -30,6 +37,23 @@ def std_system_config():
   Every time this many milliseconds pass on a data node, it should send a kid_summary message
   to its parent.
 
+  **KID_SUMMARY_THRESHOLDS**
+
+  Maps fields of a kid_summary message to the relative change in that field that a data node should consider
+  significant enough to report to its parent.  Changes to fields that are not present are always significant.
+
+  **DATA_NODE_SPLIT_POLICY**
+
+  How a `DataNode` decides which kids to split, and where.  One of
+
+  - 'count': Split kids only when the node is low on capacity, and split them so that each side has as many kids.
+  - 'load': Also split any kid whose message rate exceeds ``DATA_NODE_KID_LOAD_LIMIT``, and split kids so that each
+    side receives about as many messages.  Leaves report their message rates to their parents.
+
+  **DATA_NODE_KID_LOAD_LIMIT**
+
+  Under the 'load' split policy, a kid with more than this many messages per second will be split.
+
   **TOTAL_KID_CAPACITY_TRIGGER**
 
   When all the kids of a data node have less than this much capacity,
@@ -49,6 +73,28 @@ def std_system_config():
   If a sum node has fewer than ``SUM_NODE_RECEIVER_LOWER_LIMIT`` receivers and ``SUM_NODE_SENDER_LOWER_LIMIT`` senders
   for more than ``SUM_NODE_TOO_FEW_RECEIVERS_TIME_MS`` milliseconds,
   it will trigger a transaction to excise the sum node.
+
+  **PLACEMENT_POLICY**
+
+  The name of the `PlacementPolicy` that machines use to choose where to run newly spawned nodes.
+  One of 'local', 'least_loaded', 'spread_siblings' or 'colocate'.  See `dist_zero.placement`.
+  It defaults to 'local', which runs every new node on the machine that spawns it.
+  Systems opt in to spreading their nodes across machines by choosing one of the other policies.
+
+  **PLACEMENT_IMBALANCE**
+
+  A machine will only place a new node on another machine if the load score of that machine is lower than its own
+  by more than this amount.
+
+  **MIGRATION_FORWARDING_MS**
+
+  After a node migrates away from a machine, the machine forwards the messages that still arrive for it to its new
+  machine.  It forgets the node once this many milliseconds pass without any message to forward.
+
+  **UNSTARTED_NODE_HOLD_MS**
+
+  Messages for a node that a machine is about to start can arrive before the message that starts it.
+  The machine holds them until the node starts, and drops them once this many milliseconds pass without it starting.
   '''
   return {
       # When an `DataNode` has this many kids, it will trigger a split.
@@ -62,6 +108,17 @@ def std_system_config():
       # to its parent.
       'KID_SUMMARY_INTERVAL': 200,
 
+      # Data nodes report a change of more than 20% in their message rate to their parent.
+      # Changes in any other field of a kid summary are always reported.
+      'KID_SUMMARY_THRESHOLDS': {
+          'messages_per_second': 0.2
+      },
+
+      # How data nodes choose which kids to split, and where.  Either 'count' or 'load'.
+      'DATA_NODE_SPLIT_POLICY': 'count',
+      # Under the 'load' split policy, kids receiving more than this many messages per second are split.
+      'DATA_NODE_KID_LOAD_LIMIT': 500,
+
       # When all the kids of a data node have less than this much capacity,
       # it should spawn a new kid
       'TOTAL_KID_CAPACITY_TRIGGER': 5,
@@ -80,6 +137,16 @@ def std_system_config():
       'SUM_NODE_RECEIVER_LOWER_LIMIT': 3,
       'SUM_NODE_SENDER_LOWER_LIMIT': 3,
       'SUM_NODE_TOO_FEW_RECEIVERS_TIME_MS': 3 * 1000,
+
+      # How machines choose where to run newly spawned nodes.
+      'PLACEMENT_POLICY': 'local',
+      'PLACEMENT_IMBALANCE': 4,
+
+      # How long a machine keeps forwarding to a migrated node after the last message it forwarded.
+      'MIGRATION_FORWARDING_MS': 60 * 1000,
+
+      # How long a machine holds the messages for a node that has not started before dropping them.
+      'UNSTARTED_NODE_HOLD_MS': 60 * 1000,
   }
 
 
@@ -88,6 +155,8 @@ def std_simulated_network_errors_config():
   Configuration for simulating network errors.
 
   This configuration produces no simulated errors at all.
+  See `dist_zero.network_errors` for the other criteria (``types`` and ``fields``) that a rule may use to
+  match messages.
 
   .. code-block:: python
 
@@ -170,6 +239,38 @@ def machine_start_node(node_config):
   return {'type': 'machine_start_node', 'node_config': node_config}
 
 
+def machine_load(machine_id, transport, version, n_nodes, messages_per_second, cpu_usage):
+  '''
+  A summary of the load on a machine.
+
+  :param str machine_id: The id of the machine.
+  :param transport: A :ref:`transport` for sending machine messages to the machine.
+  :type transport: :ref:`transport`
+  :param int version: Increases each time the machine measures its load.  Later versions replace earlier ones.
+  :param int n_nodes: The number of nodes running on the machine.
+  :param float messages_per_second: The rate at which the machine's nodes are receiving messages.
+  :param float cpu_usage: The fraction of the time the machine's process spent on the CPU.
+  '''
+  return {
+      'type': 'machine_load',
+      'machine_id': machine_id,
+      'transport': transport,
+      'version': version,
+      'n_nodes': n_nodes,
+      'messages_per_second': messages_per_second,
+      'cpu_usage': cpu_usage,
+  }
+
+
+def machine_gossip(loads):
+  '''
+  A message from one machine to another sharing the loads it knows about.
+
+  :param list loads: A list of :ref:`message` of type 'machine_load'.
+  '''
+  return {'type': 'machine_gossip', 'loads': loads}
+
+
 def machine_deliver_to_node(node_id, message, sending_node_id):
   '''
   A message to a machine telling it to deliver an embedded message to a node.
@@ -182,6 +283,22 @@ def machine_deliver_to_node(node_id, message, sending_node_id):
   return {'type': 'machine_deliver_to_node', 'message': message, 'node_id': node_id, 'sending_node_id': sending_node_id}
 
 
+def machine_channel(machine_id, value, transport=None):
+  '''
+  A message carrying part of the stream of a `MachineChannel` from one machine to another.
+
+  :param str machine_id: The id of the sending machine.
+  :param dict value: The value of a sequence message (see `dist_zero.messages.linker`) whose messages
+    are themselves ``machine_deliver_to_node`` messages.
+  :param transport: If provided, a :ref:`transport` the receiving machine can use to send to the sending machine.
+  :type transport: :ref:`transport`
+  '''
+  result = {'type': 'machine_channel', 'machine_id': machine_id, 'value': value}
+  if transport is not None:
+    result['transport'] = transport
+  return result
+
+
 # API messages
 def api_node_message(node_id, message):
   '''
@@ -194,6 +311,27 @@ def api_node_message(node_id, message):
   return {'type': 'api_node_message', 'node_id': node_id, 'message': message}
 
 
+def api_machine_message(message):
+  '''
+  API message for passing a machine message to a machine, for senders that can not encrypt datagrams for it.
+
+  :param message: A machine :ref:`message` for the handle_message method of the `MachineController`.
+  :type message: :ref:`message`
+  '''
+  return {'type': 'api_machine_message', 'message': message}
+
+
+def locate_node(node_id):
+  '''
+  API message to a machine asking where a node that it ran is now running.
+
+  :param str node_id: The id of a `Node` that is or was running on the machine.
+  :return: The id of the `MachineController` running the node, or None if the machine does not know.
+  :rtype: str
+  '''
+  return {'type': 'locate_node', 'node_id': node_id}
+
+
 def link_datasets(link_config):
   '''
   Instructs a `ProgramNode` to create a new link.
@@ -310,6 +448,15 @@ def kill_node():
   return {'type': 'kill_node'}
 
 
+def migrate_node(machine_id):
+  '''
+  API message to a node telling it to move itself to another machine.
+
+  :param str machine_id: The id of the `MachineController` that should run the node.
+  '''
+  return {'type': 'migrate_node', 'machine_id': machine_id}
+
+
 def spawn_new_senders():
   '''
   Indicates to a sum node that it should spawn new senders.
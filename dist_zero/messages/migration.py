@@ -0,0 +1,40 @@
+'''
+Messages for moving running nodes between machines.
+'''
+
+
+def node_snapshot(session_key, least_unused_sequence_number, linker, postponed_transaction_messages,
+                  queued_transaction_roles, state):
+  '''
+  The state of a running `Node`, from which an identical node can be restarted on another machine.
+
+  :param str session_key: The session key of the node.  The restarted node keeps it, so that messages
+    encrypted for the old node can still be decrypted.
+  :param int least_unused_sequence_number: The least sequence number the node has not yet used.
+  :param linker: A snapshot of the node's `Linker`.  See `Linker.snapshot`
+  :type linker: :ref:`message`
+  :param list postponed_transaction_messages: A list of triples (transaction_id, message, sender_id)
+    of transaction messages the node has received for transactions it has not yet started.
+  :param list queued_transaction_roles: A list of triples (transaction_id, typename, args) for the transaction roles
+    that were waiting to start on the node.  See `Node.snapshot`
+  :param object state: State specific to the type of the node.
+  '''
+  return {
+      'type': 'node_snapshot',
+      'session_key': session_key,
+      'least_unused_sequence_number': least_unused_sequence_number,
+      'linker': linker,
+      'postponed_transaction_messages': postponed_transaction_messages,
+      'queued_transaction_roles': queued_transaction_roles,
+      'state': state,
+  }
+
+
+def node_moved(node):
+  '''
+  Informs a node that one of the nodes it holds a handle for is now running on another machine.
+
+  :param node: The new :ref:`handle` for the moved node.
+  :type node: :ref:`handle`
+  '''
+  return {'type': 'node_moved', 'node': node}
@@ -0,0 +1,135 @@
+'''
+Simulated network errors.
+
+A `NodeManager` can be configured to simulate dropped, reordered and duplicated messages.
+Its ``network_errors_config`` maps each direction ('incomming' or 'outgoing') and error type
+('drop', 'reorder' or 'duplicate') to a rule.  Each rule has a ``rate`` (the probability that a matching
+message will suffer that error), and any combination of the following criteria.  A message matches a rule
+iff it meets every criterion the rule gives.
+
+  - ``types``: A list of message types.  The message matches if it, or any message nested inside it,
+    has one of these types.
+  - ``fields``: A dictionary.  The message matches if it, or any message nested inside it,
+    has all the same values for the keys of ``fields``.
+  - ``regexp``: A regular expression that must match the json serialization of the message.
+    It is supported for compatibility; ``types`` and ``fields`` are much cheaper to match.
+
+Rules are compiled once into `Matcher` instances.  Messages are only examined after the random draw for a rule
+succeeds, and rules with a rate of 0 are discarded entirely, so simulation costs nothing when all rates are 0.
+'''
+
+import re
+
+from dist_zero import codec, errors, messages
+
+DIRECTIONS = ['incomming', 'outgoing']
+ERROR_TYPES = ['drop', 'reorder', 'duplicate']
+
+# Regular expressions that match any serialized message.
+_MATCH_ALL_REGEXPS = {'', '.*'}
+
+_json_codec = codec.JsonCodec()
+
+
+def iter_messages(message):
+  '''
+  Iterate over a message and all the messages nested inside it.
+
+  :param message: Any :ref:`message`
+  :type message: :ref:`message`
+  :return: An iterator of each dictionary with a 'type' key found inside ``message``, including ``message`` itself.
+  '''
+  stack = [message]
+  while stack:
+    value = stack.pop()
+    if isinstance(value, dict):
+      if 'type' in value:
+        yield value
+      stack.extend(value.values())
+    elif isinstance(value, list):
+      stack.extend(value)
+
+
+class Matcher(object):
+  '''A compiled rule for deciding whether a message is subject to a simulated network error.'''
+
+  def __init__(self, types=None, fields=None, regexp=None):
+    '''
+    :param list types: If provided, the list of message types to match.
+    :param dict fields: If provided, the fields to match.
+    :param str regexp: If provided, a regular expression to match against the serialized message.
+    '''
+    self._types = None if types is None else frozenset(types)
+    self._fields = None if not fields else list(fields.items())
+    self._regexp = None if regexp is None or regexp in _MATCH_ALL_REGEXPS else re.compile(regexp)
+
+  @staticmethod
+  def from_config(rule):
+    return Matcher(types=rule.get('types', None), fields=rule.get('fields', None), regexp=rule.get('regexp', None))
+
+  def matches(self, message):
+    '''
+    :param message: Any :ref:`message`
+    :type message: :ref:`message`
+    :return: True iff ``message`` matches this rule.
+    :rtype: bool
+    '''
+    if self._types is not None and not any(m['type'] in self._types for m in iter_messages(message)):
+      return False
+
+    if self._fields is not None and \
+        not any(all(m.get(key, None) == value for key, value in self._fields) for m in iter_messages(message)):
+      return False
+
+    if self._regexp is not None and not self._regexp.match(_json_codec.encode(message).decode(messages.ENCODING)):
+      return False
+
+    return True
+
+
+class NetworkErrorSimulator(object):
+  '''Decides which messages should suffer simulated network errors.'''
+
+  def __init__(self, network_errors_config, random):
+    '''
+    :param dict network_errors_config: Configuration for simulating network errors.
+      See `std_simulated_network_errors_config` for an example.
+    :param random: The `random.Random` instance to draw from.
+    '''
+    self._random = random
+    self._rules = {}
+    for direction, direction_config in network_errors_config.items():
+      if direction not in DIRECTIONS:
+        raise errors.InternalError(f"Unrecognized network error direction \"{direction}\".")
+      rules = []
+      for error_type, rule in direction_config.items():
+        if error_type not in ERROR_TYPES:
+          raise errors.InternalError(f"Unrecognized network error type \"{error_type}\".")
+        if rule['rate'] > 0.0:
+          rules.append((error_type, rule['rate'], Matcher.from_config(rule)))
+      self._rules[direction] = rules
+
+  def simulates(self, direction):
+    '''
+    :param str direction: 'incomming' or 'outgoing'.
+    :return: True iff some messages in that direction may suffer simulated network errors.
+    :rtype: bool
+    '''
+    return bool(self._rules.get(direction, None))
+
+  def error_type(self, message, direction):
+    '''
+    Determine whether we should simulate a network error on a message.
+
+    :param message: Any message that a `Node` is sending or receiving.
+    :type message: :ref:`message`
+    :param str direction: 'incomming' or 'outgoing'. Indicates whether the message is being received or sent.
+
+    :return: The error type to simulate, or `False` if we should not simulate a network error at all.
+    :rtype: str
+    '''
+    for error_type, rate, matcher in self._rules.get(direction, ()):
+      if self._random.random() < rate and matcher.matches(message):
+        return error_type
+
+    return False
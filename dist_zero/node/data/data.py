@@ -6,7 +6,9 @@ from dist_zero.node.node import Node
 from dist_zero.node.data import leaf_html
 from dist_zero.node.data import publisher
 
+from .kids import DataNodeKids, mergeable_n_kids_limit
 from .monitor import Monitor
+from .summary import KidSummaryReporter
 from .transactions import remove_leaf
 
 logger = logging.getLogger(__name__)
@@ -56,7 +58,6 @@ class DataNode(Node):
 
     self._updated_summary = True
     '''Set to true when the current summary may have changed.'''
-    self._last_kid_summary = None
 
     self._domain_name = None
     self._routing_kids_listener = None
@@ -91,16 +92,18 @@ class DataNode(Node):
     CHECK_INTERVAL = self.system_config['KID_SUMMARY_INTERVAL']
     self._stop_recorded_user = None
     if self._recorded_user is not None:
-      self._recorded_user.simulate(self._controller, self._receive_input_action)
+      self._recorded_user.simulate(
+          self._controller, self._receive_input_action, is_backpressured=self.linker.is_backpressured)
 
     self._monitor = Monitor(self)
+    self._kid_summary_reporter = KidSummaryReporter(self)
     self._monitor_ms = 0
-    self._will_check_limits = False
+    self._ms_since_load_report = 0 # Only used by leaves under the 'load' split policy
 
   def check_limits(self):
-    if not self._will_check_limits:
-      self._monitor.check_limits(self._monitor_ms)
-      self._monitor_ms = 0
+    # Requests for a check are coalesced into any check that has not yet started.
+    self._monitor.check_limits(self._monitor_ms)
+    self._monitor_ms = 0
 
   def _receive_input_action(self, message):
     self.logger.warning(
@@ -118,11 +121,7 @@ class DataNode(Node):
 
   @property
   def MERGEABLE_N_KIDS_FIRST(self):
-    MAX_N_KIDS = self.system_config['DATA_NODE_KIDS_LIMIT']
-    if MAX_N_KIDS <= 3:
-      return 1
-    else:
-      return MAX_N_KIDS // 3
+    return mergeable_n_kids_limit(self.system_config)
 
   @property
   def MERGEABLE_N_KIDS_SECOND(self):
@@ -134,18 +133,7 @@ class DataNode(Node):
 
     :return: None if no 2 kids are mergable.  Otherwise, a pair of the ids of two mergeable kids.
     '''
-    ordered_kid_ids = list(self._kids)
-    best_pair = None
-    least_total_kids = None
-    for left_id, right_id in zip(ordered_kid_ids, ordered_kid_ids[1:]):
-      if left_id not in do_not_use_ids and right_id not in do_not_use_ids:
-        if self._kids_are_mergeable(left_id, right_id):
-          total_kids = self._kids.summaries[left_id]['n_kids'] + self._kids.summaries[right_id]['n_kids']
-          if best_pair is None or total_kids < least_total_kids:
-            best_pair = (left_id, right_id)
-            least_total_kids = total_kids
-
-    return best_pair
+    return self._kids.best_mergeable_pair(do_not_use_ids)
 
   def _kids_are_mergeable(self, left_id, right_id):
     return left_id in self._kids.summaries and right_id in self._kids.summaries and \
@@ -164,18 +152,24 @@ class DataNode(Node):
     elif message['type'] == 'goodbye_parent':
       self.start_transaction_eventually(remove_leaf.RemoveLeaf(kid_id=sender_id))
     elif message['type'] == 'kid_summary':
-      if sender_id in self._kids:
-        if message != self._kids.summaries.get(sender_id, None):
-          self._kids.set_summary(sender_id, message)
-          if self._monitor.out_of_capacity():
-            # These updates should be propogated immediately.
-            self._send_kid_summary()
-          else:
-            self._updated_summary = True
-          self.check_limits()
+      self._on_kid_summary(message, sender_id)
+    elif message['type'] == 'kid_summary_delta':
+      if sender_id in self._kids.summaries:
+        self._on_kid_summary(dict(self._kids.summaries[sender_id], **message['changes']), sender_id)
     else:
       super(DataNode, self).receive(message=message, sender_id=sender_id)
 
+  def _on_kid_summary(self, summary, sender_id):
+    if sender_id in self._kids:
+      if summary != self._kids.summaries.get(sender_id, None):
+        self._kids.set_summary(sender_id, summary)
+        if self._monitor.out_of_capacity():
+          # These updates should be propogated immediately.
+          self._send_kid_summary(flush=True)
+        else:
+          self._updated_summary = True
+        self.check_limits()
+
   @staticmethod
   def from_config(node_config, controller):
     return DataNode(
@@ -186,14 +180,80 @@ class DataNode(Node):
         height=node_config['height'],
         recorded_user_json=node_config['recorded_user_json'])
 
+  def migration_node_config(self):
+    return messages.data.data_node_config(
+        node_id=self.id,
+        parent=self._parent,
+        height=self._height,
+        dataset_program_config=self._dataset_program_config)
+
+  def _snapshot_state(self):
+    if self._recorded_user is not None:
+      raise errors.InternalError("DataNode instances simulating a recorded user can not be migrated.")
+    if self._domain_name is not None:
+      raise errors.InternalError("DataNode instances that have started routing can not be migrated.")
+
+    return {
+        'kids': None if self._kids is None else self._kids.snapshot(),
+        'publisher': self._publisher.snapshot(),
+        'message_rate_windows': self._message_rate_tracker.windows if self._height == 0 else None,
+    }
+
+  def _restore_state(self, state):
+    if state['kids'] is not None:
+      self._kids = DataNodeKids.from_snapshot(state['kids'], controller=self._controller)
+    self._publisher.restore(state['publisher'])
+    if self._height == 0:
+      self._message_rate_tracker.windows = [list(window) for window in state['message_rate_windows']]
+
+  def neighbor_handles(self):
+    result = super(DataNode, self).neighbor_handles()
+    if self._parent is not None:
+      result.append(self._parent)
+    if self._kids is not None:
+      result.extend(self._kids[kid_id] for kid_id in self._kids)
+    result.extend(self._publisher.inputs())
+    result.extend(self._publisher.outputs())
+    return result
+
+  def switch_handle(self, handle):
+    super(DataNode, self).switch_handle(handle)
+    if self._parent is not None and self._parent['id'] == handle['id']:
+      self._parent = handle
+    if self._kids is not None:
+      self._kids.switch_handle(handle)
+    self._publisher.switch_handle(handle)
+
   def elapse(self, ms):
     self.linker.elapse(ms)
     self._monitor_ms += ms
-    if self._monitor.is_watching or (self._kids and self._best_mergeable_kids(list(self._kids))):
+    # Newly mergeable kids are noticed by the check that follows any change to the kids or their summaries,
+    # so the limits need only be checked here once a watch of the `Monitor` is due.
+    if self._monitor.ms_until_deadline(self._monitor_ms) == 0:
       self.check_limits()
 
+    if self._height == 0 and self._splits_by_load:
+      self._ms_since_load_report += ms
+      if self._ms_since_load_report >= self.system_config['KID_SUMMARY_INTERVAL']:
+        self._ms_since_load_report = 0
+        # Parents split their kids by the message rates of the leaves.
+        self._send_kid_summary()
+
     self._publisher.elapse(ms)
 
+  def ms_until_deadline(self):
+    result = self.linker.ms_until_deadline()
+    for ms in (self._monitor.ms_until_deadline(self._monitor_ms), self._publisher.ms_until_deadline()):
+      if ms is not None and (result is None or ms < result):
+        result = ms
+
+    if self._height == 0 and self._splits_by_load:
+      report_ms = max(0, self.system_config['KID_SUMMARY_INTERVAL'] - self._ms_since_load_report)
+      if result is None or report_ms < result:
+        result = report_ms
+
+    return result
+
   def _interval_json(self):
     return self._kids.interval_json()
 
@@ -204,23 +264,38 @@ class DataNode(Node):
     if self._height == 0:
       return self._message_rate_tracker.estimate_rate_hz(self.linker.now_ms)
     else:
-      return sum(kid_summary['messages_per_second'] for kid_summary in self._kids.summaries.values())
+      return self._kids.total_messages_per_second
 
   def _kid_summary_message(self):
+    '''
+    :return: A kid_summary message to send to a parent as part of a transaction.
+    :rtype: :ref:`message`
+    '''
+    # The parent learns of this summary outside of self._kid_summary_reporter.
+    self._kid_summary_reporter.forget()
+    return self._current_kid_summary()
+
+  def _current_kid_summary(self):
     return messages.data.kid_summary(
-        size=(sum(kid_summary['size']
-                  for kid_summary in self._kids.summaries.values()) if self._height > 1 else len(self._kids)),
+        size=(self._kids.total_size if self._height > 1 else len(self._kids)),
         n_kids=len(self._kids),
         height=self._height,
         messages_per_second=self._estimated_messages_per_second(),
         availability=self.availability())
 
-  def _send_kid_summary(self):
-    if self._parent is not None and self._height > 0:
-      message = self._kid_summary_message()
-      if (self._parent['id'], message) != self._last_kid_summary:
-        self._last_kid_summary = (self._parent['id'], message)
-        self.send(self._parent, message)
+  def _send_kid_summary(self, flush=False):
+    '''
+    Report any significant changes in the summary of self to the parent.
+
+    :param bool flush: If true, report all the changes, even the insignificant ones.
+    '''
+    if self._parent is not None and self._kids is not None and (self._height > 0 or self._splits_by_load):
+      self._kid_summary_reporter.report(self._current_kid_summary(), flush=flush)
+
+  @property
+  def _splits_by_load(self):
+    '''Whether this node splits its kids according to the 'load' split policy.'''
+    return self.system_config['DATA_NODE_SPLIT_POLICY'] == 'load'
 
   @property
   def _branching_factor(self):
@@ -239,20 +314,20 @@ class DataNode(Node):
       # FIXME(KK): Remove availability based on how many nodes are sending to self.
       return self._leaf_availability
     else:
-      from_spawned_kids = sum(kid_summary['availability'] for kid_summary in self._kids.summaries.values())
+      from_spawned_kids = self._kids.total_availability
       from_space_to_spawn_new_kids = self._leaf_availability * self._kid_capacity_limit * (
           self._branching_factor - len(self._kids.summaries))
       return from_spawned_kids + from_space_to_spawn_new_kids
 
   def _get_capacity(self):
     # find the best kid
-    highest_capacity_kid_id, highest_capacity_kid, max_kid_capacity, size = None, None, 0, 0
+    highest_capacity_kid, size = None, 0
     if self._height != 1:
-      for kid_id, kid_summary in self._kids.summaries.items():
-        size += kid_summary['size']
-        kid_capacity = self._kid_capacity_limit - kid_summary['size']
-        if kid_capacity > max_kid_capacity:
-          highest_capacity_kid_id, max_kid_capacity = kid_id, kid_capacity
+      size = self._kids.total_size
+      highest_capacity_kid_id = self._kids.smallest_kid_id()
+      if highest_capacity_kid_id is not None and \
+          self._kid_capacity_limit - self._kids.summaries[highest_capacity_kid_id]['size'] <= 0:
+        highest_capacity_kid_id = None
 
       if highest_capacity_kid_id is None:
         self.logger.error("No capacity exists to add a kid to this DataNode")
@@ -275,6 +350,7 @@ class DataNode(Node):
         'n_duplicates': self.linker.n_duplicates,
         'sent_messages': self.linker.least_unused_sequence_number,
         'acknowledged_messages': self.linker.least_unacknowledged_sequence_number(),
+        'retransmission': self.linker.retransmission_stats(),
     }
 
   def _add_leaf_from_http_get(self, request):
@@ -1,7 +1,22 @@
+import heapq
+
 import blist
 from dist_zero import errors, intervals
 
 
+def mergeable_n_kids_limit(system_config):
+  '''
+  :param dict system_config: The system config.  See `std_system_config`
+  :return: Two adjacent kids of a `DataNode` are mergeable only if each has at most this many kids.
+  :rtype: int
+  '''
+  MAX_N_KIDS = system_config['DATA_NODE_KIDS_LIMIT']
+  if MAX_N_KIDS <= 3:
+    return 1
+  else:
+    return MAX_N_KIDS // 3
+
+
 class DataNodeKids(object):
   def __init__(self, left, right, controller):
     self._left = left
@@ -9,12 +24,27 @@ class DataNodeKids(object):
     self._interval = [left, right]
 
     self._controller = controller
+    self._mergeable_n_kids = mergeable_n_kids_limit(controller.system_config)
 
     self._kid_to_interval = None
     self._kid_intervals = None
     self._handles = None
     self._summaries = None
 
+    # Running totals over the values of self._summaries
+    self._total_size = None
+    self._total_availability = None
+    self._total_messages_per_second = None
+    # Heap of pairs (size, kid_id).  Entries that no longer match self._summaries are stale, and are dropped lazily.
+    self._kid_sizes = None
+
+    # Maps the id of each kid that is mergeable with the kid to its immediate right to a pair
+    # (right_kid_id, total_n_kids) where total_n_kids is the number of kids of the two kids together.
+    self._mergeable_pair_by_left_id = None
+    # Sorted list of triples (total_n_kids, left_kid_id, right_kid_id), one for each entry in
+    # self._mergeable_pair_by_left_id.
+    self._mergeable_pairs = None
+
     self.clear()
 
   def clear(self):
@@ -22,6 +52,12 @@ class DataNodeKids(object):
     self._kid_intervals = blist.sortedlist([], key=lambda item: item[0])
     self._handles = {}
     self._summaries = {}
+    self._total_size = 0
+    self._total_availability = 0
+    self._total_messages_per_second = 0
+    self._kid_sizes = []
+    self._mergeable_pair_by_left_id = {}
+    self._mergeable_pairs = blist.sortedlist()
 
   def left_endpoint(self, kid_id):
     start, stop = self._kid_to_interval[kid_id]
@@ -38,16 +74,20 @@ class DataNodeKids(object):
     self._left = key
     self._interval[0] = key
 
-  def shrink_right(self):
+  def shrink_right(self, by_load=False):
     '''
     Shrink the interval by reducing the right endpoint.
     Updates self to manage a smaller interval, possibly removing kids in the process.
 
+    :param bool by_load: If true, keep kids that receive about half of the messages of self.
+      Otherwise, keep half of the kids.
     :return: A pair (new_right_endpoint, removed_kids)  where new_right_endpoint is the new right endpoint of
       self and removed_kids is the ordered list of kids that were store after the right endpoint.
       new_right_endpoint is guaranteed not to fall inside the interval managed by any one kid.
     '''
     n_to_keep = len(self._kid_intervals) // 2
+    if by_load and len(self._kid_intervals) > 1 and self._total_messages_per_second > 0:
+      n_to_keep = self._n_kids_with_half_the_load()
     if n_to_keep == len(self._kid_intervals):
       mid = self._truncate_interval_right()
       return mid, []
@@ -59,13 +99,33 @@ class DataNodeKids(object):
 
       kids = []
       for kid_id in leaving_kid_ids:
-        self._summaries.pop(kid_id, None)
+        self._pop_summary(kid_id)
+        self._forget_mergeable_pair(kid_id)
         kids.append(self._handles.pop(kid_id))
         start, stop = self._kid_to_interval.pop(kid_id)
         self._kid_intervals.remove([start, stop, kid_id])
+      self._update_mergeable_pair(n_to_keep - 1)
 
       return mid, kids
 
+  def _n_kids_with_half_the_load(self):
+    '''
+    :return: The number n of leftmost kids, with 0 < n < len(self), that receive closest to half
+      of the messages received by all the kids.
+    '''
+    best_n, best_imbalance = 1, None
+    left_load = 0
+    for n, kid_id in enumerate(self, start=1):
+      if n == len(self._kid_intervals):
+        break
+      summary = self._summaries.get(kid_id, None)
+      left_load += 0 if summary is None else summary['messages_per_second']
+      imbalance = abs(2 * left_load - self._total_messages_per_second)
+      if best_imbalance is None or imbalance < best_imbalance:
+        best_n, best_imbalance = n, imbalance
+
+    return best_n
+
   def add_kid(self, kid, interval, summary=None):
     start, stop = interval
     kid_id = kid['id']
@@ -73,7 +133,8 @@ class DataNodeKids(object):
     self._kid_intervals.add([start, stop, kid_id])
     self._handles[kid_id] = kid
     if summary:
-      self._summaries[kid_id] = summary
+      self._put_summary(kid_id, summary)
+    self._update_mergeable_pairs_around(self._index(kid_id))
 
   def interval_json(self):
     return intervals.interval_json(self._interval)
@@ -108,14 +169,100 @@ class DataNodeKids(object):
     else:
       return None
 
+  def switch_handle(self, kid):
+    '''Replace the handle of a kid that has moved to another machine.'''
+    if kid['id'] in self._handles:
+      self._handles[kid['id']] = kid
+
+  def snapshot(self):
+    '''
+    :return: A json serializable snapshot of self.  See `DataNodeKids.from_snapshot`
+    :rtype: dict
+    '''
+    return {
+        'interval': self.interval_json(),
+        'kids': [[self._handles[kid_id],
+                  intervals.interval_json(self._kid_to_interval[kid_id]),
+                  self._summaries.get(kid_id, None)] for kid_id in self],
+    }
+
+  @staticmethod
+  def from_snapshot(snapshot, controller):
+    '''Create a `DataNodeKids` instance from the output of `DataNodeKids.snapshot`'''
+    result = DataNodeKids(*intervals.parse_interval(snapshot['interval']), controller=controller)
+    for kid, interval, summary in snapshot['kids']:
+      result.add_kid(kid=kid, interval=intervals.parse_interval(interval), summary=summary)
+    return result
+
   def set_summary(self, kid_id, summary):
     if kid_id in self._handles:
-      self._summaries[kid_id] = summary
+      self._put_summary(kid_id, summary)
+      self._update_mergeable_pairs_around(self._index(kid_id))
 
   @property
   def summaries(self):
     return self._summaries
 
+  @property
+  def total_size(self):
+    '''The sum of the sizes in all the kid summaries.'''
+    return self._total_size
+
+  @property
+  def total_availability(self):
+    '''The sum of the availabilities in all the kid summaries.'''
+    return self._total_availability
+
+  @property
+  def total_messages_per_second(self):
+    '''The sum of the messages_per_second in all the kid summaries.'''
+    return self._total_messages_per_second
+
+  def smallest_kid_id(self):
+    '''
+    :return: The id of a kid whose summary has the least size, or None if there are no kid summaries.
+    :rtype: str
+    '''
+    while self._kid_sizes:
+      size, kid_id = self._kid_sizes[0]
+      if kid_id in self._summaries and self._summaries[kid_id]['size'] == size:
+        return kid_id
+      heapq.heappop(self._kid_sizes)
+
+    return None
+
+  def _put_summary(self, kid_id, summary):
+    # PERF(KK): Maintain the totals incrementally, as they are needed every time a kid summary arrives.
+    old_summary = self._summaries.get(kid_id, None)
+    if old_summary is not None:
+      self._subtract_from_totals(old_summary)
+    self._summaries[kid_id] = summary
+    self._total_size += summary['size']
+    self._total_availability += summary['availability']
+    self._total_messages_per_second += summary['messages_per_second']
+
+    if old_summary is None or old_summary['size'] != summary['size']:
+      heapq.heappush(self._kid_sizes, (summary['size'], kid_id))
+      if len(self._kid_sizes) > 2 * len(self._summaries) + 16:
+        # Too many stale entries have built up
+        self._kid_sizes = [(kid_summary['size'], summary_kid_id)
+                           for summary_kid_id, kid_summary in self._summaries.items()]
+        heapq.heapify(self._kid_sizes)
+
+  def _pop_summary(self, kid_id):
+    summary = self._summaries.pop(kid_id, None)
+    if summary is not None:
+      self._subtract_from_totals(summary)
+
+  def _subtract_from_totals(self, summary):
+    if not self._summaries:
+      # Avoid accumulating floating point error
+      self._total_size, self._total_availability, self._total_messages_per_second = 0, 0, 0
+    else:
+      self._total_size -= summary['size']
+      self._total_availability -= summary['availability']
+      self._total_messages_per_second -= summary['messages_per_second']
+
   def merge_right(self, kid_id):
     '''
     Remove a kid, and add its interval to that of the kid to its immediate right.
@@ -123,7 +270,8 @@ class DataNodeKids(object):
     :param str kid_id: The id of the kid to remove.
     '''
     self._handles.pop(kid_id)
-    self._summaries.pop(kid_id, None)
+    self._pop_summary(kid_id)
+    self._forget_mergeable_pair(kid_id)
     start, mid = self._kid_to_interval.pop(kid_id)
     index = self._kid_intervals.index([start, mid, kid_id])
     self._kid_intervals.pop(index)
@@ -135,6 +283,7 @@ class DataNodeKids(object):
     self._kid_intervals.add([start, stop, right_kid_id])
 
     self._kid_to_interval[right_kid_id] = [start, stop]
+    self._update_mergeable_pairs_around(index)
 
   def split(self, kid_id, mid, new_kid, kid_summary, new_kid_summary):
     '''
@@ -159,14 +308,99 @@ class DataNodeKids(object):
     self._kid_to_interval[new_id] = [mid, stop]
     self._handles[new_id] = new_kid
 
-    self._summaries[kid_id] = kid_summary
-    self._summaries[new_id] = new_kid_summary
+    self._put_summary(kid_id, kid_summary)
+    self._put_summary(new_id, new_kid_summary)
+    self._update_mergeable_pairs_around(index)
+    self._update_mergeable_pair(index + 1)
 
   def remove_kid(self, kid_id):
+    index = self._index(kid_id)
     self._handles.pop(kid_id)
     start, stop = self._kid_to_interval.pop(kid_id)
     self._kid_intervals.remove([start, stop, kid_id])
-    self._summaries.pop(kid_id, None)
+    self._pop_summary(kid_id)
+    self._forget_mergeable_pair(kid_id)
+    self._update_mergeable_pair(index - 1)
+
+  def best_mergeable_pair(self, do_not_use_ids):
+    '''
+    Find the pair of adjacent mergeable kids with the least total number of kids.
+
+    :param do_not_use_ids: A collection of kid ids that should not be part of the pair.
+    :return: None if no 2 adjacent kids outside ``do_not_use_ids`` are mergeable.
+      Otherwise, a pair (left_kid_id, right_kid_id) of adjacent mergeable kids.
+    :rtype: tuple
+    '''
+    # PERF(KK): Only the pairs involving ``do_not_use_ids`` are ever skipped.
+    for total_n_kids, left_id, right_id in self._mergeable_pairs:
+      if left_id not in do_not_use_ids and right_id not in do_not_use_ids:
+        return (left_id, right_id)
+
+    return None
+
+  def disjoint_mergeable_pairs(self, do_not_use_ids):
+    '''
+    Greedily choose pairs of adjacent mergeable kids, in order of increasing total number of kids,
+    such that no kid occurs in more than one pair.
+
+    :param do_not_use_ids: A collection of kid ids that should not be part of any pair.
+    :return: The list of chosen pairs (left_kid_id, right_kid_id).
+    :rtype: list
+    '''
+    used_ids = set(do_not_use_ids)
+    n_usable = len(self._kid_intervals) - sum(1 for kid_id in used_ids if kid_id in self._kid_to_interval)
+    result = []
+    for total_n_kids, left_id, right_id in self._mergeable_pairs:
+      if n_usable < 2:
+        # PERF(KK): No pair is left to choose, so there is no need to look at the rest of the pairs.
+        break
+      elif left_id not in used_ids and right_id not in used_ids:
+        result.append((left_id, right_id))
+        used_ids.add(left_id)
+        used_ids.add(right_id)
+        n_usable -= 2
+
+    return result
+
+  def _index(self, kid_id):
+    start, stop = self._kid_to_interval[kid_id]
+    return self._kid_intervals.index([start, stop, kid_id])
+
+  def _kid_id_at(self, index):
+    if 0 <= index < len(self._kid_intervals):
+      return self._kid_intervals[index][2]
+    else:
+      return None
+
+  def _update_mergeable_pairs_around(self, index):
+    '''Update the pairs of kids at indices (index - 1, index) and (index, index + 1)'''
+    self._update_mergeable_pair(index - 1)
+    self._update_mergeable_pair(index)
+
+  def _update_mergeable_pair(self, index):
+    '''Update the pair of kids at indices (index, index + 1) in self._mergeable_pair_by_left_id'''
+    left_id, right_id = self._kid_id_at(index), self._kid_id_at(index + 1)
+    if left_id is None:
+      return
+
+    left_summary = self._summaries.get(left_id, None)
+    right_summary = self._summaries.get(right_id, None) if right_id is not None else None
+    if left_summary is not None and right_summary is not None and \
+        left_summary['n_kids'] <= self._mergeable_n_kids and right_summary['n_kids'] <= self._mergeable_n_kids:
+      pair = (right_id, left_summary['n_kids'] + right_summary['n_kids'])
+      if self._mergeable_pair_by_left_id.get(left_id, None) != pair:
+        self._forget_mergeable_pair(left_id)
+        self._mergeable_pair_by_left_id[left_id] = pair
+        self._mergeable_pairs.add((pair[1], left_id, right_id))
+    else:
+      self._forget_mergeable_pair(left_id)
+
+  def _forget_mergeable_pair(self, left_id):
+    '''Remove the pair of kids whose left kid is identified by ``left_id``, if it is mergeable.'''
+    pair = self._mergeable_pair_by_left_id.pop(left_id, None)
+    if pair is not None:
+      right_id, total_n_kids = pair
+      self._mergeable_pairs.remove((total_n_kids, left_id, right_id))
 
   @property
   def left(self):
@@ -3,6 +3,12 @@ from .transactions import split_kid, merge_kids, consume_proxy, spawn_kid, bump_
 
 
 class Monitor(object):
+  TIME_TO_WAIT_BEFORE_KID_MERGE_MS = 2 * 1000
+  '''How long a pair of kids must stay mergeable before they are merged.'''
+
+  TIME_TO_WAIT_BEFORE_CONSUME_PROXY_MS = 4 * 1000
+  '''How long a root node must have a proxy before it consumes it.'''
+
   def __init__(self, node: 'DataNode'):
     self._node = node
 
@@ -16,21 +22,20 @@ class Monitor(object):
     self._mergeable_node_ids = set() # All the ids used as keys in self._mergeable_pair_to_time_since_mergeable
 
   def check_limits(self, ms):
-    self._will_check_limits = True
     self._node.start_transaction_eventually(CheckLimitsTransaction(self, ms))
 
   def _check_limits_inside_transaction(self, ms):
     if self._node._updated_summary or self._node._height == 1:
-      self._node._send_kid_summary()
+      # Insignificant changes are held back, unless the parent needs to know right away that capacity is low.
+      self._node._send_kid_summary(flush=self.out_of_capacity())
       self._node._updated_summary = False
     self._check_for_low_capacity()
+    self._check_for_overloaded_kids()
     self._check_for_mergeable_kids(ms)
     self._check_for_consumable_proxy(ms)
-    self._will_check_limits = False
 
   def out_of_capacity(self):
-    total_kid_capacity = sum(
-        self._node._kid_capacity_limit - kid_summary['size'] for kid_summary in self._node._kids.summaries.values())
+    total_kid_capacity = self._node._kid_capacity_limit * len(self._node._kids.summaries) - self._node._kids.total_size
 
     if total_kid_capacity <= self._node.system_config['TOTAL_KID_CAPACITY_TRIGGER']:
       return True
@@ -42,7 +47,7 @@ class Monitor(object):
     if self._node._height <= 1:
       return # Nodes of height <= 1 never address low capacity themselves
 
-    if set(self._node._kids.summaries.keys()) < set(self._node._kids):
+    if len(self._node._kids.summaries) < len(self._node._kids):
       return # Wait till we have summaries for all our kids
 
     if self.out_of_capacity():
@@ -52,7 +57,7 @@ class Monitor(object):
         if self._node._parent is None:
           self._node.start_transaction_eventually(bump_height.BumpHeight())
         else:
-          self._node._send_kid_summary()
+          self._node._send_kid_summary(flush=True)
           if not self._warned_low_capacity:
             self._warned_low_capacity = True
             self._node.logger.warning(
@@ -79,21 +84,69 @@ class Monitor(object):
 
     self._node.start_transaction_eventually(split_kid.SplitKid(kid_id=best_kid_id))
 
-  def _check_for_consumable_proxy(self, ms):
-    TIME_TO_WAIT_BEFORE_CONSUME_PROXY_MS = 4 * 1000
+  def kid_is_overloaded(self, kid_id):
+    '''
+    Under the 'load' split policy, whether a kid receives so many messages that it should be split.
+
+    :param str kid_id: The id of a kid of the node.
+    :rtype: bool
+    '''
+    summary = self._node._kids.summaries.get(kid_id, None)
+    # Kids with a single kid of their own can not be split.
+    return summary is not None and summary['n_kids'] > 1 and \
+        summary['messages_per_second'] > self._node.system_config['DATA_NODE_KID_LOAD_LIMIT']
+
+  def _check_for_overloaded_kids(self):
+    '''Under the 'load' split policy, check whether any kid receives too many messages.'''
+    if not self._node._splits_by_load or self._node._height <= 1:
+      return # Kids of nodes of height <= 1 are leaves, and can not be split.
 
+    if len(self._node._kids) >= self._node.system_config['DATA_NODE_KIDS_LIMIT']:
+      return # No room for another kid.
+
+    hottest_kid_id, hottest_rate = None, 0
+    for kid_id, summary in self._node._kids.summaries.items():
+      if summary['messages_per_second'] > hottest_rate and self.kid_is_overloaded(kid_id):
+        hottest_kid_id, hottest_rate = kid_id, summary['messages_per_second']
+
+    if hottest_kid_id is not None:
+      self._node.start_transaction_eventually(split_kid.SplitKid(kid_id=hottest_kid_id, overloaded=True))
+
+  def _check_for_consumable_proxy(self, ms):
     if self._node._parent is None:
       if self._node._get_proxy():
         self._time_since_no_consumable_proxy += ms
-        if self._time_since_no_consumable_proxy >= TIME_TO_WAIT_BEFORE_CONSUME_PROXY_MS:
+        if self._time_since_no_consumable_proxy >= Monitor.TIME_TO_WAIT_BEFORE_CONSUME_PROXY_MS:
           self._node.start_transaction_eventually(consume_proxy.ConsumeProxy())
       else:
         self._time_since_no_consumable_proxy = 0
 
+  @property
+  def watched_kid_ids(self):
+    '''The set of ids of the kids in pairs that are being watched for a merge.'''
+    return self._mergeable_node_ids
+
   @property
   def is_watching(self):
     return bool(self._mergeable_pair_to_time_since_mergeable) or self._time_since_no_consumable_proxy > 0
 
+  def ms_until_deadline(self, ms):
+    '''
+    :param int ms: The number of milliseconds elapsed on the node since it last checked its limits.
+    :return: The number of milliseconds until a check of the node's limits would merge a watched pair of kids
+      or consume a proxy, or `None` if the monitor is watching for neither.
+    :rtype: int
+    '''
+    result = None
+    if self._mergeable_pair_to_time_since_mergeable:
+      result = Monitor.TIME_TO_WAIT_BEFORE_KID_MERGE_MS - max(self._mergeable_pair_to_time_since_mergeable.values())
+    if self._time_since_no_consumable_proxy > 0:
+      proxy_ms = Monitor.TIME_TO_WAIT_BEFORE_CONSUME_PROXY_MS - self._time_since_no_consumable_proxy
+      if result is None or proxy_ms < result:
+        result = proxy_ms
+
+    return None if result is None else max(0, result - ms)
+
   def _watch_pair_for_merge(self, pair):
     self._mergeable_pair_to_time_since_mergeable[pair] = 0
     self._mergeable_node_ids.add(pair[0])
@@ -106,8 +159,6 @@ class Monitor(object):
 
   def _check_for_mergeable_kids(self, ms):
     '''Check whether any two kids should be merged.'''
-    TIME_TO_WAIT_BEFORE_KID_MERGE_MS = 2 * 1000
-
     if self._node._height > 1:
       for pair in list(self._mergeable_pair_to_time_since_mergeable.keys()):
         # Add some time to how long it has waited
@@ -115,16 +166,14 @@ class Monitor(object):
 
         if not self._node._kids_are_mergeable(*pair):
           self._unwatch_pair_for_merge(pair) # No longer mergeable.  Forget about them
-        elif self._mergeable_pair_to_time_since_mergeable[pair] >= TIME_TO_WAIT_BEFORE_KID_MERGE_MS:
+        elif self._mergeable_pair_to_time_since_mergeable[pair] >= Monitor.TIME_TO_WAIT_BEFORE_KID_MERGE_MS:
           # Mergeable!  Request a transaction to attempt to merge them eventually, it should succeed if they're still
           # mergeable when the transaction starts.
           self._unwatch_pair_for_merge(pair)
           self._node.start_transaction_eventually(merge_kids.MergeKids(*pair))
 
-      best_pair = self._node._best_mergeable_kids(self._mergeable_node_ids)
-      while best_pair is not None:
-        self._watch_pair_for_merge(best_pair)
-        best_pair = self._node._best_mergeable_kids(self._mergeable_node_ids)
+      for pair in self._node._kids.disjoint_mergeable_pairs(self._mergeable_node_ids):
+        self._watch_pair_for_merge(pair)
 
 
 class CheckLimitsTransaction(transaction.OriginatorRole):
@@ -136,6 +185,18 @@ class CheckLimitsTransaction(transaction.OriginatorRole):
   def log_starts_and_stops(self):
     return False
 
+  @property
+  def resources(self):
+    # Only reads the state of the node, and enqueues any other transactions it needs.
+    return frozenset()
+
+  @property
+  def coalesce_key(self):
+    return 'check_limits'
+
+  def coalesce(self, other):
+    self._ms += other._ms
+
   async def run(self, controller: 'TransactionRoleController'):
     controller.logger.debug("Running CheckLimitsTransaction")
     self._monitor._check_limits_inside_transaction(self._ms)
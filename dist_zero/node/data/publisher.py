@@ -79,6 +79,50 @@ class Publisher(object):
     if self._is_leaf and self._net is not None:
       self._net.Elapse(ms)
 
+  def ms_until_deadline(self):
+    '''
+    :return: The number of milliseconds until the reactive Net has its next scheduled event,
+      or `None` if it has none.
+    :rtype: int
+    '''
+    if self._is_leaf and self._net is not None:
+      next_time = self._net.NextTime()
+      if next_time is not None:
+        return max(0, next_time - self._net.CurTime())
+
+    return None
+
+  def snapshot(self):
+    '''
+    :return: A json serializable snapshot of the subscriptions and the reactive Net.  See `Publisher.restore`
+    :rtype: dict
+    '''
+    return {
+        'inputs': self._inputs,
+        'outputs': self._outputs,
+        'net_time': self._net.CurTime() if self._net is not None else None,
+    }
+
+  def restore(self, snapshot):
+    '''
+    Restore the output of `Publisher.snapshot`.
+
+    The state of the reactive Net lives in compiled code that can not be serialized.
+    Leaves only ever elapse time on their Net, so it is restored by elapsing the newly compiled Net
+    to the time of the snapshot.
+    '''
+    self._inputs = dict(snapshot['inputs'])
+    self._outputs = dict(snapshot['outputs'])
+    if self._net is not None and snapshot['net_time']:
+      self._net.Elapse(snapshot['net_time'])
+
+  def switch_handle(self, handle):
+    '''Replace the handle of a subscribed node that has moved to another machine.'''
+    for links in (self._inputs, self._outputs):
+      for link_key, node in links.items():
+        if node is not None and node['id'] == handle['id']:
+          links[link_key] = handle
+
   def get_linked_handle(self, link_key, key_type):
     if key_type == 'input':
       return self._inputs.get(link_key, None)
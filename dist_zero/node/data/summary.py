@@ -0,0 +1,57 @@
+from dist_zero import messages
+
+
+class KidSummaryReporter(object):
+  '''
+  Reports the kid summary of a `DataNode` to its parent.
+
+  The first report to a parent carries the whole summary.  Later reports carry only the fields that have changed
+  significantly since the parent last heard about them, where the significance threshold of each field is
+  configured by ``KID_SUMMARY_THRESHOLDS``.  Insignificant changes are held back until they add up to a significant
+  one, or until a report is flushed.
+  '''
+
+  def __init__(self, node: 'DataNode'):
+    self._node = node
+    self._thresholds = node.system_config['KID_SUMMARY_THRESHOLDS']
+
+    self._parent_id = None # The id of the parent that self last reported to.
+    self._reported = None # None, or the summary as it is known by the parent identified by self._parent_id
+
+  def forget(self):
+    '''
+    Indicate that the parent may have learned of the summary by some other means,
+    so that the next report carries the whole summary.
+    '''
+    self._reported = None
+
+  def report(self, summary, flush=False):
+    '''
+    Report a summary to the parent if it differs significantly from what the parent already knows.
+
+    :param summary: The current kid_summary :ref:`message` of the node.
+    :type summary: :ref:`message`
+    :param bool flush: If true, report every change, even the insignificant ones.
+      Use it when the parent must act on the summary right away, e.g. when the node is out of capacity.
+    '''
+    parent = self._node._parent
+    if self._reported is None or self._parent_id != parent['id']:
+      self._parent_id = parent['id']
+      self._reported = summary
+      self._node.send(parent, summary)
+    else:
+      changes = {
+          field: value
+          for field, value in summary.items()
+          if value != self._reported[field] and (flush or self._is_significant(field, self._reported[field], value))
+      }
+      if changes:
+        self._reported = dict(self._reported, **changes)
+        self._node.send(parent, messages.data.kid_summary_delta(changes))
+
+  def _is_significant(self, field, old, new):
+    threshold = self._thresholds.get(field, 0)
+    if threshold == 0 or old == 0:
+      return True
+    else:
+      return abs(new - old) > threshold * abs(old)
@@ -37,6 +37,10 @@ class AddLeafParent(transaction.ParticipantRole):
     self._kid = kid
     self._kid_summary = kid_summary
 
+  @property
+  def resources(self):
+    return frozenset([transaction.kid_resource(self._kid['id'])])
+
   async def run(self, controller: 'TransactionRoleController'):
     controller.logger.info(
         'Adding {kid_id} to {parent_id}', extra={
@@ -53,6 +57,6 @@ class AddLeafParent(transaction.ParticipantRole):
 
     if controller.node._monitor.out_of_capacity():
       controller.logger.info("Node is out of capacity.  Sending kid summary.")
-      controller.node._send_kid_summary()
+      controller.node._send_kid_summary(flush=True)
 
     controller.node.check_limits()
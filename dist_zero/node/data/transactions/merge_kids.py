@@ -12,6 +12,14 @@ class MergeKids(transaction.OriginatorRole):
     self._absorbee_id = left_kid_id
     self._absorber_id = right_kid_id
 
+  @property
+  def resources(self):
+    return frozenset([transaction.kid_resource(self._absorbee_id), transaction.kid_resource(self._absorber_id)])
+
+  @property
+  def coalesce_key(self):
+    return (self._absorbee_id, self._absorber_id)
+
   async def run(self, controller: 'TransactionRoleController'):
     # By the time this transaction starts to run, the kids may no longer be mergeable
     if not controller.node._kids_are_mergeable(self._absorbee_id, self._absorber_id):
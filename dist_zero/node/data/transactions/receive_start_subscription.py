@@ -11,6 +11,10 @@ class ReceiveStartSubscription(transaction.ParticipantRole):
     self._controller = None
     self._link_key = link_key
 
+  @property
+  def resources(self):
+    return frozenset([transaction.KIDS, transaction.INTERVAL, transaction.SUBSCRIPTIONS])
+
   @property
   def _node(self):
     return self._controller.node
@@ -7,6 +7,19 @@ class RemoveLeaf(transaction.OriginatorRole):
   def __init__(self, kid_id):
     self._kid_id = kid_id
 
+  @property
+  def resources(self):
+    return frozenset([transaction.kid_resource(self._kid_id)])
+
+  @property
+  def coalesce_key(self):
+    return self._kid_id
+
+  @property
+  def migration_args(self):
+    # The kid has already said goodbye, and will not ask again.
+    return {'kid_id': self._kid_id}
+
   async def run(self, controller: 'TransactionRoleController'):
     controller.node._updated_summary = True
     if self._kid_id in controller.node._kids:
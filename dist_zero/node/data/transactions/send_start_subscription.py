@@ -114,6 +114,10 @@ class SendStartSubscription(transaction.ParticipantRole):
 
     self._controller.logger.debug("Got hellos from kids")
 
+  @property
+  def resources(self):
+    return frozenset([transaction.KIDS, transaction.INTERVAL, transaction.SUBSCRIPTIONS])
+
   @property
   def _node(self):
     return self._controller.node
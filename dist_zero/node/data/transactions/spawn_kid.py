@@ -10,6 +10,10 @@ class SpawnKid(transaction.OriginatorRole):
     self._send_summary = send_summary
     self._force = force
 
+  @property
+  def resources(self):
+    return frozenset([transaction.KIDS, transaction.INTERVAL])
+
   async def run(self, controller: 'TransactionRoleController'):
     if controller.node._height == 0:
       raise errors.InternalError("height 0 DataNode instances can not spawn kids")
@@ -6,11 +6,26 @@ from . import helpers
 class SplitKid(transaction.OriginatorRole):
   '''Split a specific kid of this node.'''
 
-  def __init__(self, kid_id):
+  def __init__(self, kid_id, overloaded=False):
+    '''
+    :param str kid_id: The id of the kid to split.
+    :param bool overloaded: True iff the kid should be split because it receives too many messages, as opposed to
+      because the node is out of capacity.
+    '''
     self._kid_id = kid_id
+    self._overloaded = overloaded
 
     self._kid = None
 
+  @property
+  def resources(self):
+    return frozenset([transaction.SPLITS, transaction.kid_resource(self._kid_id)])
+
+  @property
+  def coalesce_key(self):
+    # Splitting an overloaded kid once is enough until its load can be measured again.
+    return self._kid_id if self._overloaded else None
+
   async def run(self, controller: 'TransactionRoleController'):
     if controller.node._height == 0:
       raise errors.InternalError("height 0 DataNode instances can not split their kids")
@@ -21,6 +36,18 @@ class SplitKid(transaction.OriginatorRole):
           "Canceling SplitKid transaction because the kid was not present when the transaction started.")
       return
 
+    if len(controller.node._kids) >= controller.node.system_config['DATA_NODE_KIDS_LIMIT']:
+      controller.logger.info("Canceling SplitKid transaction because the node has no room for another kid.")
+      return
+    elif self._overloaded:
+      if not controller.node._monitor.kid_is_overloaded(self._kid_id):
+        controller.logger.info("Canceling SplitKid transaction because the kid is no longer overloaded.")
+        return
+    elif not controller.node._monitor.out_of_capacity():
+      # Another SplitKid may have added the missing capacity while this one was waiting to start.
+      controller.logger.info("Canceling SplitKid transaction because the node is no longer out of capacity.")
+      return
+
     old_kid_stop = controller.node._kids.right_endpoint(self._kid_id)
 
     new_id = ids.new_id('DataNode')
@@ -76,7 +103,7 @@ class SplitNode(transaction.ParticipantRole):
   async def run(self, controller: 'TransactionRoleController'):
     if controller.node._height == 0 and controller.node._dataset_program_config['interval_type'] != 'interval':
       raise errors.InternalError(f"Unable to split a height 0 Node with interval_type \"{interval_type}\" != interval")
-    mid, leaving_kids = controller.node._kids.shrink_right()
+    mid, leaving_kids = controller.node._kids.shrink_right(by_load=controller.node._splits_by_load)
     controller.logger.info(
         "Splitting at midpoint {midpoint} [{kids_before_midpoint}]-midpoint-[{kids_after_midpoint}]",
         extra={
@@ -1,6 +1,6 @@
 import logging
 
-from dist_zero import errors
+from dist_zero import errors, intervals, messages
 
 from ..node import Node
 from . import link_leaf
@@ -18,6 +18,7 @@ class LinkNode(Node):
     self._link_key = link_key
 
     self._kids = {}
+    self._parent = None
 
     # These will be set by the role that starts this LinkNode
     self._source_interval = None
@@ -25,6 +26,9 @@ class LinkNode(Node):
     self._senders = None
     self._receivers = None
     self._manager = None # The LinkGraphManager instance to manage this node's kids.
+    # When this node was restored from a migration snapshot, its manager is not restored.
+    # Instead, the ids of the leftmost kids are stored here.
+    self._leftmost_kid_ids = None
 
     # FIXME(KK): This is all specific to summing.  Please remove it once leaves implement general reactive graphs.
     self._current_state = 0
@@ -42,9 +46,69 @@ class LinkNode(Node):
         right_is_data=node_config['right_is_data'],
         controller=controller)
 
+  def migration_node_config(self):
+    return messages.link.link_node_config(
+        node_id=self.id,
+        left_is_data=self._left_is_data,
+        right_is_data=self._right_is_data,
+        link_key=self._link_key,
+        height=self._height)
+
+  def _snapshot_state(self):
+    return {
+        'parent': self._parent,
+        'kids': self._kids,
+        'senders': self._senders,
+        'receivers': self._receivers,
+        'source_interval': None if self._source_interval is None else intervals.interval_json(self._source_interval),
+        'target_interval': None if self._target_interval is None else intervals.interval_json(self._target_interval),
+        'leftmost_kid_ids': list(self._leftmost_kids()),
+        'current_state': self._current_state,
+    }
+
+  def _restore_state(self, state):
+    self._parent = state['parent']
+    self._kids = state['kids']
+    self._senders = state['senders']
+    self._receivers = state['receivers']
+    if state['source_interval'] is not None:
+      self._source_interval = intervals.parse_interval(state['source_interval'])
+    if state['target_interval'] is not None:
+      self._target_interval = intervals.parse_interval(state['target_interval'])
+    self._leftmost_kid_ids = state['leftmost_kid_ids']
+    self._current_state = state['current_state']
+
+  def neighbor_handles(self):
+    result = super(LinkNode, self).neighbor_handles()
+    if self._parent is not None:
+      result.append(self._parent)
+    for handles in (self._kids, self._senders, self._receivers):
+      if handles:
+        result.extend(handles.values())
+    return result
+
+  def switch_handle(self, handle):
+    super(LinkNode, self).switch_handle(handle)
+    if self._parent is not None and self._parent['id'] == handle['id']:
+      self._parent = handle
+    for handles in (self._kids, self._senders, self._receivers):
+      if handles and handle['id'] in handles:
+        handles[handle['id']] = handle
+
+  def _leftmost_kids(self):
+    if self._manager is not None:
+      return self._manager.source_objects()
+    elif self._leftmost_kid_ids is not None:
+      return self._leftmost_kid_ids
+    else:
+      return []
+
   def elapse(self, ms):
     pass
 
+  def ms_until_deadline(self):
+    return None
+
   # FIXME(KK): Much of the below was copied from an old LinkNode implementation and is specific to link networks
   # that always sum their inputs.  Consider removing/rewriting much of it
 
@@ -53,7 +117,7 @@ class LinkNode(Node):
     if message['type'] == 'get_kids':
       return {key: self._kids[key] for key in self._kids}
     elif message['type'] == 'get_leftmost_kids':
-      return {key: self._kids[key] for key in self._manager.source_objects()}
+      return {key: self._kids[key] for key in self._leftmost_kids()}
     elif message['type'] == 'get_senders':
       return dict(self._senders)
     elif message['type'] == 'get_receivers':
@@ -69,6 +133,7 @@ class LinkNode(Node):
         'n_duplicates': self.linker.n_duplicates,
         'sent_messages': self.linker.least_unused_sequence_number,
         'acknowledged_messages': self.linker.least_unacknowledged_sequence_number(),
+        'retransmission': self.linker.retransmission_stats(),
     }
 
   def receive(self, message, sender_id):
@@ -81,7 +146,9 @@ class LinkNode(Node):
 
   def _maybe_send_forward_messages(self, ms):
     '''Called periodically to give leaf nodes an opportunity to send their messages.'''
+    # While backpressured, keep collecting deltas.  They will be sent together once the receivers catch up.
     if not self.deltas_only and \
+        not self.linker.is_backpressured() and \
         self._deltas.has_data():
 
       self.send_forward_messages()
@@ -89,10 +156,6 @@ class LinkNode(Node):
     self.linker.elapse(ms)
 
   def send_forward_messages(self, before=None):
-    delta_messages = self._deltas.pop_deltas(before=before)
-
-    if not delta_messages:
-      return self.least_unused_sequence_number
-    else:
-      self._current_state = self._leaf.process_increment(self._current_state, delta_messages)
-      return self.least_unused_sequence_number
+    if self._deltas.has_data(before=before):
+      self._current_state = self._leaf.process_increment(self._current_state, self._deltas.iter_deltas(before=before))
+    return self.least_unused_sequence_number
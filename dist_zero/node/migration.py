@@ -0,0 +1,60 @@
+'''
+Live migration of running nodes between machines.
+
+A node is migrated by a `MigrateNode` transaction that runs on the node itself.  Because it runs as a transaction,
+no other transaction is ever half finished on the node when it is migrated.  It has priority over every other
+queued role, so once it is requested no new role starts on the node, and it runs as soon as the running roles finish.
+The transaction
+
+  - captures a snapshot of the node with `Node.snapshot`.  The snapshot includes the node's session key, its
+    `Linker` state (sequence numbers, importer reorder buffers and exporter pending windows) and the roles still
+    waiting to start, along with any state specific to the type of the node.  Queued participant roles are restarted
+    on the new machine in their original transactions.  Queued originator roles are dropped, unless they define
+    `TransactionRole.migration_args`, as the node requests them again whenever they are still needed.
+  - asks the `MachineController` to start the node from the snapshot on the other machine, and to stop running it
+    on the current machine.  The node keeps its id and its session key, so the old machine can
+    forward any messages that still arrive for it.
+
+Once the restored node starts, it sends a 'node_moved' message with a new handle to every node that holds a handle
+for it (its parent, kids, senders and receivers).  Each of them switches to the new handle everywhere it
+stores one.  Messages in flight during the move are forwarded by the old machine over its `MachineChannel` to the
+new one.
+'''
+
+from dist_zero import transaction
+
+
+class MigrateNode(transaction.OriginatorRole):
+  '''Move the node running this role to another machine.'''
+
+  def __init__(self, machine_id):
+    '''
+    :param str machine_id: The id of the `MachineController` that should run the node.
+    '''
+    self._machine_id = machine_id
+
+  @property
+  def has_priority(self):
+    # Keep new roles from starting, so that the migration does not wait on a node that is always busy.
+    return True
+
+  async def run(self, controller: 'TransactionRoleController'):
+    node = controller.node
+    controller.logger.info("Migrating to machine {machine_id}", extra={'machine_id': self._machine_id})
+    node_config = add_snapshot_to_node_config(node.migration_node_config(), node.snapshot())
+    node._controller.migrate_node(node, machine_id=self._machine_id, node_config=node_config)
+    node._drop_queued_transaction_roles()
+
+
+def add_snapshot_to_node_config(node_config, snapshot):
+  '''
+  :param node_config: A config for starting a node.
+  :type node_config: :ref:`message`
+  :param snapshot: The output of `Node.snapshot` for a node with the same id.
+  :type snapshot: :ref:`message`
+  :return: A config that starts the node with the state from ``snapshot``.
+  :rtype: :ref:`message`
+  '''
+  new_config = {'migration_snapshot': snapshot}
+  new_config.update(node_config)
+  return new_config
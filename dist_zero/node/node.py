@@ -3,10 +3,10 @@ import logging
 
 from collections import defaultdict
 
-from cryptography.fernet import Fernet
-
 import dist_zero.logging
-from dist_zero import messages, linker, deltas, errors, ids, transaction
+from dist_zero import messages, linker, deltas, errors, ids, transaction, session_crypto
+
+from .migration import MigrateNode
 
 logger = logging.getLogger(__name__)
 
@@ -18,19 +18,26 @@ class Node(object):
     self.logger = dist_zero.logging.LoggerAdapter(logger, extra={'cur_node_id': self.id})
 
     # For encryption/decryption
-    self._fernet_key = Fernet.generate_key().decode(messages.ENCODING)
-    self.fernet = Fernet(self._fernet_key)
+    self._session_key = session_crypto.new_session_key()
+    self.cipher = session_crypto.session_cipher(self._session_key)
 
     self.least_unused_sequence_number = 0
 
-    # Queue of transaction roles to run.  Iff nonempty, a coroutine is running self._transaction_role_queue[0]
+    # Queue of (role, controller) pairs for the transaction roles that have not yet started to run.
     self._transaction_role_queue = []
+    # Maps the transaction_id of each running transaction role to its (role, controller) pair.
+    # No two running roles conflict with each other.
+    self._running_transaction_roles = {}
+    # Maps (role class, coalesce_key) to the queued role into which later roles with the same key are coalesced.
+    self._coalescible_queued_roles = {}
+    # Maps the transaction_id of each queued participant role to the [typename, args] config it was parsed from.
+    self._queued_participant_configs = {}
     # Maps transaction_id to ordered list of messages that have
     #  - been received while that transaction was not active
     #  - not yet been delivered
     self._postponed_transaction_messages = defaultdict(list)
 
-    self.linker = linker.Linker(self, logger=self.logger, deliver=self.deliver)
+    self.linker = linker.Linker(self, logger=self.logger, deliver=self.deliver, reliable=self._delivers_reliably)
     self.system_config = self._controller.system_config
     '''
     System configuration parameters.
@@ -43,9 +50,9 @@ class Node(object):
     map instead.
     '''
 
-  def set_fernet(self, node):
-    self._fernet_key = node._fernet_key
-    self.fernet = node.fernet
+  def set_session_key(self, node):
+    self._session_key = node._session_key
+    self.cipher = node.cipher
 
   def send(self, receiver, message):
     '''
@@ -81,7 +88,7 @@ class Node(object):
     '''
     return {
         'id': handle['id'],
-        'fernet_key': handle['fernet_key'],
+        'session_key': handle['session_key'],
         'controller_id': handle['controller_id'],
         'transport': self._controller.transfer_transport(transport=handle['transport'], for_node_id=for_node_id),
     }
@@ -91,9 +98,12 @@ class Node(object):
         'id': self.id,
         'controller_id': self._controller.id,
         'transport': transport,
-        'fernet_key': self._fernet_key,
+        'session_key': self._session_key,
     }
 
+  def _delivers_reliably(self, handle):
+    return self._controller.delivers_reliably(handle)
+
   def elapse(self, ms):
     '''
     Elapse ms of time on this node.
@@ -102,12 +112,37 @@ class Node(object):
     '''
     raise RuntimeError('Abstract Superclass')
 
+  def ms_until_deadline(self):
+    '''
+    The `MachineController` will only elapse time on this node once it reaches its next deadline.
+    Nodes are always elapsed shortly after they send or receive a message, so the deadline only needs to account
+    for work that `Node.elapse` would do without any new messages.
+
+    :return: The number of milliseconds until `Node.elapse` next has work to do, or `None` if it has none.
+    :rtype: int
+    '''
+    return self.linker.ms_until_deadline()
+
   def deliver(self, message, sequence_number, sender_id):
     '''
     Abstract method for delivering new messages to this node.
     '''
     raise RuntimeError('Abstract Superclass')
 
+  def receive_batch(self, messages):
+    '''
+    Receive a batch of messages that arrived together.
+
+    Subclasses that can process many messages at once more cheaply than one at a time should override this method.
+    No node does yet.  In particular, `DataNode` leaves do not turn received messages into transitions of their
+    reactive Net, so applying each batch in a single turn of the Net is left until they do.
+
+    :param list messages: A list of pairs (message, sender_id) in the order they were received.
+      Each pair is in the format of the arguments to `Node.receive`.
+    '''
+    for message, sender_id in messages:
+      self.receive(message=message, sender_id=sender_id)
+
   def receive(self, message, sender_id):
     '''
     Receive a message from a sender.
@@ -120,22 +155,130 @@ class Node(object):
       self.linker.receive_sequence_message(message['value'], sender_id)
     elif message['type'] == 'start_participant_role':
       self.start_participant_role(message)
+    elif message['type'] == 'node_moved':
+      self.switch_handle(message['node'])
     elif message['type'] == 'transaction_message':
-      if len(self._transaction_role_queue) > 0:
-        active_role, active_role_controller = self._transaction_role_queue[0]
-
-        if active_role_controller.transaction_id == message['transaction_id']:
-          active_role_controller.deliver(message['message'], sender_id)
-        else:
-          self._postponed_transaction_messages[message['transaction_id']].append((message['message'], sender_id))
+      if message['transaction_id'] in self._running_transaction_roles:
+        active_role, active_role_controller = self._running_transaction_roles[message['transaction_id']]
+        active_role_controller.deliver(message['message'], sender_id)
+      else:
+        self._postponed_transaction_messages[message['transaction_id']].append((message['message'], sender_id))
     else:
       raise errors.InternalError("Unrecognized message type {}".format(message['type']))
 
+  def switch_handle(self, handle):
+    '''
+    Replace every handle self holds for a node that has moved to another machine.
+    Subclasses that store handles outside of their `Linker` should override this method.
+
+    :param handle: The new :ref:`handle` for the moved node.
+    :type handle: :ref:`handle`
+    '''
+    self.linker.switch_handle(handle)
+
+  def neighbor_handles(self):
+    '''
+    Subclasses that store handles outside of their `Linker` should override this method.
+
+    :return: The handles of all the nodes that may hold a handle for self.
+    :rtype: list
+    '''
+    return self.linker.handles()
+
+  def migration_node_config(self):
+    '''
+    :return: A config for starting a node with the same id and type as self on another machine.
+      Subclasses that can migrate must implement this method.
+    :rtype: :ref:`message`
+    '''
+    raise errors.InternalError(f"{self.__class__.__name__} instances can not be migrated.")
+
+  def _snapshot_state(self):
+    '''
+    :return: A json serializable snapshot of the state specific to the subclass.
+    '''
+    raise errors.InternalError(f"{self.__class__.__name__} instances can not be migrated.")
+
+  def _restore_state(self, state):
+    '''Restore the output of `Node._snapshot_state`'''
+    raise errors.InternalError(f"{self.__class__.__name__} instances can not be migrated.")
+
+  def snapshot(self):
+    '''
+    Capture the state of self, for restarting it on another machine.  See `dist_zero.node.migration`
+
+    :return: A snapshot of self.
+    :rtype: :ref:`message`
+    '''
+    return messages.migration.node_snapshot(
+        session_key=self._session_key,
+        least_unused_sequence_number=self.least_unused_sequence_number,
+        linker=self.linker.snapshot(),
+        postponed_transaction_messages=[[transaction_id, message, sender_id]
+                                        for transaction_id, msgs in self._postponed_transaction_messages.items()
+                                        for message, sender_id in msgs],
+        queued_transaction_roles=self._snapshot_queued_transaction_roles(),
+        state=self._snapshot_state())
+
+  def _snapshot_queued_transaction_roles(self):
+    '''
+    :return: A list of triples (transaction_id, typename, args) describing the queued roles that must be restarted
+      on another machine.  The transaction_id is None for originator roles, which will start new transactions.
+    :rtype: list
+    '''
+    result = []
+    for role, controller in self._transaction_role_queue:
+      if controller.transaction_id in self._queued_participant_configs:
+        typename, args = self._queued_participant_configs[controller.transaction_id]
+        result.append([controller.transaction_id, typename, args])
+      elif role.migration_args is not None:
+        result.append([None, role.__class__.__name__, role.migration_args])
+    return result
+
+  def _drop_queued_transaction_roles(self):
+    '''
+    Forget every role that is waiting to start.
+    Called once the node has migrated, as the snapshot carries the queued roles to the new machine.
+    '''
+    self._transaction_role_queue = []
+    self._coalescible_queued_roles = {}
+    self._queued_participant_configs = {}
+
+  def restore(self, snapshot):
+    '''
+    Restore the state captured by `Node.snapshot` on another machine,
+    and inform all neighboring nodes that self has moved.
+
+    :param snapshot: The output of `Node.snapshot` on a node with the same id.
+    :type snapshot: :ref:`message`
+    '''
+    self._session_key = snapshot['session_key']
+    self.cipher = session_crypto.session_cipher(self._session_key)
+    self.least_unused_sequence_number = snapshot['least_unused_sequence_number']
+    self.linker.restore(snapshot['linker'])
+    for transaction_id, message, sender_id in snapshot['postponed_transaction_messages']:
+      self._postponed_transaction_messages[transaction_id].append((message, sender_id))
+    self._restore_state(snapshot['state'])
+    for transaction_id, typename, args in snapshot['queued_transaction_roles']:
+      if transaction_id is None:
+        self.start_transaction_eventually(transaction.TransactionRole.from_config(typename=typename, args=args))
+      else:
+        self._start_participant_from_config(transaction_id=transaction_id, typename=typename, args=args)
+
+    neighbor_ids = set()
+    for handle in self.neighbor_handles():
+      if handle['id'] != self.id and handle['id'] not in neighbor_ids:
+        neighbor_ids.add(handle['id'])
+        self.send(handle, messages.migration.node_moved(self.new_handle(handle['id'])))
+
   def start_participant_role(self, message):
-    from dist_zero.transaction import ParticipantRole
+    self._start_participant_from_config(
+        transaction_id=message['transaction_id'], typename=message['typename'], args=message['args'])
+
+  def _start_participant_from_config(self, transaction_id, typename, args):
+    self._queued_participant_configs[transaction_id] = [typename, args]
     self._start_transaction_participant_eventually(
-        transaction_id=message['transaction_id'],
-        role=ParticipantRole.from_config(typename=message['typename'], args=message['args']))
+        transaction_id=transaction_id, role=transaction.TransactionRole.from_config(typename=typename, args=args))
 
   def checkpoint(self, before=None):
     '''
@@ -154,6 +297,7 @@ class Node(object):
         'n_duplicates': self.linker.n_duplicates,
         'sent_messages': self.linker.least_unused_sequence_number,
         'acknowledged_messages': self.linker.least_unacknowledged_sequence_number(),
+        'retransmission': self.linker.retransmission_stats(),
     }
 
   def handle_api_message(self, message):
@@ -172,6 +316,8 @@ class Node(object):
       return self.new_handle(for_node_id=message['new_node_id'])
     elif message['type'] == 'get_stats':
       return self.stats()
+    elif message['type'] == 'migrate_node':
+      self.start_transaction_eventually(MigrateNode(machine_id=message['machine_id']))
     else:
       self.logger.error('Unrecognized node api message of type "{}"'.format(message['type']))
 
@@ -181,9 +327,20 @@ class Node(object):
     '''
     Ensure that ``role.run`` will eventually be called with a `TransactionRoleController` for a new transaction on self.
 
+    If ``role`` is coalescible (see `TransactionRole.coalesce_key`) and an equivalent role is still waiting to start,
+    ``role`` will be merged into that one instead.
+
     :param role: The originator role instance defining the behavior of the overall transaction.
     :type role: `OriginatorRole`
     '''
+    if role.coalesce_key is not None:
+      key = (role.__class__, role.coalesce_key)
+      if key in self._coalescible_queued_roles:
+        # PERF(KK): The queued role will do all the work of ``role`` when it runs.
+        self._coalescible_queued_roles[key].coalesce(role)
+        return
+      self._coalescible_queued_roles[key] = role
+
     controller = transaction.TransactionRoleController(
         node=self, transaction_id=ids.new_id(f'Transaction__{role.__class__.__name__}'), role_class=role.__class__)
     self._start_role_eventually(role, controller)
@@ -191,13 +348,15 @@ class Node(object):
   def _start_role_eventually(self, role, controller):
     if role.log_starts_and_stops:
       self.logger.debug("Enqueueing role {role_name}", extra={'role_name': role.__class__.__name__})
-    self._transaction_role_queue.append((role, controller))
-    if len(self._transaction_role_queue) == 1:
-      # No coroutine is running transactions (the queue used to be empty), we need to create one
-      self._controller.create_task(self._run_transaction_roles_till_empty())
+    if role.has_priority:
+      # Go ahead of every queued role without priority.
+      index = 0
+      while index < len(self._transaction_role_queue) and self._transaction_role_queue[index][0].has_priority:
+        index += 1
+      self._transaction_role_queue.insert(index, (role, controller))
     else:
-      # A coroutine is already running transactions, it will eventually get to ``role``
-      pass
+      self._transaction_role_queue.append((role, controller))
+    self._start_runnable_transaction_roles()
 
   def _start_transaction_participant_eventually(self, transaction_id: str,
                                                 role: 'dist_zero.transaction.ParticipantRole'):
@@ -205,11 +364,35 @@ class Node(object):
         node=self, transaction_id=transaction_id, role_class=role.__class__)
     self._start_role_eventually(role, controller)
 
-  async def _run_transaction_roles_till_empty(self):
-    while len(self._transaction_role_queue) > 0:
-      # Note that while awaiting the below call to ``run``, more roles may be added
-      await self._run_transaction_role(*self._transaction_role_queue[0])
-      self._transaction_role_queue.pop(0)
+  def _start_runnable_transaction_roles(self):
+    '''
+    Start running every queued role that conflicts neither with a running role, nor with a role enqueued before it.
+    Conflicting roles therefore run one at a time, in the order they were enqueued.
+    '''
+    waiting = []
+    for role, controller in self._transaction_role_queue:
+      if controller.transaction_id in self._running_transaction_roles or \
+          any(role.conflicts_with(other) for other, _controller in waiting) or \
+          any(role.conflicts_with(other) for other, _controller in self._running_transaction_roles.values()):
+        waiting.append((role, controller))
+      else:
+        if role.coalesce_key is not None and \
+            self._coalescible_queued_roles.get((role.__class__, role.coalesce_key), None) is role:
+          # Once a role starts, it may have already read the state it depends on, so it can no longer coalesce.
+          self._coalescible_queued_roles.pop((role.__class__, role.coalesce_key))
+        self._queued_participant_configs.pop(controller.transaction_id, None)
+        self._running_transaction_roles[controller.transaction_id] = (role, controller)
+        self._controller.create_task(self._run_transaction_role_and_continue(role, controller))
+    self._transaction_role_queue = waiting
+
+  async def _run_transaction_role_and_continue(self, role, controller):
+    try:
+      await self._run_transaction_role(role, controller)
+    finally:
+      # Even a role that failed unexpectedly must stop blocking the roles that conflict with it.
+      self._running_transaction_roles.pop(controller.transaction_id)
+      # Roles that were waiting on ``role`` may now be able to start
+      self._start_runnable_transaction_roles()
 
   async def _deliver_postponed_transaction_messages(self, role_controller, msgs):
     for (msg, sender_id) in msgs:
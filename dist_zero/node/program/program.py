@@ -36,6 +36,9 @@ class ProgramNode(Node):
   def elapse(self, ms):
     pass
 
+  def ms_until_deadline(self):
+    return None
+
   def deliver(self, message, sequence_number, sender_id):
     pass
 
@@ -0,0 +1,255 @@
+'''
+Placement of newly spawned nodes onto machines.
+
+Each `NodeManager` keeps a `LoadTable` with the most recent load it has heard of for each machine in the system.
+Machines learn of one another from the handles their nodes send to, and share their loads by gossip:
+periodically, each machine measures its own load and sends every load it knows of to a few of its peers.
+
+When a node spawns a new node, its `NodeManager` asks a `PlacementPolicy` which machine should run the new node.
+The policy is chosen by the ``PLACEMENT_POLICY`` system config parameter (see `std_system_config`).
+'''
+
+from collections import defaultdict
+
+from dist_zero import errors
+
+MESSAGES_PER_SECOND_WEIGHT = 0.01
+'''The contribution to a machine's load score of each message per second its nodes receive.'''
+CPU_USAGE_WEIGHT = 100.0
+'''The contribution to a machine's load score of a fully busy CPU.'''
+
+
+def load_score(load):
+  '''
+  :param load: A :ref:`message` of type 'machine_load'
+  :type load: :ref:`message`
+  :return: A single number summarizing the load.  Higher numbers mean more heavily loaded machines.
+  :rtype: float
+  '''
+  return load['n_nodes'] + load['messages_per_second'] * MESSAGES_PER_SECOND_WEIGHT + \
+      load['cpu_usage'] * CPU_USAGE_WEIGHT
+
+
+class LoadTable(object):
+  '''The loads of all the machines known to a single machine.'''
+
+  def __init__(self, machine_id):
+    '''
+    :param str machine_id: The id of the machine that owns this table.
+    '''
+    self.machine_id = machine_id
+    self._load_by_machine_id = {}
+    self._transport_by_machine_id = {} # For every known machine other than self.machine_id
+    self._peer_ids = [] # The keys of self._transport_by_machine_id in the order they were learned.
+    self._next_gossip_index = 0
+
+  def learn_peer(self, machine_id, transport):
+    '''
+    Learn how to send to another machine.
+
+    :param str machine_id: The id of some machine.
+    :param transport: A :ref:`transport` for sending machine messages to that machine.
+    :type transport: :ref:`transport`
+    '''
+    if machine_id != self.machine_id and machine_id not in self._transport_by_machine_id:
+      self._transport_by_machine_id[machine_id] = transport
+      self._peer_ids.append(machine_id)
+
+  def update(self, load):
+    '''
+    Record a load, unless a later version is already known.
+
+    :param load: A :ref:`message` of type 'machine_load'
+    :type load: :ref:`message`
+    '''
+    existing = self._load_by_machine_id.get(load['machine_id'], None)
+    if existing is None or existing['version'] < load['version']:
+      self._load_by_machine_id[load['machine_id']] = load
+      self.learn_peer(load['machine_id'], load['transport'])
+
+  def note_spawned(self, machine_id):
+    '''
+    Adjust the known load of a machine after placing a node on it.
+    Without this adjustment, every node placed before the next gossip would go to the same machine.
+    '''
+    load = self._load_by_machine_id.get(machine_id, None)
+    if load is not None:
+      self._load_by_machine_id[machine_id] = dict(load, n_nodes=load['n_nodes'] + 1)
+
+  def load(self, machine_id):
+    '''
+    :return: The most recent load of a machine, or `None` if it is not known.
+    :rtype: :ref:`message`
+    '''
+    return self._load_by_machine_id.get(machine_id, None)
+
+  def loads(self):
+    '''
+    :return: The most recent loads of all machines known to this table.
+    :rtype: list
+    '''
+    return list(self._load_by_machine_id.values())
+
+  def transport(self, machine_id):
+    '''
+    :return: The :ref:`transport` for sending to a peer.
+    :rtype: :ref:`transport`
+    '''
+    return self._transport_by_machine_id[machine_id]
+
+  def is_known(self, machine_id):
+    return machine_id == self.machine_id or machine_id in self._transport_by_machine_id
+
+  def gossip_targets(self, n):
+    '''
+    Choose which peers to gossip to next.  Successive calls cycle through all the peers.
+
+    :param int n: The maximum number of peers to return.
+    :return: A list of the ids of up to ``n`` distinct peers.
+    :rtype: list[str]
+    '''
+    n = min(n, len(self._peer_ids))
+    result = []
+    for i in range(n):
+      result.append(self._peer_ids[(self._next_gossip_index + i) % len(self._peer_ids)])
+    if self._peer_ids:
+      self._next_gossip_index = (self._next_gossip_index + n) % len(self._peer_ids)
+    return result
+
+  def candidates(self):
+    '''
+    :return: The list of pairs (load_score, machine_id) for every machine with a known load.
+    :rtype: list
+    '''
+    return [(load_score(load), machine_id) for machine_id, load in self._load_by_machine_id.items()]
+
+
+class PlacementPolicy(object):
+  '''Abstract base class for policies that choose which machine should run a newly spawned node.'''
+
+  name = None
+  '''The name by which the ``PLACEMENT_POLICY`` system config parameter refers to this policy.'''
+
+  def choose(self, node_config, load_table):
+    '''
+    :param node_config: The config of the node to be spawned.
+    :type node_config: :ref:`message`
+    :param load_table: The loads known to the spawning machine.
+    :type load_table: `LoadTable`
+    :return: The id of the machine that should run the node.  It must be a machine known to ``load_table``.
+    :rtype: str
+    '''
+    raise errors.AbstractSuperclass(self.__class__)
+
+  def forget(self, node_id):
+    '''
+    Forget anything kept about a node that no longer runs on the spawning machine.
+
+    :param str node_id: The id of the node.
+    '''
+    pass
+
+
+class LocalPolicy(PlacementPolicy):
+  '''Always run new nodes on the spawning machine.'''
+
+  name = 'local'
+
+  def choose(self, node_config, load_table):
+    return load_table.machine_id
+
+
+class LeastLoadedPolicy(PlacementPolicy):
+  '''Run new nodes on the machine with the lowest `load_score`, preferring the spawning machine.'''
+
+  name = 'least_loaded'
+
+  def __init__(self, imbalance):
+    '''
+    :param float imbalance: Only choose another machine if its load score is lower by more than this amount.
+    '''
+    self._imbalance = imbalance
+
+  def choose(self, node_config, load_table):
+    return self._least_loaded(load_table.candidates(), load_table)
+
+  def _least_loaded(self, candidates, load_table):
+    local_load = load_table.load(load_table.machine_id)
+    if local_load is None or not candidates:
+      return load_table.machine_id
+
+    best_score, best_machine_id = min(candidates)
+    if best_score + self._imbalance < load_score(local_load):
+      return best_machine_id
+    else:
+      return load_table.machine_id
+
+
+class SpreadSiblingsPolicy(LeastLoadedPolicy):
+  '''
+  Spread the kids of each parent across machines, so that losing a machine loses only a few of them.
+  Among the machines running the fewest siblings, behave like `LeastLoadedPolicy`.
+  '''
+
+  name = 'spread_siblings'
+
+  def __init__(self, imbalance):
+    super(SpreadSiblingsPolicy, self).__init__(imbalance)
+    # Map each parent id to a map from machine id to the number of its kids placed on that machine.
+    self._n_kids_by_parent_id = defaultdict(lambda: defaultdict(int))
+
+  def choose(self, node_config, load_table):
+    parent = node_config.get('parent', None)
+    if parent is None:
+      return super(SpreadSiblingsPolicy, self).choose(node_config, load_table)
+
+    n_kids = self._n_kids_by_parent_id[parent['id']]
+    candidates = load_table.candidates()
+    if candidates:
+      fewest = min(n_kids[machine_id] for score, machine_id in candidates)
+      candidates = [(score, machine_id) for score, machine_id in candidates if n_kids[machine_id] == fewest]
+      if n_kids[load_table.machine_id] == fewest:
+        result = self._least_loaded(candidates, load_table)
+      else:
+        result = min(candidates)[1]
+    else:
+      result = load_table.machine_id
+
+    n_kids[result] += 1
+    return result
+
+  def forget(self, node_id):
+    # Only the machine running a parent spawns its kids, so there is nothing more to count for it here.
+    self._n_kids_by_parent_id.pop(node_id, None)
+
+
+class ColocatePolicy(PlacementPolicy):
+  '''Run each new node on the same machine as its parent, so that messages between them stay on one machine.'''
+
+  name = 'colocate'
+
+  def choose(self, node_config, load_table):
+    parent = node_config.get('parent', None)
+    if parent is not None and load_table.is_known(parent['controller_id']):
+      return parent['controller_id']
+    else:
+      return load_table.machine_id
+
+
+def from_system_config(system_config):
+  '''
+  :param dict system_config: The system config.  See `std_system_config`.
+  :return: A new instance of the policy named by ``system_config``.
+  :rtype: `PlacementPolicy`
+  '''
+  name = system_config['PLACEMENT_POLICY']
+  if name == LocalPolicy.name:
+    return LocalPolicy()
+  elif name == LeastLoadedPolicy.name:
+    return LeastLoadedPolicy(imbalance=system_config['PLACEMENT_IMBALANCE'])
+  elif name == SpreadSiblingsPolicy.name:
+    return SpreadSiblingsPolicy(imbalance=system_config['PLACEMENT_IMBALANCE'])
+  elif name == ColocatePolicy.name:
+    return ColocatePolicy()
+  else:
+    raise errors.InternalError(f"Unrecognized placement policy \"{name}\".")
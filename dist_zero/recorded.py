@@ -1,4 +1,5 @@
 import asyncio
+import itertools
 import logging
 
 from dist_zero import errors, cgen
@@ -60,7 +61,7 @@ class RecordedUser(expression.ConcreteExpression):
 
     play_recorded_transition = self._generate_play_recorded_transition(compiler)
 
-    for when, python_transition in self._time_action_pairs:
+    for when, python_transition in self._compacted_time_action_pairs(type):
       vTransition = stateInitFunction.AddDeclaration(
           type.c_transitions_type.Star().Var(f"recorded_transitions_{cgen.inc_i()}"))
       type.generate_allocate_transition(compiler, stateInitFunction, vTransition, python_transition)
@@ -74,6 +75,18 @@ class RecordedUser(expression.ConcreteExpression):
       (stateInitFunction.AddIf(cgen.event_queue_push(vGraph.Arrow('events').Address(), event)).consequent.AddAssignment(
           None, compiler.pyerr_from_string("Error pushing to event queue.")))
 
+  def _compacted_time_action_pairs(self, type):
+    '''
+    :param type: The `ConcreteType` of self.
+    :return: The recorded (time, action) pairs, with the actions recorded for the same time compacted together.
+    :rtype: list
+    '''
+    result = []
+    for when, pairs in itertools.groupby(self._time_action_pairs, key=lambda pair: pair[0]):
+      for python_transition in type.compact_transitions([action for t, action in pairs]):
+        result.append((when, python_transition))
+    return result
+
   def generate_free_state(self, compiler, block, stateRvalue):
     type = compiler.get_concrete_type(self.type)
     type.generate_free_state(compiler, block, stateRvalue)
@@ -87,11 +100,17 @@ class RecordedUser(expression.ConcreteExpression):
   def actions(self):
     return [action for (t, action) in self._time_action_pairs]
 
-  def simulate(self, controller, deliver):
+  BACKPRESSURE_POLL_MS = 50
+  '''While playback is backpressured, the number of milliseconds between checks for whether it may continue.'''
+
+  def simulate(self, controller, deliver, is_backpressured=None):
     '''
     Start an asyncio task to simulate the messages recorded is self.
     Use controller.sleep_ms() to wait for the next message, and
     call deliver(m) with each message m when it arrives.
+
+    :param is_backpressured: If provided, a function returning True while messages should not be delivered.
+      Playback pauses until it returns False, and later messages are delayed accordingly.
     '''
     self._started = True
 
@@ -99,6 +118,8 @@ class RecordedUser(expression.ConcreteExpression):
       if i < len(self._time_action_pairs):
         t, m = self._time_action_pairs[i]
         await controller.sleep_ms(t if i == 0 else t - self._time_action_pairs[i - 1][0])
+        while is_backpressured is not None and is_backpressured():
+          await controller.sleep_ms(RecordedUser.BACKPRESSURE_POLL_MS)
         deliver(m)
         asyncio.get_event_loop().create_task(_loop(i + 1))
 
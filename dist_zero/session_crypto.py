@@ -0,0 +1,104 @@
+'''
+Symmetric encryption for messages between nodes and between machines.
+
+Each `Node` (and each `NodeManager`) has a session key.  Anyone holding a handle (or transport) with that key
+can encrypt messages that only the key's owner can decrypt.
+
+Messages are encrypted with AES-GCM directly over raw bytes.  Each encrypted message is the 12 byte nonce
+followed by the ciphertext and its 16 byte authentication tag; there is no base64 expansion.
+
+Building a cipher object is comparatively expensive, so ciphers are cached by key.  Use `session_cipher`
+to get the cipher for a key.
+'''
+
+import base64
+import collections
+import os
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from dist_zero import messages
+
+KEY_BITS = 256
+NONCE_BYTES = 12
+
+
+def new_session_key():
+  '''
+  Generate a new session key.
+
+  :return: A json serializable key.
+  :rtype: str
+  '''
+  return base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=KEY_BITS)).decode(messages.ENCODING)
+
+
+class SessionCipher(object):
+  '''An authenticated cipher for a single session key.'''
+
+  def __init__(self, session_key):
+    '''
+    :param str session_key: A key generated by `new_session_key`
+    '''
+    self._aead = AESGCM(base64.urlsafe_b64decode(session_key))
+
+  def encrypt(self, data):
+    '''
+    :param bytes data: The plaintext.
+    :return: The nonce followed by the ciphertext.
+    :rtype: bytes
+    '''
+    nonce = os.urandom(NONCE_BYTES)
+    return nonce + self._aead.encrypt(nonce, bytes(data), None)
+
+  def decrypt(self, data):
+    '''
+    :param bytes data: The output of `SessionCipher.encrypt`
+    :return: The plaintext.
+    :rtype: bytes
+
+    :raises cryptography.exceptions.InvalidTag: if the data was not encrypted with this cipher's key,
+      or has been tampered with.
+    '''
+    data = memoryview(data)
+    return self._aead.decrypt(data[:NONCE_BYTES].tobytes(), data[NONCE_BYTES:].tobytes(), None)
+
+
+class SessionCipherCache(object):
+  '''A least recently used cache of `SessionCipher` instances, keyed by session key.'''
+
+  def __init__(self, max_size=4096):
+    self._max_size = max_size
+    self._cipher_by_key = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._cipher_by_key)
+
+  def get(self, session_key):
+    '''
+    :param str session_key: A session key.
+    :return: The cipher for that key.
+    :rtype: `SessionCipher`
+    '''
+    cipher = self._cipher_by_key.get(session_key, None)
+    if cipher is None:
+      cipher = SessionCipher(session_key)
+      self._cipher_by_key[session_key] = cipher
+      if len(self._cipher_by_key) > self._max_size:
+        self._cipher_by_key.popitem(last=False)
+    else:
+      self._cipher_by_key.move_to_end(session_key)
+
+    return cipher
+
+
+_cache = SessionCipherCache()
+
+
+def session_cipher(session_key):
+  '''
+  :param str session_key: A session key.
+  :return: The cached cipher for that key.
+  :rtype: `SessionCipher`
+  '''
+  return _cache.get(session_key)
@@ -19,15 +19,23 @@ use_uv_loop = USE_UV_LOOP.strip().lower() == 'true'
 if use_uv_loop:
   asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-ENCRYPT_ALL_MESSAGES = os.environ.get('ENCRYPT_ALL_MESSAGES', 'true')
-encrypt_all_messages = ENCRYPT_ALL_MESSAGES.strip().lower() == 'true'
-
 load_dotenv(find_dotenv())
 
 DIST_ZERO_ENV = os.environ['DIST_ZERO_ENV']
 
 IS_TESTING_ENV = DIST_ZERO_ENV == 'test'
 
+ENCRYPT_ALL_MESSAGES = os.environ.get('ENCRYPT_ALL_MESSAGES', 'true')
+encrypt_all_messages = ENCRYPT_ALL_MESSAGES.strip().lower() == 'true'
+
+# When encrypting, either 'message' to encrypt each node message with the key of its receiving node,
+# or 'datagram' to encrypt each coalesced datagram once with the key of its receiving machine.
+ENCRYPTION_GRANULARITY = os.environ.get('ENCRYPTION_GRANULARITY', 'message').strip().lower()
+if ENCRYPTION_GRANULARITY not in ('message', 'datagram'):
+  raise RuntimeError(f"ENCRYPTION_GRANULARITY must be 'message' or 'datagram', not '{ENCRYPTION_GRANULARITY}'.")
+encrypt_messages = encrypt_all_messages and ENCRYPTION_GRANULARITY == 'message'
+encrypt_datagrams = encrypt_all_messages and ENCRYPTION_GRANULARITY == 'datagram'
+
 ALWAYS_REBUILD_DOCKER_IMAGES = os.environ.get('ALWAYS_REBUILD_DOCKER_IMAGES', '').strip().lower() == 'true'
 
 # URL for the docker server
@@ -39,7 +47,15 @@ MACHINE_CONTROLLER_DEFAULT_TCP_PORT = 9877
 
 MACHINE_CONTROLLER_ROUTING_PORT_RANGE = (10000, 20000)
 
-MSG_BUFSIZE = 2048
+# The size of the buffer for reads from the tcp API, and the maximum size of the body of each tcp API frame.
+MSG_BUFSIZE = 64 * 1024
+
+# Messages sent to the same machine within one iteration of the event loop are coalesced into datagrams
+# of at most this many bytes.  Chosen to fit inside a typical 1500 byte ethernet MTU.
+UDP_DATAGRAM_BUDGET_BYTES = 1400
+
+# The name of the `Codec` used to encode messages between machines.  See `dist_zero.codec`
+WIRE_CODEC = os.environ.get('WIRE_CODEC', 'binary').strip().lower()
 
 HAPROXY_STATS_USERNAME = os.environ.get('HAPROXY_STATS_USERNAME')
 HAPROXY_STATS_PASSWORD = os.environ.get('HAPROXY_STATS_PASSWORD')
@@ -91,5 +107,7 @@ CLOUD_ENV_VARS = [
     'AWS_SECRET_ACCESS_KEY_ID',
     'DEFAULT_AWS_REGION',
     'ENCRYPT_ALL_MESSAGES',
+    'ENCRYPTION_GRANULARITY',
     'USE_UV_LOOP',
+    'WIRE_CODEC',
 ]
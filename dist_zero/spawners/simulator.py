@@ -9,7 +9,7 @@ import time
 
 import dist_zero.logging
 import dist_zero.ids
-from dist_zero import machine, errors, settings, spawners
+from dist_zero import machine, errors, settings, spawners, codec, session_crypto
 from dist_zero.node import data
 
 from . import spawner
@@ -47,6 +47,9 @@ class SimulatedSpawner(spawner.Spawner):
     self._pending_receives = []
     self._random = random.Random(random_seed)
 
+    # Simulated machines encode and decode their messages with the same codec that real machines use.
+    self._codec = codec.default_codec()
+
     # A log of all the items pushed onto the heap in the order they were pushed.
     # This log is useful for debugging.
     self._log = []
@@ -93,11 +96,13 @@ class SimulatedSpawner(spawner.Spawner):
 
   def _format_log(self, log_message):
     ms, msg = log_message
-    message = msg['message']
+    message = self._decode_event_message(msg)
+    if message['type'] == 'machine_channel' and message['value']['type'] == 'receive':
+      message = message['value']['message']
     if message['type'] == 'machine_deliver_to_node':
       return "{} --{}--> {}".format(
           self._format_node_id(message.get('sending_node_id', None)),
-          msg['message']['type'],
+          message['type'],
           self._format_node_id(message.get('node_id', None)),
       )
     else:
@@ -123,7 +128,7 @@ class SimulatedSpawner(spawner.Spawner):
         to_receive.set_result(None)
       else:
         receiving_controller = self._controller_by_id[to_receive['machine_id']]
-        receiving_controller.handle_message(message=to_receive['message'])
+        receiving_controller.handle_message(message=self._decode_event_message(to_receive))
 
       # FIXME(KK): Surely there must be a better way to run the events that may have been
       # scheduled by the above few lines.
@@ -188,20 +193,21 @@ class SimulatedSpawner(spawner.Spawner):
       If sock_type == 'tcp', then return the response from the `MachineController` tcp API.
     :rtype: object
     '''
-    # Simulate the serializing and deserializing that happens in other Spawners.
-    # This behavior is important so that simulated tests don't accidentally share data.
-    message = simulate_message_sent_and_received(message)
-
     if self._elapsed_time_ms is None:
       raise RuntimeError('The simulation must be started before it can send messages.')
 
     sending_time_ms = self._random_ms_for_send()
     if sock_type == 'udp':
+      # Encode the message just as the other Spawners do.
+      # This behavior is important so that simulated tests don't accidentally share data.
       self._add_to_heap((self._elapsed_time_ms + sending_time_ms, {
           'machine_id': machine_id,
-          'message': message,
+          'message': self._codec.encode(message),
       }))
     elif sock_type == 'tcp':
+      # Simulate the serializing and deserializing that happens in other Spawners.
+      # This behavior is important so that simulated tests don't accidentally share data.
+      message = simulate_message_sent_and_received(message)
       receiving_controller = self._controller_by_id[machine_id]
       response = receiving_controller.handle_api_message(message)
       if response['status'] == 'ok':
@@ -215,11 +221,28 @@ class SimulatedSpawner(spawner.Spawner):
     if self._elapsed_time_ms is None:
       raise RuntimeError('The simulation must be started before it can send messages.')
 
+    encoded_message = self._codec.encode(message)
+    if settings.encrypt_datagrams:
+      # Simulate the per-datagram encryption of a `DatagramSender`.
+      session_key = transport.get('session_key', None)
+      if session_key is None:
+        raise errors.InternalError("Can not encrypt a datagram for a machine without its session key.")
+      encoded_message = session_crypto.session_cipher(session_key).encrypt(encoded_message)
+
     self._add_to_heap((self._elapsed_time_ms + self._random_ms_for_send(), {
         'machine_id': transport['host'],
-        'message': message,
+        'message': encoded_message,
+        'encrypted': settings.encrypt_datagrams,
     }))
 
+  def _decode_event_message(self, event_value):
+    encoded_message = event_value['message']
+    if event_value.get('encrypted', False):
+      encoded_message = self._controller_by_id[event_value['machine_id']].cipher.decrypt(encoded_message)
+    elif settings.encrypt_datagrams:
+      raise errors.InternalError("Received a datagram that was not encrypted.")
+    return self._codec.decode(encoded_message)
+
 
 class _Event(object):
   '''
@@ -240,7 +263,7 @@ class _Event(object):
       return False
     else:
       # Return a consistent answer when comparing events that occur at the exact same time.
-      return json.dumps(self.value) < json.dumps(other.value)
+      return (self.value['machine_id'], self.value['message']) < (other.value['machine_id'], other.value['message'])
 
   def tuple(self):
     return (self.t, self.value)
@@ -2,6 +2,8 @@ import logging
 import sys
 import time
 
+from collections import defaultdict
+
 from logstash_async.handler import AsynchronousLogstashHandler
 
 import dist_zero.logging
@@ -34,6 +36,15 @@ class SystemController(object):
     self._node_id_to_machine_id = {}
     '''For nodes spawned by this instance, map the node id to the id of the machine it was spawned on.'''
 
+    self._migration_target_by_node_id = {}
+    '''
+    For nodes this instance has asked to migrate, map the node id to the id of the machine it should move to.
+    Entries are removed once the machine the node was running on reports that it has moved.
+    '''
+
+    self._api_pool = transport.ApiConnectionPool()
+    '''Persistent connections to the tcp APIs of machines, when in cloud mode.'''
+
   def sleep_ms(self, ms):
     return self._spawner.sleep_ms(ms)
 
@@ -214,6 +225,41 @@ class SystemController(object):
   def kill_node(self, node_id):
     self.send_api_message(node_id, messages.machine.kill_node())
 
+  def migrate_node(self, node_id, machine_id):
+    '''
+    Move a running node to another machine.  See `dist_zero.node.migration`
+
+    :param str node_id: The id of a `DataNode` or `LinkNode`.
+    :param str machine_id: The id of the `MachineController` that should run the node.
+      The node's current machine must already know of it.
+    '''
+    self.send_api_message(node_id, messages.machine.migrate_node(machine_id=machine_id))
+    # The node moves only once the roles running on it finish.  Until its old machine reports that it has moved,
+    # keep sending to the old machine.
+    self._migration_target_by_node_id[node_id] = machine_id
+
+  def _machine_id_for_node(self, node_id):
+    '''
+    :param str node_id: The id of a node known to this instance.
+    :return: The id of the machine currently running the node.
+    :rtype: str
+    '''
+    machine_id = self._node_id_to_machine_id[node_id]
+    if node_id in self._migration_target_by_node_id:
+      location = self._send_to_machine(
+          machine_id=machine_id, message=messages.machine.locate_node(node_id), sock_type='tcp')
+      if location is None:
+        # The old machine stops forwarding to a migrated node a while after it moves, and then forgets it.
+        location = self._send_to_machine(
+            machine_id=self._migration_target_by_node_id[node_id],
+            message=messages.machine.locate_node(node_id),
+            sock_type='tcp')
+      if location is not None and location != machine_id:
+        self._node_id_to_machine_id[node_id] = machine_id = location
+      if machine_id == self._migration_target_by_node_id[node_id]:
+        self._migration_target_by_node_id.pop(node_id)
+    return machine_id
+
   def _send_to_machine(self, machine_id, message, sock_type='udp'):
     '''
     Send a message to the identified `MachineController` using whatever method is appropriate
@@ -228,6 +274,10 @@ class SystemController(object):
       If sock_type == 'tcp', then return the response from the `MachineController` tcp API.
     :rtype: object
     '''
+    if sock_type == 'udp' and settings.encrypt_datagrams:
+      # Machines reject datagrams that were not encrypted with their session keys, which are not known here.
+      message, sock_type = messages.machine.api_machine_message(message), 'tcp'
+
     if self._spawner.mode() == spawners.MODE_SIMULATED:
       return self._spawner.simulate_send_to_machine(machine_id=machine_id, message=message, sock_type=sock_type)
     elif self._spawner.mode() == spawners.MODE_VIRTUAL:
@@ -236,10 +286,33 @@ class SystemController(object):
       return transport.send(
           message=message,
           ip_address=self._spawner.aws_instance_by_id[machine_id].public_ip_address,
-          sock_type=sock_type)
+          sock_type=sock_type,
+          api_pool=self._api_pool)
     else:
       raise errors.InternalError('Unrecognized mode "{}"'.format(self._spawner.mode()))
 
+  def _send_many_to_machine_tcp(self, machine_id, api_messages):
+    '''
+    Send many messages to the tcp API of the identified `MachineController`.
+
+    :param str machine_id: The id of the `MachineController` for one of the managed machines.
+    :param list api_messages: A list of json serializable API messages.
+
+    :return: The list of responses, in the same order as ``api_messages``.
+    :rtype: list
+    '''
+    if self._spawner.mode() == spawners.MODE_CLOUD:
+      # Pipeline the messages instead of waiting for each response before sending the next message.
+      return transport.send_tcp_many(
+          api_messages,
+          dst=(self._spawner.aws_instance_by_id[machine_id].public_ip_address,
+               settings.MACHINE_CONTROLLER_DEFAULT_TCP_PORT),
+          api_pool=self._api_pool)
+    else:
+      return [
+          self._send_to_machine(machine_id=machine_id, message=message, sock_type='tcp') for message in api_messages
+      ]
+
   def mode(self):
     return self._spawner.mode()
 
@@ -280,10 +353,34 @@ class SystemController(object):
 
   def send_api_message(self, node_id, message):
     return self._send_to_machine(
-        machine_id=self._node_id_to_machine_id[node_id],
+        machine_id=self._machine_id_for_node(node_id),
         message=messages.machine.api_node_message(node_id=node_id, message=message),
         sock_type='tcp')
 
+  def send_api_messages(self, node_ids_and_messages):
+    '''
+    Like `SystemController.send_api_message`, but send many api messages at once.
+    The messages for each machine are sent together.
+
+    :param list node_ids_and_messages: A list of pairs (node_id, message)
+    :return: The list of responses, in the same order as ``node_ids_and_messages``.
+    :rtype: list
+    '''
+    indices_by_machine_id = defaultdict(list)
+    for i, (node_id, message) in enumerate(node_ids_and_messages):
+      indices_by_machine_id[self._machine_id_for_node(node_id)].append(i)
+
+    result = [None] * len(node_ids_and_messages)
+    for machine_id, indices in indices_by_machine_id.items():
+      api_messages = [
+          messages.machine.api_node_message(node_id=node_ids_and_messages[i][0], message=node_ids_and_messages[i][1])
+          for i in indices
+      ]
+      for i, response in zip(indices, self._send_many_to_machine_tcp(machine_id, api_messages)):
+        result[i] = response
+
+    return result
+
   def generate_new_handle(self, new_node_id, existing_node_id):
     '''
     Generate a new handle to fill a config for a new node to send to an existing node.
@@ -305,12 +402,12 @@ class SystemController(object):
     :param message: A message for that node.
     :type message: :ref:`message`
     '''
-    machine_id = self._node_id_to_machine_id[node_id]
+    machine_id = self._machine_id_for_node(node_id)
     machine_message = messages.machine.machine_deliver_to_node(node_id=node_id, message=message, sending_node_id=None)
     self._send_to_machine(machine_id=machine_id, message=machine_message)
 
   def _node_handle_to_machine_id(self, node_handle):
-    return self._node_id_to_machine_id[node_handle['id']]
+    return self._machine_id_for_node(node_handle['id'])
 
   def spy(self, root_id, spy_key):
     '''
@@ -322,17 +419,35 @@ class SystemController(object):
     :return: A map from leaf_node_id to the spy key's value on that leaf_node.
     :rtype: dict
     '''
-    return {leaf_id: self.spy_leaf(leaf_id, spy_key) for leaf_id in self.get_leaves(root_id)}
+    leaf_ids = self.get_leaves(root_id)
+    spies = self.send_api_messages([(leaf_id, messages.machine.spy(spy_key)) for leaf_id in leaf_ids])
+    return dict(zip(leaf_ids, spies))
 
   def get_leaves(self, root_id):
-    def _loop(node_id):
-      if 0 == self.get_height(node_id):
-        yield node_id
-      else:
-        for kid_id in self.get_kids(node_id):
-          yield from _loop(kid_id)
-
-    return list(_loop(root_id))
+    '''
+    :param str root_id: The id of the root of a tree of nodes.
+    :return: The ids of all the leaves of the tree.
+    :rtype: list[str]
+    '''
+    result = []
+    # Walk the tree a level at a time, so that all the api messages for a level can be sent together.
+    level = [root_id]
+    while level:
+      stats = self.send_api_messages([(node_id, messages.machine.get_stats()) for node_id in level])
+      parent_ids = []
+      for node_id, node_stats in zip(level, stats):
+        if node_stats['height'] == 0:
+          result.append(node_id)
+        else:
+          parent_ids.append(node_id)
+
+      level = []
+      for kids in self.send_api_messages([(node_id, messages.machine.get_kids()) for node_id in parent_ids]):
+        for handle in kids.values():
+          self._add_node_machine_mapping(handle)
+        level.extend(kids.keys())
+
+    return result
 
   def get_simulated_spawner(self):
     if self._spawner.mode() != spawners.MODE_SIMULATED:
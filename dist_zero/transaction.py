@@ -4,6 +4,20 @@ from collections import defaultdict
 import dist_zero.logging
 from dist_zero import messages, ids, errors
 
+# Resources of a node that a `TransactionRole` may declare it touches.  See `TransactionRole.resources`.
+KIDS = 'kids' # The set of kids as a whole.  It includes every individual kid.
+INTERVAL = 'interval' # The interval of keys covered by the node.
+SUBSCRIPTIONS = 'subscriptions' # The subscriptions of the node's publisher.
+SPLITS = 'splits' # The right to split a kid, so that each split sees the capacity added by the splits before it.
+
+
+def kid_resource(kid_id):
+  '''
+  :param str kid_id: The id of a kid of a node.
+  :return: The resource of a node corresponding to one of its kids.
+  '''
+  return ('kid', kid_id)
+
 
 class TransactionRoleController(object):
   '''
@@ -76,6 +90,9 @@ class TransactionRoleController(object):
 
     The existence of such a tree guarantees that transactions can not wind up in deadlock, as at any point
     in time, any transaction "lowest" in the tree is guaranteed to make progress.
+    Roles on the same node may run concurrently only when their `TransactionRole.resources` do not conflict, and a
+    role only ever waits for the conflicting roles that are running or were enqueued before it on the same node,
+    so the roles waiting on any one node can not wait on each other in a cycle, and the guarantee still holds.
 
     :param node_handle: The handle of a node "owned" by self.
     :type node_handle: :ref:`handle`
@@ -170,29 +187,94 @@ class TransactionRole(object):
     '''Subclasses can override to False if they would not like all their starts and stops to be logged.'''
     return True
 
+  @property
+  def resources(self):
+    '''
+    The resources of the node that this role reads or modifies while it runs.
 
-class OriginatorRole(TransactionRole):
-  '''
-  Abstract base class for `TransactionRole` instances that originate their transaction.
-  '''
+    A node runs roles whose resources do not conflict concurrently, and runs conflicting roles one at a time in
+    the order they were enqueued.
+    Subclasses that touch only part of their node should override this property.
 
+    :return: None if the role may touch anything on its node (the default), or else a set of resources
+      (`KIDS`, `INTERVAL`, `SUBSCRIPTIONS`, `SPLITS` or the result of `kid_resource`).
+    :rtype: frozenset
+    '''
+    return None
 
-class ParticipantRole(TransactionRole):
-  '''
-  Abstract base class for `TransactionRole` instances that participate in a
-  transaction originated by a separate `TransactionRole`.
-  '''
+  @property
+  def coalesce_key(self):
+    '''
+    Idempotent `OriginatorRole` subclasses can override this property to have requests to run them coalesced.
+
+    When `Node.start_transaction_eventually` is called with a role while another role of the same class and with an
+    equal key is still waiting to start on the node, the new role is merged into the waiting one with
+    `TransactionRole.coalesce` instead of being enqueued.
+
+    :return: None if the role should never be coalesced (the default), or else a hashable key.
+    '''
+    return None
+
+  def coalesce(self, other):
+    '''
+    Merge a newer request to run ``other`` into self, which has not yet started to run.
+    Subclasses that override `TransactionRole.coalesce_key` may override this method to combine their arguments.
+
+    :param other: A role of the same class as self and with the same `TransactionRole.coalesce_key`.
+    :type other: `TransactionRole`
+    '''
+    pass
+
+  @property
+  def has_priority(self):
+    '''
+    Subclasses can override to True to have their roles enqueued ahead of every queued role without priority.
+    A role with priority that conflicts with everything (see `TransactionRole.resources`) therefore keeps any new role
+    from starting, and runs as soon as the roles that are already running finish.
+    '''
+    return False
+
+  @property
+  def migration_args(self):
+    '''
+    `OriginatorRole` subclasses can override this property to be restarted on the new machine when their node migrates
+    while they are still waiting to start.  Their class must then be exported by `dist_zero.all_transactions`.
+
+    :return: None if the role should be dropped when its node migrates (the default), or else the kwargs to pass to
+      the role's initializer on the new machine.
+    :rtype: dict
+    '''
+    return None
+
+  def conflicts_with(self, other):
+    '''
+    :param other: Another role on the same node.
+    :type other: `TransactionRole`
+    :return: True iff self and ``other`` must not run on the same node at the same time.
+    :rtype: bool
+    '''
+    mine, theirs = self.resources, other.resources
+    if mine is None or theirs is None:
+      return True
+    elif mine & theirs:
+      return True
+    elif KIDS in mine:
+      return any(_is_kid_resource(resource) for resource in theirs)
+    elif KIDS in theirs:
+      return any(_is_kid_resource(resource) for resource in mine)
+    else:
+      return False
 
   @staticmethod
   def from_config(typename: str, args: object):
     '''
-    Parse a config generated by `start_participant_role`
+    Parse a config generated by `start_participant_role`, or by `Node.snapshot` for a queued role.
 
-    :param str typename: A string identitying a particular subclass of `ParticipantRole`
+    :param str typename: A string identitying a particular subclass of `TransactionRole`
     :param object arg: The kwargs arguments to pass to that subclass's initializer.
 
-    :return: The parsed `ParticipantRole`.
-    :rtype: `ParticipantRole`
+    :return: The parsed `TransactionRole`.
+    :rtype: `TransactionRole`
     '''
     from dist_zero import all_transactions
     if typename in all_transactions.__dict__:
@@ -203,6 +285,19 @@ class ParticipantRole(TransactionRole):
           f"Unrecognized transaction type name \"{typename}\" not found in dist_zero.all_transactions.")
 
 
+class OriginatorRole(TransactionRole):
+  '''
+  Abstract base class for `TransactionRole` instances that originate their transaction.
+  '''
+
+
+class ParticipantRole(TransactionRole):
+  '''
+  Abstract base class for `TransactionRole` instances that participate in a
+  transaction originated by a separate `TransactionRole`.
+  '''
+
+
 def add_participant_role_to_node_config(node_config, transaction_id, participant_typename, args):
   new_config = {
       'start_participant_role':
@@ -214,3 +309,7 @@ def add_participant_role_to_node_config(node_config, transaction_id, participant
   }
   new_config.update(node_config)
   return new_config
+
+
+def _is_kid_resource(resource):
+  return isinstance(resource, tuple) and resource[0] == 'kid'
@@ -2,22 +2,35 @@
 For transporting messages across the network.
 '''
 
+import asyncio
 import socket
 import json
 import logging
+import struct
 
-from dist_zero import messages, settings, errors
+from dist_zero import messages, settings, errors, codec, session_crypto
 
 logger = logging.getLogger(__name__)
 
+_FRAME_LENGTH = struct.Struct('!I')
 
-def send(message, ip_address, sock_type):
+_PLAIN_DATAGRAM = b'\x00'
+_ENCRYPTED_DATAGRAM = b'\x01'
+_ENCRYPTION_OVERHEAD_BYTES = session_crypto.NONCE_BYTES + 16
+
+# request id, length of the body of the frame, flags
+_API_FRAME_HEADER = struct.Struct('!IIB')
+_API_FLAG_FINAL = 1
+'''Set on the last frame of each message.'''
+
+
+def send(message, ip_address, sock_type, api_pool=None):
   if sock_type == 'udp':
     dst = (ip_address, settings.MACHINE_CONTROLLER_DEFAULT_UDP_PORT)
     return send_udp(message, dst)
   elif sock_type == 'tcp':
     dst = (ip_address, settings.MACHINE_CONTROLLER_DEFAULT_TCP_PORT)
-    return send_tcp(message, dst)
+    return send_tcp(message, dst, api_pool=api_pool)
   else:
     raise errors.InternalError("Unrecognized sock_type {}".format(sock_type))
 
@@ -26,27 +39,428 @@ def send_udp(message, dst):
   '''
   Send a message via UDP
 
-  :param object message: A json seralizable message.
+  :param object message: A machine message.  It will be encoded with the default `Codec`.
   :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
 
   :return: `None`
   '''
-  binary = bytes(json.dumps(message), messages.ENCODING)
+  binary = pack_datagram([codec.default_codec().encode(message)])
   with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
     sock.sendto(binary, dst)
     return None
 
 
-def send_tcp(message, dst):
-  binary = bytes(json.dumps(message), messages.ENCODING)
-  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    sock.connect(dst)
-    sock.send(binary)
-    logger.debug("message sent to MachineController tcp API on {dst_host}", extra={'dst_host': dst[0]})
-    response = sock.recv(settings.MSG_BUFSIZE)
-    logger.debug("received MachineController API response message from {dst_host}", extra={'dst_host': dst[0]})
-    msg = json.loads(response.decode(messages.ENCODING))
-    if msg['status'] != 'ok':
-      raise errors.InternalError("Failed to communicate over TCP api to MachineController. reason: {}".format(
-          msg.get('reason', '')))
-    return msg['data']
+def pack_datagram(encoded_messages, cipher=None):
+  '''
+  Pack encoded messages into a single datagram.
+
+  :param list[bytes] encoded_messages: A list of messages, each encoded with a `Codec`.
+  :param cipher: If provided, encrypt the whole datagram once with this cipher.
+  :type cipher: `SessionCipher`
+  :rtype: bytes
+  '''
+  parts = []
+  for encoded_message in encoded_messages:
+    parts.append(_FRAME_LENGTH.pack(len(encoded_message)))
+    parts.append(encoded_message)
+  if cipher is None:
+    return _PLAIN_DATAGRAM + b''.join(parts)
+  else:
+    return _ENCRYPTED_DATAGRAM + cipher.encrypt(b''.join(parts))
+
+
+def unpack_datagram(data, cipher=None, require_encryption=False):
+  '''
+  Unpack a datagram generated by `pack_datagram`.
+
+  :param bytes data: The datagram.
+  :param cipher: The cipher of the receiving machine.  Required to unpack encrypted datagrams.
+  :type cipher: `SessionCipher`
+  :param bool require_encryption: If true, reject datagrams that were not encrypted.
+    Without the key of the receiving machine, no one can then send it messages.
+  :return: The list of encoded messages in the datagram, in the order they were packed.
+  :rtype: list[bytes]
+  '''
+  data = memoryview(data)
+  if data[:1] == _ENCRYPTED_DATAGRAM:
+    if cipher is None:
+      raise errors.InternalError("Received an encrypted datagram without a cipher to decrypt it.")
+    data = memoryview(cipher.decrypt(data[1:]))
+  elif data[:1] == _PLAIN_DATAGRAM:
+    if require_encryption:
+      raise errors.InternalError("Received a datagram that was not encrypted.")
+    data = data[1:]
+  else:
+    raise errors.InternalError("Received a datagram with an unrecognized header.")
+
+  result = []
+  offset = 0
+  while offset < len(data):
+    length, = _FRAME_LENGTH.unpack_from(data, offset)
+    offset += _FRAME_LENGTH.size
+    if offset + length > len(data):
+      raise errors.InternalError("Received a truncated datagram.")
+    result.append(data[offset:offset + length].tobytes())
+    offset += length
+  return result
+
+
+def coalesce(encoded_messages, max_datagram_bytes, cipher=None):
+  '''
+  Group encoded messages into as few datagrams as possible without exceeding a size budget.
+  Messages keep their order.  A message too large to share the budget is sent in a datagram of its own.
+
+  :param list[bytes] encoded_messages: A list of messages, each encoded with a `Codec`.
+  :param int max_datagram_bytes: The budget for the size of each datagram.
+  :param cipher: If provided, encrypt each datagram with this cipher.
+  :type cipher: `SessionCipher`
+  :return: The list of datagrams.
+  :rtype: list[bytes]
+  '''
+  datagrams = []
+  batch = []
+  batch_size = 1 if cipher is None else 1 + _ENCRYPTION_OVERHEAD_BYTES
+  empty_batch_size = batch_size
+  for encoded_message in encoded_messages:
+    size = _FRAME_LENGTH.size + len(encoded_message)
+    if batch and batch_size + size > max_datagram_bytes:
+      datagrams.append(pack_datagram(batch, cipher))
+      batch, batch_size = [], empty_batch_size
+    batch.append(encoded_message)
+    batch_size += size
+
+  if batch:
+    datagrams.append(pack_datagram(batch, cipher))
+
+  return datagrams
+
+
+class DatagramSender(object):
+  '''
+  Sends machine messages over a single long-lived asyncio datagram endpoint.
+
+  Messages are queued as they are sent.  Once per iteration of the event loop, the queue is flushed, and
+  all the messages bound for the same destination are coalesced into as few datagrams as
+  ``max_datagram_bytes`` allows.
+
+  Messages sent before the endpoint is available are held in the queue until `DatagramSender.connection_made`
+  is called.
+  '''
+
+  def __init__(self, wire_codec=None, max_datagram_bytes=None):
+    '''
+    :param wire_codec: The `Codec` used to encode messages.  Defaults to the configured codec.
+    :type wire_codec: `Codec`
+    :param int max_datagram_bytes: The budget for the size of each datagram.
+    '''
+    self._codec = wire_codec if wire_codec is not None else codec.default_codec()
+    self._max_datagram_bytes = max_datagram_bytes if max_datagram_bytes is not None else \
+        settings.UDP_DATAGRAM_BUDGET_BYTES
+
+    self._transport = None
+    self._flush_scheduled = False
+    # Map from each pair (dst, session_key) to the list of encoded messages queued for it, where
+    # dst is the destination pair (host, port) and session_key is None or the key used to encrypt the datagrams.
+    self._queue_by_dst = {}
+
+    self.n_messages = 0
+    '''Number of messages sent.'''
+    self.n_datagrams = 0
+    '''Number of datagrams sent.'''
+
+  def connection_made(self, transport):
+    '''
+    Start sending on an endpoint.
+
+    :param transport: The transport of a bound datagram endpoint.
+    :type transport: `asyncio.DatagramTransport`
+    '''
+    self._transport = transport
+    if self._queue_by_dst:
+      self._schedule_flush()
+
+  def connection_lost(self):
+    '''Stop sending on the current endpoint.  Later messages will be queued.'''
+    self._transport = None
+
+  def send(self, message, dst, session_key=None):
+    '''
+    Queue a machine message to be sent.
+
+    :param object message: A machine message.
+    :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+    :param str session_key: If provided, the session key of the receiving machine.  The datagrams containing
+      the message will be encrypted with it.
+    '''
+    encoded_message = self._codec.encode(message)
+    key = (dst, session_key)
+    if key in self._queue_by_dst:
+      self._queue_by_dst[key].append(encoded_message)
+    else:
+      self._queue_by_dst[key] = [encoded_message]
+    self._schedule_flush()
+
+  def _schedule_flush(self):
+    if not self._flush_scheduled:
+      self._flush_scheduled = True
+      asyncio.get_event_loop().call_soon(self.flush)
+
+  def flush(self):
+    '''Send every queued message.'''
+    self._flush_scheduled = False
+    if self._transport is None:
+      return
+
+    queue_by_dst, self._queue_by_dst = self._queue_by_dst, {}
+    for (dst, session_key), encoded_messages in queue_by_dst.items():
+      cipher = None if session_key is None else session_crypto.session_cipher(session_key)
+      self.n_messages += len(encoded_messages)
+      for datagram in coalesce(encoded_messages, self._max_datagram_bytes, cipher):
+        self.n_datagrams += 1
+        self._transport.sendto(datagram, dst)
+
+
+def api_frames(request_id, message):
+  '''
+  Frame a message for the tcp API of a `MachineRunner`.
+
+  Each frame is a fixed size header (the request id, the length of the frame's body, and flags) followed by
+  the body.  The json serialization of the message is split across as many frames as needed to keep each body
+  within ``settings.MSG_BUFSIZE`` bytes.  Only the last frame has the final flag set.
+
+  :param int request_id: An id that pairs each response with its request.
+  :param object message: A json serializable message.
+  :return: The list of frames.
+  :rtype: list[bytes]
+  '''
+  body = json.dumps(message).encode(messages.ENCODING)
+  chunk_size = settings.MSG_BUFSIZE
+  frames = []
+  for start in range(0, max(len(body), 1), chunk_size):
+    chunk = body[start:start + chunk_size]
+    flags = _API_FLAG_FINAL if start + chunk_size >= len(body) else 0
+    frames.append(_API_FRAME_HEADER.pack(request_id, len(chunk), flags) + chunk)
+  return frames
+
+
+class ApiFrameDecoder(object):
+  '''
+  Incrementally decodes a stream of frames generated by `api_frames`.
+
+  The frames of distinct messages may be interleaved in the stream.
+  '''
+
+  def __init__(self):
+    self._buffer = bytearray()
+    # Map each request id to the list of bodies of the frames received so far for its message.
+    self._partial_bodies = {}
+
+  def feed(self, data):
+    '''
+    Add newly received bytes to the stream.
+
+    :param bytes data: The bytes.
+    :return: The list of pairs (request_id, message) for every message completed by ``data``.
+    :rtype: list
+    '''
+    self._buffer.extend(data)
+    result = []
+    offset = 0
+    while len(self._buffer) - offset >= _API_FRAME_HEADER.size:
+      request_id, length, flags = _API_FRAME_HEADER.unpack_from(self._buffer, offset)
+      start = offset + _API_FRAME_HEADER.size
+      if len(self._buffer) - start < length:
+        break
+      chunk = bytes(self._buffer[start:start + length])
+      offset = start + length
+
+      if flags & _API_FLAG_FINAL:
+        chunks = self._partial_bodies.pop(request_id, [])
+        chunks.append(chunk)
+        result.append((request_id, json.loads(b''.join(chunks).decode(messages.ENCODING))))
+      else:
+        self._partial_bodies.setdefault(request_id, []).append(chunk)
+
+    del self._buffer[:offset]
+    return result
+
+
+class ApiConnection(object):
+  '''
+  A persistent connection to the tcp API of a `MachineRunner`.
+
+  Many requests may be pipelined over the connection.  Each is given a request id, and responses are matched
+  to requests by their ids.
+  '''
+
+  def __init__(self, dst):
+    '''
+    :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+    '''
+    self._sock = socket.create_connection(dst)
+    self._decoder = ApiFrameDecoder()
+    self._next_request_id = 0
+    self._responses = {} # Map each request id to its response, for responses that arrived early.
+
+  def is_open(self):
+    '''
+    :return: False if the connection was closed by either side.
+    :rtype: bool
+    '''
+    if self._sock is None:
+      return False
+
+    try:
+      # A closed connection is readable, and reading from it returns no data.
+      return self._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+    except BlockingIOError:
+      return True
+    except OSError:
+      return False
+
+  def request_many(self, api_messages):
+    '''
+    Send a list of requests without waiting for responses in between, then wait for all the responses.
+
+    :param list api_messages: A list of json serializable API messages.
+    :return: The list of responses, in the same order as ``api_messages``.
+    :rtype: list
+    '''
+    request_ids = []
+    frames = []
+    for api_message in api_messages:
+      request_id = self._next_request_id
+      self._next_request_id = (self._next_request_id + 1) % (1 << 32)
+      request_ids.append(request_id)
+      frames.extend(api_frames(request_id, api_message))
+
+    self._sock.sendall(b''.join(frames))
+
+    outstanding = set(request_ids) - set(self._responses.keys())
+    while outstanding:
+      data = self._sock.recv(settings.MSG_BUFSIZE)
+      if not data:
+        raise errors.InternalError("MachineController closed its tcp API connection before responding.")
+      for request_id, response in self._decoder.feed(data):
+        self._responses[request_id] = response
+        outstanding.discard(request_id)
+
+    return [self._responses.pop(request_id) for request_id in request_ids]
+
+  def close(self):
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+
+
+class ApiConnectionPool(object):
+  '''
+  A pool of idle `ApiConnection` instances, for reusing connections across API calls.
+  '''
+
+  def __init__(self, max_idle_per_dst=4):
+    '''
+    :param int max_idle_per_dst: The maximum number of idle connections to keep open to each destination.
+    '''
+    self._max_idle_per_dst = max_idle_per_dst
+    self._idle_by_dst = {} # Map each destination to the list of its idle connections
+
+  def request(self, api_message, dst):
+    '''
+    Send a single API message and wait for its response.
+
+    :param object api_message: A json serializable API message.
+    :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+    :return: The response.
+    '''
+    return self.request_many([api_message], dst)[0]
+
+  def request_many(self, api_messages, dst):
+    '''
+    Pipeline many API messages to the same destination over a single connection.
+
+    :param list api_messages: A list of json serializable API messages.
+    :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+    :return: The list of responses, in the same order as ``api_messages``.
+    :rtype: list
+    '''
+    connection = self._checkout(dst)
+    try:
+      responses = connection.request_many(api_messages)
+    except Exception:
+      connection.close()
+      raise
+
+    self._checkin(dst, connection)
+    return responses
+
+  def _checkout(self, dst):
+    idle = self._idle_by_dst.get(dst, [])
+    while idle:
+      connection = idle.pop()
+      if connection.is_open():
+        return connection
+      else:
+        connection.close()
+
+    return ApiConnection(dst)
+
+  def _checkin(self, dst, connection):
+    idle = self._idle_by_dst.setdefault(dst, [])
+    if len(idle) < self._max_idle_per_dst:
+      idle.append(connection)
+    else:
+      connection.close()
+
+  def close(self):
+    '''Close all idle connections.'''
+    for idle in self._idle_by_dst.values():
+      for connection in idle:
+        connection.close()
+    self._idle_by_dst = {}
+
+
+_default_api_pool = ApiConnectionPool()
+
+
+def _api_response_data(response):
+  if response['status'] != 'ok':
+    raise errors.InternalError("Failed to communicate over TCP api to MachineController. reason: {}".format(
+        response.get('reason', '')))
+  return response['data']
+
+
+def send_tcp(message, dst, api_pool=None):
+  '''
+  Send a message to the tcp API of a `MachineRunner` and wait for its response.
+
+  :param object message: A json serializable API message.
+  :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+  :param api_pool: The pool of connections to use.  Defaults to a pool shared by the whole process.
+  :type api_pool: `ApiConnectionPool`
+  :return: The data of the response.
+  '''
+  return send_tcp_many([message], dst, api_pool=api_pool)[0]
+
+
+def send_tcp_many(api_messages, dst, api_pool=None):
+  '''
+  Like `send_tcp`, but pipeline many messages to the same destination.
+
+  :param list api_messages: A list of json serializable API messages.
+  :param tuple dst: A pair (host, port) where host is a `str` and port an `int`
+  :param api_pool: The pool of connections to use.  Defaults to a pool shared by the whole process.
+  :type api_pool: `ApiConnectionPool`
+  :return: The list of the data of the responses, in the same order as ``api_messages``.
+  :rtype: list
+  '''
+  api_pool = api_pool if api_pool is not None else _default_api_pool
+  logger.debug(
+      "sending {n_messages} messages to MachineController tcp API on {dst_host}",
+      extra={
+          'n_messages': len(api_messages),
+          'dst_host': dst[0]
+      })
+  responses = api_pool.request_many(api_messages, dst)
+  logger.debug("received MachineController API response messages from {dst_host}", extra={'dst_host': dst[0]})
+  return [_api_response_data(response) for response in responses]
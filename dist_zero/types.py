@@ -70,8 +70,14 @@ class FunctionType(Type):
 
 
 class BasicType(Type):
-  def __init__(self, capnp_state, c_state_type, capnp_transition_type, c_transition_type, apply_transition,
-               nil_transition_c_expression):
+  def __init__(self,
+               capnp_state,
+               c_state_type,
+               capnp_transition_type,
+               c_transition_type,
+               apply_transition,
+               nil_transition_c_expression,
+               combine_transitions=None):
     self.name = f"Basic{_gen_name()}"
     self.capnp_state = capnp_state
     self.c_state_type = c_state_type
@@ -81,6 +87,13 @@ class BasicType(Type):
 
     self._apply_transition = apply_transition
 
+    self.combine_transitions = combine_transitions
+    '''
+    None, or a function combine_transitions(first, second) taking two python transition values and returning the
+    single transition value with the same effect as applying first and then second.
+    Transitions recorded for the same time (see `RecordedUser`) are compacted with it before they are applied.
+    '''
+
     super(BasicType, self).__init__()
 
   def serialize_json(self, serializer):
@@ -99,62 +112,83 @@ class BasicType(Type):
 
 
 apply_plus = lambda transition, stateRvalue: transition + stateRvalue
+
+
+def wrapping_plus(bits, signed):
+  '''
+  :param int bits: The width of an integer type.
+  :param bool signed: Whether the integer type is signed.
+  :return: A combine_transitions function for `BasicType` that adds transitions of the integer type,
+    wrapping around on overflow just as the c code that applies them would.
+  '''
+  modulus = 1 << bits
+  least = -(1 << (bits - 1)) if signed else 0
+  return lambda first, second: (first + second - least) % modulus + least
+
 Int8 = BasicType(
     'Int8',
     c_state_type=cgen.Int8,
     capnp_transition_type='Int8',
     c_transition_type=cgen.Int8,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(8, signed=True))
 Int16 = BasicType(
     'Int16',
     c_state_type=cgen.Int16,
     capnp_transition_type='Int16',
     c_transition_type=cgen.Int16,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(16, signed=True))
 Int32 = BasicType(
     'Int32',
     c_state_type=cgen.Int32,
     capnp_transition_type='Int32',
     c_transition_type=cgen.Int32,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(32, signed=True))
 Int64 = BasicType(
     'Int64',
     c_state_type=cgen.Int64,
     capnp_transition_type='Int64',
     c_transition_type=cgen.Int64,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(64, signed=True))
 UInt8 = BasicType(
     'UInt8',
     c_state_type=cgen.UInt8,
     capnp_transition_type='UInt8',
     c_transition_type=cgen.UInt8,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(8, signed=False))
 UInt16 = BasicType(
     'UInt16',
     c_state_type=cgen.UInt16,
     capnp_transition_type='UInt16',
     c_transition_type=cgen.UInt16,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(16, signed=False))
 UInt32 = BasicType(
     'UInt32',
     c_state_type=cgen.UInt32,
     capnp_transition_type='UInt32',
     c_transition_type=cgen.UInt32,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(32, signed=False))
 UInt64 = BasicType(
     'UInt64',
     c_state_type=cgen.UInt64,
     capnp_transition_type='UInt64',
     c_transition_type=cgen.UInt64,
     apply_transition=apply_plus,
-    nil_transition_c_expression=cgen.Zero)
+    nil_transition_c_expression=cgen.Zero,
+    combine_transitions=wrapping_plus(64, signed=False))
 
 
 class Product(Type):
@@ -0,0 +1,87 @@
+import logging
+
+from dist_zero import channel, messages
+
+logger = logging.getLogger(__name__)
+
+
+class _FakeController(object):
+  '''Stands in for a `NodeManager` with a channel to one other fake controller.'''
+
+  def __init__(self, machine_id, network):
+    self.id = machine_id
+    self.now_ms = 0
+    self._network = network
+    self._network[machine_id] = self
+    self.delivered = []
+    self.lose = lambda message: False
+    self.n_copies = 1
+
+  def connect(self, machine_id):
+    self.channel = channel.MachineChannel(
+        controller=self,
+        machine_id=machine_id,
+        send_to_machine=self.send_to_machine,
+        transport=messages.machine.ip_transport(self.id),
+        deliver=self.delivered.append)
+
+  def send_to_machine(self, message, transport):
+    if not self.lose(message):
+      for i in range(self.n_copies):
+        self._network[transport['host']].channel.receive(message)
+
+
+def _deliver_to_node(node_id, i):
+  return messages.machine.machine_deliver_to_node(
+      node_id=node_id, message=messages.data.input_action(i), sending_node_id='sender')
+
+
+def test_channel_multiplexes_nodes():
+  network = {}
+  a, b = _FakeController('a', network), _FakeController('b', network)
+  a.connect('b')
+  b.connect('a')
+
+  lost = []
+
+  def lose_first_message_for_node_1(message):
+    if message['value']['type'] == 'receive' and message['value']['message']['node_id'] == 'node_1' and not lost:
+      lost.append(message)
+      return True
+    return False
+
+  a.lose = lose_first_message_for_node_1
+  sent = [_deliver_to_node('node_{}'.format(i % 3), i) for i in range(9)]
+  for message in sent:
+    a.channel.send(message, transport=messages.machine.ip_transport('b'))
+
+  # The lost message holds back no other message, not even those for its own node, which reorders them itself.
+  assert b.delivered == [message for message in sent if message is not sent[1]]
+
+  # The receiver reports what it holds in its next batch of acknowledgements, and only the lost message is resent.
+  for now_ms in (25, 50):
+    b.now_ms = now_ms
+    b.channel.elapse()
+  assert sorted(b.delivered, key=sent.index) == sent
+  assert b.delivered[-1] is sent[1]
+  assert a.channel.stats()['n_retransmissions'] == 1
+
+  # A single acknowledgement covers the messages of all the nodes.
+  for now_ms in (75, 100):
+    b.now_ms = now_ms
+    b.channel.elapse()
+  assert a.channel.stats()['acknowledged_messages'] == len(sent)
+
+
+def test_channel_delivers_duplicates_once():
+  network = {}
+  a, b = _FakeController('a', network), _FakeController('b', network)
+  a.connect('b')
+  b.connect('a')
+
+  a.n_copies = 2
+  sent = [_deliver_to_node('node_{}'.format(i % 2), i) for i in range(4)]
+  for message in sent:
+    a.channel.send(message, transport=messages.machine.ip_transport('b'))
+
+  assert b.delivered == sent
@@ -0,0 +1,69 @@
+import collections
+
+import pytest
+
+from dist_zero import codec, messages
+
+
+@pytest.mark.parametrize('wire_codec', [codec.JsonCodec(), codec.BinaryCodec()])
+def test_envelope_roundtrip(wire_codec):
+  payload = wire_codec.encode_payload(messages.data.input_action(3))
+  envelope = messages.machine.machine_deliver_to_node(node_id='node_a', message=payload, sending_node_id='node_b')
+
+  decoded = wire_codec.decode(wire_codec.encode(envelope))
+  assert decoded == envelope
+  assert wire_codec.decode_payload(decoded['message']) == messages.data.input_action(3)
+
+
+@pytest.mark.parametrize('wire_codec', [codec.JsonCodec(), codec.BinaryCodec()])
+def test_plain_envelopes(wire_codec):
+  envelope = messages.machine.machine_deliver_to_node(
+      node_id='node_a', message=messages.data.input_action(3), sending_node_id=None)
+  assert wire_codec.decode(wire_codec.encode(envelope)) == envelope
+
+  start_node = messages.machine.machine_start_node({'id': 'node_a', 'type': 'DataNode'})
+  assert wire_codec.decode(wire_codec.encode(start_node)) == start_node
+
+
+@pytest.mark.parametrize('wire_codec', [codec.JsonCodec(), codec.BinaryCodec()])
+def test_bytes_in_payloads(wire_codec):
+  message = {'type': 'net_outputs', 'outputs': {'a': b'\x00\x01capnp', 'b': [b'', b'\xff' * 300]}}
+  assert wire_codec.decode_payload(wire_codec.encode_payload(message)) == message
+
+
+def test_binary_payload_is_not_escaped():
+  opaque = bytes(range(256)) * 4
+  wire_codec = codec.BinaryCodec()
+  envelope = messages.machine.machine_deliver_to_node(node_id='node_a', message=opaque, sending_node_id='node_b')
+  encoded = wire_codec.encode(envelope)
+
+  assert opaque in encoded
+  assert len(encoded) < len(opaque) + 64
+
+
+@pytest.mark.parametrize('wire_codec', [codec.JsonCodec(), codec.BinaryCodec()])
+def test_payload_values(wire_codec):
+  message = {
+      'type': 'values',
+      'ints': [0, -1, 2**40, -2**63, 2**63, -2**80],
+      'floats': [0.5, -1e300],
+      'flags': [True, False, None],
+      'text': 'caf\u00e9',
+      'nested': {
+          'a': [{}, []],
+          'b': ('x', 1)
+      },
+      3: 'int key',
+  }
+  decoded = wire_codec.decode_payload(wire_codec.encode_payload(message))
+  assert decoded['nested']['b'] == ['x', 1]
+  assert decoded['3'] == 'int key'
+  for key in ['type', 'ints', 'floats', 'flags', 'text']:
+    assert decoded[key] == message[key]
+
+
+@pytest.mark.parametrize('wire_codec', [codec.JsonCodec(), codec.BinaryCodec()])
+def test_namedtuple_roundtrip(wire_codec):
+  Point = collections.namedtuple('Point', ['x', 'y'])
+  decoded = wire_codec.decode(wire_codec.encode({'type': 'foo', 'x': Point(1, 2)}))
+  assert decoded == {'type': 'foo', 'x': [1, 2]}
@@ -0,0 +1,86 @@
+from dist_zero import messages
+from dist_zero.node.data.kids import DataNodeKids
+
+
+class _FakeController(object):
+  def __init__(self):
+    self.system_config = messages.machine.std_system_config()
+
+
+def _handle(kid_id):
+  return {'id': kid_id, 'controller_id': 'machine', 'transport': None, 'session_key': None}
+
+
+def _summary(n_kids, messages_per_second=0):
+  return messages.data.kid_summary(
+      size=n_kids, n_kids=n_kids, availability=0, messages_per_second=messages_per_second, height=1)
+
+
+def _least_mergeable_total_by_scanning(kids, limit):
+  kid_ids = list(kids)
+  pairs = [(kids.summaries[left]['n_kids'] + kids.summaries[right]['n_kids'], left, right)
+           for left, right in zip(kid_ids, kid_ids[1:])
+           if kids.summaries[left]['n_kids'] <= limit and kids.summaries[right]['n_kids'] <= limit]
+  return min(pairs)[0] if pairs else None
+
+
+def test_mergeable_pairs_follow_updates():
+  kids = DataNodeKids(0.0, 1.0, controller=_FakeController())
+  limit = kids._mergeable_n_kids
+  n_kids = [limit + 10, 3, 60, 2, limit + 1, 1, 65]
+  for i, n in enumerate(n_kids):
+    kids.add_kid(_handle(f'kid_{i}'), interval=[i / 10, (i + 1) / 10], summary=_summary(n))
+
+  def best_total():
+    pair = kids.best_mergeable_pair(())
+    if pair is None:
+      return None
+    return kids.summaries[pair[0]]['n_kids'] + kids.summaries[pair[1]]['n_kids']
+
+  assert best_total() == _least_mergeable_total_by_scanning(kids, limit) == 62
+  assert kids.disjoint_mergeable_pairs(()) == [('kid_2', 'kid_3'), ('kid_5', 'kid_6')]
+  assert kids.best_mergeable_pair({'kid_3'}) == ('kid_1', 'kid_2')
+
+  kids.set_summary('kid_4', _summary(0))
+  assert kids.best_mergeable_pair(()) == ('kid_4', 'kid_5')
+
+  kids.merge_right('kid_4')
+  kids.set_summary('kid_5', _summary(1))
+  assert kids.best_mergeable_pair(()) == ('kid_3', 'kid_5')
+
+  kids.split('kid_2', 0.25, _handle('kid_new'), kid_summary=_summary(0), new_kid_summary=_summary(0))
+  assert kids.best_mergeable_pair(()) == ('kid_2', 'kid_new')
+
+  kids.remove_kid('kid_new')
+  assert kids.best_mergeable_pair(()) == ('kid_2', 'kid_3')
+  assert best_total() == _least_mergeable_total_by_scanning(kids, limit)
+
+
+def test_summary_totals_follow_updates():
+  kids = DataNodeKids(0.0, 1.0, controller=_FakeController())
+  for i, n in enumerate([5, 2, 7]):
+    kids.add_kid(_handle(f'kid_{i}'), interval=[i / 10, (i + 1) / 10], summary=_summary(n))
+  assert kids.total_size == 14
+  assert kids.smallest_kid_id() == 'kid_1'
+
+  kids.set_summary('kid_1', _summary(9))
+  kids.split('kid_0', 0.05, _handle('kid_new'), kid_summary=_summary(3), new_kid_summary=_summary(1))
+  assert kids.total_size == sum(summary['size'] for summary in kids.summaries.values()) == 20
+  assert kids.smallest_kid_id() == 'kid_new'
+
+  kids.merge_right('kid_new')
+  kids.remove_kid('kid_0')
+  assert kids.total_size == 16
+  assert kids.smallest_kid_id() == 'kid_2'
+
+
+def test_shrink_right_balances_load():
+  kids = DataNodeKids(0.0, 1.0, controller=_FakeController())
+  for i, rate in enumerate([10, 20, 5, 5, 40, 30]):
+    kids.add_kid(_handle(f'kid_{i}'), interval=[i / 10, (i + 1) / 10], summary=_summary(2, messages_per_second=rate))
+
+  # Splitting by count would keep kid_0 through kid_2, with only a third of the load.
+  mid, leaving_kids = kids.shrink_right(by_load=True)
+  assert mid == 0.4
+  assert [kid['id'] for kid in leaving_kids] == ['kid_4', 'kid_5']
+  assert kids.total_messages_per_second == 40
@@ -0,0 +1,22 @@
+from dist_zero import deltas
+
+
+def test_pop_deltas_before():
+  d = deltas.Deltas()
+  d.add_sender('a')
+  d.add_sender('b')
+  for i in range(5):
+    d.add_message('a', i, ('a', i))
+  for i in range(3):
+    d.add_message('b', i, ('b', i))
+
+  assert not d.has_data(before={'a': 0, 'b': 0})
+  assert d.pop_deltas(before={'a': 2}) == [('a', 0), ('a', 1), ('b', 0), ('b', 1), ('b', 2)]
+  assert d.first_unseen_rsn('b') == 3
+
+  # Deltas that an unfinished generator did not generate are left in place.
+  generator = d.iter_deltas()
+  assert next(generator) == ('a', 2)
+  generator.close()
+  assert d.pop_deltas() == [('a', 3), ('a', 4)]
+  assert not d.has_data()
@@ -0,0 +1,44 @@
+from dist_zero import messages
+from dist_zero.node.data.summary import KidSummaryReporter
+
+
+class _FakeNode(object):
+  def __init__(self):
+    self.system_config = messages.machine.std_system_config()
+    self._parent = {'id': 'parent'}
+    self.sent = []
+
+  def send(self, receiver, message):
+    self.sent.append(message)
+
+
+def _summary(size, messages_per_second):
+  return messages.data.kid_summary(
+      size=size, n_kids=size, availability=10, messages_per_second=messages_per_second, height=1)
+
+
+def test_reports_only_significant_changes():
+  node = _FakeNode()
+  reporter = KidSummaryReporter(node)
+
+  reporter.report(_summary(size=3, messages_per_second=100.0))
+  assert node.sent == [_summary(size=3, messages_per_second=100.0)]
+
+  # Small changes in the message rate are held back until they add up.
+  reporter.report(_summary(size=3, messages_per_second=110.0))
+  reporter.report(_summary(size=3, messages_per_second=95.0))
+  assert len(node.sent) == 1
+  reporter.report(_summary(size=3, messages_per_second=125.0))
+  assert node.sent[-1] == messages.data.kid_summary_delta({'messages_per_second': 125.0})
+
+  # Any change in size is significant, and only the changed fields are sent.
+  reporter.report(_summary(size=4, messages_per_second=130.0))
+  assert node.sent[-1] == messages.data.kid_summary_delta({'size': 4, 'n_kids': 4})
+
+  reporter.report(_summary(size=4, messages_per_second=131.0), flush=True)
+  assert node.sent[-1] == messages.data.kid_summary_delta({'messages_per_second': 131.0})
+
+  # A new parent gets the whole summary.
+  node._parent = {'id': 'new_parent'}
+  reporter.report(_summary(size=4, messages_per_second=131.0))
+  assert node.sent[-1] == _summary(size=4, messages_per_second=131.0)
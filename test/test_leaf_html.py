@@ -1,7 +1,6 @@
 import pytest
-from cryptography.fernet import Fernet
 
-from dist_zero import messages, ids
+from dist_zero import messages, ids, session_crypto
 from dist_zero.node.data import leaf_html
 
 
@@ -11,7 +10,7 @@ def leaf_config(request):
       'id': ids.new_id('DataNode_test'),
       'controller_id': ids.new_id('MachineController_test'),
       'transport': messages.machine.ip_transport('127.0.0.1'),
-      'fernet_key': Fernet.generate_key().decode(messages.ENCODING),
+      'session_key': session_crypto.new_session_key(),
   }
   return messages.data.data_node_config(
       node_id=ids.new_id('LeafNode_test'),
@@ -0,0 +1,247 @@
+import logging
+
+from dist_zero import exporter, importer, linker, messages
+
+logger = logging.getLogger(__name__)
+
+
+class _FakeController(object):
+  def __init__(self):
+    self.now_ms = 0
+
+
+class _FakeNode(object):
+  '''Stands in for a `Node` with a `Linker`, and delivers its sequence messages directly to other fake nodes.'''
+
+  def __init__(self, node_id, network):
+    self.id = node_id
+    self._controller = _FakeController()
+    self._network = network
+    self._network[node_id] = self
+    self.least_unused_sequence_number = 0
+    self.delivered = []
+    self.linker = linker.Linker(self, logger=logger, deliver=self.deliver)
+
+  def handle(self):
+    return {'id': self.id, 'controller_id': 'machine', 'transport': None, 'session_key': None}
+
+  def send(self, receiver, message):
+    self._network[receiver['id']].linker.receive_sequence_message(message['value'], self.id)
+
+  def deliver(self, message, sequence_number, sender_id):
+    self.delivered.append(message)
+    self.linker.advance_sequence_number()
+
+
+def test_exporter_respects_receive_window(monkeypatch):
+  monkeypatch.setattr(importer.Importer, 'RECEIVE_WINDOW', 4)
+  network = {}
+  sender, receiver, downstream = _FakeNode('sender', network), _FakeNode('receiver', network), \
+      _FakeNode('downstream', network)
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+  receiver_exporter = receiver.linker.new_exporter(downstream.handle())
+  downstream.linker.new_importer(receiver.handle())
+
+  # The downstream node advertises an empty window, so the receiver becomes backpressured.
+  receiver_exporter.acknowledge(0, window=0)
+  receiver_exporter.export_message(messages.data.input_action(0), receiver.linker.advance_sequence_number())
+  assert receiver.linker.is_backpressured()
+  assert receiver.linker.receive_window() == 0
+  assert downstream.delivered == []
+
+  for i in range(10):
+    sender_exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+  assert len(receiver.delivered) == 4
+  assert sender.linker.is_backpressured()
+
+  # Nothing the receiver has delivered is acknowledged downstream, so it can not acknowledge anything either.
+  receiver.linker.send_acknowledgement_messages()
+  assert len(receiver.delivered) == 4
+
+  # Once the downstream window opens, acknowledgements flow back and the sender continues.
+  receiver_exporter.acknowledge(0, window=4)
+  assert downstream.delivered == [messages.data.input_action(0)]
+  downstream.linker.send_acknowledgement_messages()
+  assert not receiver.linker.is_backpressured()
+  receiver.linker.send_acknowledgement_messages()
+  assert receiver.delivered == [messages.data.input_action(i) for i in range(8)]
+
+  receiver.linker.send_acknowledgement_messages()
+  assert receiver.delivered == [messages.data.input_action(i) for i in range(10)]
+  assert not sender.linker.is_backpressured()
+
+
+def test_blocked_exporter_probes_window():
+  network = {}
+  sender, receiver = _FakeNode('sender', network), _FakeNode('receiver', network)
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+
+  sender_exporter.acknowledge(0, window=0)
+  sender_exporter.export_message(messages.data.input_action(0), sender.linker.advance_sequence_number())
+  assert receiver.delivered == []
+
+  sender._controller.now_ms = exporter.Exporter.PENDING_EXPIRATION_TIME_MS
+  sender_exporter.retransmit_expired_pending_messages()
+  assert receiver.delivered == [messages.data.input_action(0)]
+
+
+def test_retransmission_timeout_adapts_to_round_trips():
+  network = {}
+  sender, receiver = _FakeNode('sender', network), _FakeNode('receiver', network)
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+  assert sender_exporter.retransmission_stats()['rto_ms'] == exporter.Exporter.PENDING_EXPIRATION_TIME_MS
+
+  for i in range(20):
+    sender_exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+    sender._controller.now_ms += 40
+    receiver.linker.send_acknowledgement_messages()
+
+  stats = sender_exporter.retransmission_stats()
+  assert stats['srtt_ms'] == 40
+  assert stats['rto_ms'] < 100
+
+  # Lose the next message.  It is retransmitted after the short timeout, which then backs off.
+  sender.send = lambda receiver, message: None
+  sender_exporter.export_message(messages.data.input_action(20), sender.linker.advance_sequence_number())
+  sender._controller.now_ms += stats['rto_ms']
+  sender_exporter.retransmit_expired_pending_messages()
+  assert sender.linker.n_retransmissions == 1
+  assert sender_exporter.retransmission_stats()['rto_ms'] == 2 * stats['rto_ms']
+
+
+def test_only_gaps_are_retransmitted():
+  network = {}
+  sender, receiver = _FakeNode('sender', network), _FakeNode('receiver', network)
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+
+  send = sender.send
+  lost = []
+
+  def lossy_send(receiver, message):
+    if message['value']['sequence_number'] == 2 and not lost:
+      lost.append(message)
+    else:
+      send(receiver, message)
+
+  sender.send = lossy_send
+  for i in range(10):
+    sender_exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+  assert len(receiver.delivered) == 2
+
+  # The receiver reports what it holds, and the sender retransmits only the missing message.
+  receiver.linker.send_acknowledgement_messages()
+  assert sender.linker.n_retransmissions == 1
+  assert receiver.delivered == [messages.data.input_action(i) for i in range(10)]
+
+  receiver.linker.send_acknowledgement_messages()
+  assert not sender_exporter.has_pending_messages()
+
+
+def test_reliable_exporters_never_retransmit():
+  network = {}
+  sender, receiver = _FakeNode('sender', network), _FakeNode('receiver', network)
+  sender.linker = linker.Linker(sender, logger=logger, deliver=sender.deliver, reliable=lambda handle: True)
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+
+  for i in range(10):
+    sender_exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+  assert len(receiver.delivered) == 10
+
+  # Acknowledgements are late, but the layer below is trusted to have delivered the messages.
+  sender._controller.now_ms = 10 * exporter.Exporter.MAX_RETRANSMISSION_TIMEOUT_MS
+  assert sender.linker.ms_until_deadline() is None
+  sender.linker.elapse(sender._controller.now_ms)
+  assert sender.linker.n_retransmissions == 0
+
+  # Acknowledgements are still tracked.
+  receiver.linker.send_acknowledgement_messages()
+  assert not sender_exporter.has_pending_messages()
+  assert sender.linker.least_unacknowledged_sequence_number() == 10
+
+
+def test_exporter_resends_pending_messages_when_it_becomes_reliable():
+  network = {}
+  sender, receiver = _FakeNode('sender', network), _FakeNode('receiver', network)
+  sender.linker = linker.Linker(
+      sender, logger=logger, deliver=sender.deliver, reliable=lambda handle: handle['controller_id'] != 'machine')
+  sender_exporter = sender.linker.new_exporter(receiver.handle())
+  receiver.linker.new_importer(sender.handle())
+  assert not sender_exporter.reliable
+
+  send = sender.send
+
+  def lossy_send(receiver, message):
+    if message['value']['sequence_number'] not in (3, 4):
+      send(receiver, message)
+
+  sender.send = lossy_send
+  for i in range(6):
+    sender_exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+  sender.send = send
+  assert len(receiver.delivered) == 3
+  receiver.linker.send_acknowledgement_messages()
+  assert sender.linker.n_retransmissions == 0
+
+  # The receiver moves to another machine.  Only the lost messages are sent again, as nothing will retransmit them.
+  sender.linker.switch_handle(dict(receiver.handle(), controller_id='other_machine'))
+  assert sender_exporter.reliable
+  assert sender.linker.n_retransmissions == 2
+  assert receiver.delivered == [messages.data.input_action(i) for i in range(6)]
+
+
+def test_acknowledgements_are_piggybacked():
+  network = {}
+  left, right = _FakeNode('left', network), _FakeNode('right', network)
+  left_exporter, right_exporter = left.linker.new_exporter(right.handle()), right.linker.new_exporter(left.handle())
+  left.linker.new_importer(right.handle())
+  right.linker.new_importer(left.handle())
+
+  sent = []
+  for node in (left, right):
+    node.send = lambda receiver, message, send=node.send: sent.append(message) or send(receiver, message)
+
+  for i in range(10):
+    left_exporter.export_message(messages.data.input_action(i), left.linker.advance_sequence_number())
+    right_exporter.export_message(messages.data.input_action(i), right.linker.advance_sequence_number())
+
+  assert all(message['value']['type'] == 'receive' for message in sent)
+  # Every message but the first carries an acknowledgement of the message before it.
+  assert sum(1 for message in sent if 'acknowledgement' in message['value']) == 19
+  assert not left_exporter.has_pending_messages()
+
+  # Only the last message needs an acknowledgement of its own.
+  left.linker.send_acknowledgement_messages()
+  assert sent[-1]['value']['type'] == 'acknowledge'
+  assert not right_exporter.has_pending_messages()
+
+
+def test_branching_records_only_changes():
+  network = {}
+  receiver = _FakeNode('receiver', network)
+  senders = [_FakeNode('sender_{}'.format(i), network) for i in range(3)]
+  exporters = [sender.linker.new_exporter(receiver.handle()) for sender in senders]
+  for sender in senders:
+    receiver.linker.new_importer(sender.handle())
+  downstream = _FakeNode('downstream', network)
+  downstream.send = lambda receiver, message: None # Never acknowledge anything downstream.
+  receiver_exporter = receiver.linker.new_exporter(downstream.handle())
+  downstream.linker.new_importer(receiver.handle())
+
+  receiver_exporter.export_message(messages.data.input_action(0), receiver.linker.advance_sequence_number())
+  for i in range(4):
+    exporters[0].export_message(messages.data.input_action(i), senders[0].linker.advance_sequence_number())
+
+  # Only the first entry records the new importers.  Later entries record only the importer that delivered.
+  entries = receiver.linker._branching.entries()
+  assert [len(changes) for sequence_number, changes in entries] == [3, 1, 1, 1, 1]
+
+  receiver.linker.remove_importers({'sender_0'})
+  receiver_exporter.acknowledge(1)
+  receiver.linker.send_acknowledgement_messages()
+  assert receiver.linker._branching.entries() == []
+  assert not receiver.linker.is_backpressured()
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from dist_zero import linker, machine, messages, spawners
+from dist_zero.node import migration
+from dist_zero.node.node import Node
+from dist_zero.spawners.simulator import SimulatedSpawner
+
+logger = logging.getLogger(__name__)
+
+
+class _FakeController(object):
+  def __init__(self, now_ms):
+    self.now_ms = now_ms
+
+
+class _FakeNode(object):
+  def __init__(self, node_id, now_ms):
+    self.id = node_id
+    self._controller = _FakeController(now_ms)
+    self.least_unused_sequence_number = 0
+    self.sent = []
+    self.delivered = []
+    self.linker = linker.Linker(self, logger=logger, deliver=self.deliver)
+
+  def send(self, receiver, message):
+    self.sent.append((receiver['id'], message))
+
+  def deliver(self, message, sequence_number, sender_id):
+    self.delivered.append(message)
+
+
+def _handle(node_id, controller_id):
+  return {'id': node_id, 'controller_id': controller_id, 'transport': None, 'session_key': None}
+
+
+def test_linker_snapshot_roundtrip():
+  old = _FakeNode('node', now_ms=5000)
+  old.linker.new_importer(_handle('sender', 'machine_a'))
+  exporter = old.linker.new_exporter(_handle('receiver', 'machine_a'))
+  for i in range(3):
+    exporter.export_message(messages.data.input_action(i), old.linker.advance_sequence_number())
+  exporter.acknowledge(1)
+
+  # The message with sequence number 1 arrives before the one with sequence number 0.
+  old.linker.receive_sequence_message(
+      messages.linker.sequence_message_send(messages.data.input_action(10), 1)['value'], 'sender')
+
+  old._controller.now_ms = 5500
+  snapshot = json.loads(json.dumps(old.linker.snapshot()))
+
+  new = _FakeNode('node', now_ms=100)
+  new.least_unused_sequence_number = old.least_unused_sequence_number
+  new.linker.restore(snapshot)
+  new_exporter = new.linker._exporters['receiver']
+
+  assert new.linker.least_unacknowledged_sequence_number() == 1
+  assert new_exporter.ms_until_expiration() == exporter.ms_until_expiration()
+
+  new.linker.receive_sequence_message(
+      messages.linker.sequence_message_send(messages.data.input_action(9), 0)['value'], 'sender')
+  assert new.delivered == [messages.data.input_action(9), messages.data.input_action(10)]
+
+  new_exporter.acknowledge(3)
+  assert new.linker.least_unacknowledged_sequence_number() == 3
+
+
+def test_linker_switch_handle():
+  node = _FakeNode('node', now_ms=0)
+  node.linker.new_importer(_handle('neighbor', 'machine_a'))
+  node.linker.new_exporter(_handle('neighbor', 'machine_a'))
+
+  node.linker.switch_handle(_handle('neighbor', 'machine_b'))
+  assert [handle['controller_id'] for handle in node.linker.handles()] == ['machine_b', 'machine_b']
+
+
+class _FakeSpawner(object):
+  def sleep_ms(self, ms):
+    # Periodic tasks never run.  The test elapses time itself.
+    return asyncio.get_event_loop().create_future()
+
+
+def _node_manager(machine_id, node_managers, mode=spawners.MODE_SIMULATED):
+  def send_to_machine(message, transport):
+    asyncio.get_event_loop().call_soon(node_managers[transport['host']].handle_message, message)
+
+  node_managers[machine_id] = machine.NodeManager(
+      machine_config={
+          'id': machine_id,
+          'machine_name': machine_id,
+          'mode': mode,
+          'system_config': messages.machine.std_system_config(),
+          'random_seed': 1,
+          'network_errors_config': {'incomming': {}, 'outgoing': {}},
+          'system_id': 'system',
+      },
+      spawner=_FakeSpawner(),
+      ip_host=machine_id,
+      send_to_machine=send_to_machine)
+  return node_managers[machine_id]
+
+
+@pytest.mark.asyncio
+async def test_forwarding_to_migrated_node_expires():
+  node_managers = {}
+  old, new = _node_manager('old', node_managers), _node_manager('new', node_managers)
+  old._load_table.learn_peer('new', messages.machine.ip_transport('new'))
+
+  def locate(node_manager):
+    return node_manager.handle_api_message(messages.machine.locate_node('node'))['data']
+
+  node = old.start_node(messages.link.link_node_config('node', False, False, 'link_key', 0))
+  old.migrate_node(
+      node, 'new', migration.add_snapshot_to_node_config(node.migration_node_config(), node.snapshot()))
+  await asyncio.sleep(0.01)
+  assert locate(old) == 'new' and locate(new) == 'new'
+  await new.clean_all()
+
+  # Each message still sent to the old machine keeps it forwarding for a while longer.
+  forwarding_ms = messages.machine.std_system_config()['MIGRATION_FORWARDING_MS']
+  old.elapse_nodes(forwarding_ms // 2)
+  old.handle_message(messages.machine.machine_deliver_to_node('node', messages.data.input_action(1), None))
+  old.elapse_nodes(forwarding_ms // 2 + 1)
+  assert locate(old) == 'new'
+
+  old.elapse_nodes(forwarding_ms // 2)
+  assert locate(old) is None
+  assert not old._migrated_node_by_id
+  await old.clean_all()
+
+
+@pytest.mark.asyncio
+async def test_spawned_node_receives_messages_that_overtake_its_start(monkeypatch):
+  node_managers = {}
+  a, b = _node_manager('a', node_managers), _node_manager('b', node_managers)
+  a._load_table.learn_peer('b', messages.machine.ip_transport('b'))
+  monkeypatch.setattr(a._placement_policy, 'choose', lambda node_config, load_table: 'b')
+
+  # A message for the new node reaches its machine before the node starts.
+  message = messages.transaction.transaction_message('transaction', messages.data.input_action(1))
+  b.handle_message(messages.machine.machine_deliver_to_node('node', message, 'sender'))
+  assert b.n_nodes == 0
+
+  a.spawn_node(messages.link.link_node_config('node', False, False, 'link_key', 0))
+  await asyncio.sleep(0.01)
+  assert b.get_node_by_id('node')._postponed_transaction_messages['transaction'] == \
+      [(messages.data.input_action(1), 'sender')]
+  assert not b._held_deliveries_by_node_id
+
+  # Messages for nodes that never start are eventually dropped.
+  b.handle_message(messages.machine.machine_deliver_to_node('missing_node', message, 'sender'))
+  b.elapse_nodes(messages.machine.std_system_config()['UNSTARTED_NODE_HOLD_MS'] + 1)
+  assert not b._held_deliveries_by_node_id
+  await a.clean_all()
+  await b.clean_all()
+
+
+class _CountingNode(Node):
+  '''A migratable node that records the numbers of the input actions its senders export to it.'''
+
+  def __init__(self, node_id, controller):
+    self.id = node_id
+    self._controller = controller
+    self.received = []
+    super(_CountingNode, self).__init__(logger)
+
+  def migration_node_config(self):
+    return {'type': '_CountingNode', 'id': self.id}
+
+  def _snapshot_state(self):
+    return {'received': self.received}
+
+  def _restore_state(self, state):
+    self.received = state['received']
+
+  def deliver(self, message, sequence_number, sender_id):
+    self.received.append((sender_id, message['number']))
+    self.linker.advance_sequence_number()
+
+  def elapse(self, ms):
+    self.linker.elapse(ms)
+
+
+def _allow_counting_nodes(monkeypatch):
+  parse_node_config_without_role = machine.NodeManager._parse_node_config_without_role
+
+  def _parse_node_config(node_manager, node_config):
+    if node_config['type'] == '_CountingNode':
+      return _CountingNode(node_config['id'], controller=node_manager)
+    else:
+      return parse_node_config_without_role(node_manager, node_config)
+
+  monkeypatch.setattr(machine.NodeManager, '_parse_node_config_without_role', _parse_node_config)
+
+
+@pytest.mark.asyncio
+async def test_local_messages_do_not_share_data_with_their_sender(monkeypatch):
+  _allow_counting_nodes(monkeypatch)
+  node_manager = _node_manager('a', {}, mode=spawners.MODE_VIRTUAL)
+  sender = node_manager.start_node({'type': '_CountingNode', 'id': 'sender'})
+  receiver = node_manager.start_node({'type': '_CountingNode', 'id': 'receiver'})
+  exporter = sender.linker.new_exporter(receiver.new_handle(sender.id))
+  receiver.linker.new_importer(sender.new_handle(receiver.id))
+
+  message = messages.data.input_action(1)
+  exporter.export_message(message, sender.linker.advance_sequence_number())
+  # The sender changes the message after sending it, before it is delivered.
+  message['number'] = 2
+  await asyncio.sleep(0.01)
+  assert receiver.received == [('sender', 1)]
+  await node_manager.clean_all()
+
+
+@pytest.mark.asyncio
+async def test_migrate_node_while_messages_are_in_flight(monkeypatch):
+  _allow_counting_nodes(monkeypatch)
+
+  # Drop some of the input actions, whether they go to another machine or stay on the same one.
+  network_errors_config = messages.machine.std_simulated_network_errors_config()
+  network_errors_config['outgoing']['drop'] = {'rate': 0.1, 'regexp': '.*input_action.*'}
+  spawner = SimulatedSpawner(system_id='system', random_seed='test_migrate_node_while_messages_are_in_flight')
+  spawner.start()
+  node_managers = []
+  for machine_id in ['a', 'b', 'c']:
+    machine_config = messages.machine.machine_config(
+        machine_controller_id=machine_id,
+        machine_name=machine_id,
+        system_id='system',
+        mode=spawners.MODE_SIMULATED,
+        network_errors_config=network_errors_config,
+        system_config=messages.machine.std_system_config(),
+        random_seed=machine_id)
+    node_managers.append(spawner.get_machine_by_id(await spawner.create_machine(machine_config)))
+  a, b, c = node_managers
+  a._load_table.learn_peer('b', messages.machine.ip_transport('b', session_key=b._session_key))
+
+  # The receiver starts on the same machine as one sender, and on a different machine from the other.
+  receiver = a.start_node({'type': '_CountingNode', 'id': 'receiver'})
+  senders = [
+      a.start_node({'type': '_CountingNode', 'id': 'local_sender'}),
+      c.start_node({'type': '_CountingNode', 'id': 'remote_sender'}),
+  ]
+  exporters = []
+  for sender in senders:
+    exporters.append(sender.linker.new_exporter(receiver.new_handle(sender.id)))
+    receiver.linker.new_importer(sender.new_handle(receiver.id))
+
+  n_messages = 60
+  for i in range(n_messages):
+    if i == n_messages // 3:
+      a.handle_api_message(messages.machine.api_node_message('receiver', messages.machine.migrate_node('b')))
+    for sender, exporter in zip(senders, exporters):
+      exporter.export_message(messages.data.input_action(i), sender.linker.advance_sequence_number())
+    await spawner.run_for(ms=15)
+  await spawner.run_for(ms=20 * 1000)
+
+  assert a.n_nodes == 1 and b.n_nodes == 1
+  moved_receiver = b.get_node_by_id('receiver')
+  for sender in senders:
+    assert [number for sender_id, number in moved_receiver.received if sender_id == sender.id] == \
+        list(range(n_messages))
+    assert sender.linker.least_unacknowledged_sequence_number() == n_messages
+  await spawner.clean_all()
@@ -0,0 +1,46 @@
+from random import Random
+
+import pytest
+
+from dist_zero import errors, messages, network_errors
+
+
+def _sequence_message(message):
+  return messages.linker.sequence_message_send(message=message, sequence_number=3)
+
+
+def test_match_nested_types():
+  matcher = network_errors.Matcher(types=['increment'])
+  assert matcher.matches(_sequence_message(messages.sum.increment(2)))
+  assert not matcher.matches(_sequence_message(messages.data.input_action(2)))
+
+
+def test_match_fields_and_regexp():
+  assert network_errors.Matcher(fields={'number': 2}).matches(_sequence_message(messages.data.input_action(2)))
+  assert not network_errors.Matcher(fields={'number': 3}).matches(_sequence_message(messages.data.input_action(2)))
+
+  matcher = network_errors.Matcher(regexp='.*input_action.*')
+  assert matcher.matches(_sequence_message(messages.data.input_action(2)))
+  assert not matcher.matches(_sequence_message(messages.sum.increment(2)))
+
+
+def test_zero_rates_never_draw():
+  random = Random(1)
+  simulator = network_errors.NetworkErrorSimulator(messages.machine.std_simulated_network_errors_config(), random)
+  state = random.getstate()
+  assert not simulator.error_type(messages.data.input_action(2), direction='outgoing')
+  assert random.getstate() == state
+
+
+def test_simulate_drops():
+  config = messages.machine.std_simulated_network_errors_config()
+  config['outgoing']['drop'] = {'rate': 1.0, 'types': ['input_action']}
+  simulator = network_errors.NetworkErrorSimulator(config, Random(1))
+  assert simulator.error_type(messages.data.input_action(2), direction='outgoing') == 'drop'
+  assert not simulator.error_type(messages.data.input_action(2), direction='incomming')
+  assert not simulator.error_type(messages.sum.increment(2), direction='outgoing')
+
+
+def test_unrecognized_error_type():
+  with pytest.raises(errors.InternalError):
+    network_errors.NetworkErrorSimulator({'outgoing': {'corrupt': {'rate': 0.1}}}, Random(1))
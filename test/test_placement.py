@@ -0,0 +1,92 @@
+from dist_zero import messages, placement
+
+
+def _load(machine_id, n_nodes, version=1):
+  return messages.machine.machine_load(
+      machine_id=machine_id,
+      transport=messages.machine.ip_transport(machine_id),
+      version=version,
+      n_nodes=n_nodes,
+      messages_per_second=0.0,
+      cpu_usage=0.0)
+
+
+def _load_table(n_nodes_by_machine_id):
+  load_table = placement.LoadTable('machine_a')
+  for machine_id, n_nodes in n_nodes_by_machine_id.items():
+    load_table.update(_load(machine_id, n_nodes))
+  return load_table
+
+
+def _node_config(node_id, parent_id='parent'):
+  return messages.data.data_node_config(
+      node_id=node_id,
+      parent={
+          'id': parent_id,
+          'controller_id': 'machine_a'
+      },
+      height=0,
+      dataset_program_config=None)
+
+
+def test_load_table_keeps_latest_version():
+  load_table = _load_table({'machine_a': 1})
+  load_table.update(_load('machine_b', 5, version=2))
+  load_table.update(_load('machine_b', 9, version=1))
+  assert load_table.load('machine_b')['n_nodes'] == 5
+  assert load_table.transport('machine_b')['host'] == 'machine_b'
+  assert load_table.gossip_targets(2) == ['machine_b']
+
+
+def test_least_loaded_spreads_nodes():
+  load_table = _load_table({'machine_a': 10, 'machine_b': 0, 'machine_c': 20})
+  policy = placement.LeastLoadedPolicy(imbalance=2)
+
+  placed = []
+  for i in range(9):
+    machine_id = policy.choose(_node_config(f'node_{i}'), load_table)
+    load_table.note_spawned(machine_id)
+    placed.append(machine_id)
+
+  assert placed.count('machine_b') == 8
+  assert placed.count('machine_a') == 1
+  assert 'machine_c' not in placed
+
+
+def test_least_loaded_prefers_local_machine():
+  load_table = _load_table({'machine_a': 3, 'machine_b': 0})
+  assert placement.LeastLoadedPolicy(imbalance=4).choose(_node_config('node'), load_table) == 'machine_a'
+
+
+def test_spread_siblings():
+  load_table = _load_table({'machine_a': 0, 'machine_b': 0, 'machine_c': 0})
+  policy = placement.SpreadSiblingsPolicy(imbalance=100)
+  placed = [policy.choose(_node_config(f'node_{i}'), load_table) for i in range(6)]
+  assert sorted(placed) == ['machine_a', 'machine_a', 'machine_b', 'machine_b', 'machine_c', 'machine_c']
+
+
+def test_spread_siblings_forgets_removed_parents():
+  load_table = _load_table({'machine_a': 0, 'machine_b': 0})
+  policy = placement.SpreadSiblingsPolicy(imbalance=100)
+  for i in range(3):
+    policy.choose(_node_config(f'node_{i}', parent_id=f'parent_{i}'), load_table)
+  assert len(policy._n_kids_by_parent_id) == 3
+
+  for i in range(3):
+    policy.forget(f'parent_{i}')
+  assert not policy._n_kids_by_parent_id
+
+
+def test_colocate():
+  load_table = _load_table({'machine_a': 100, 'machine_b': 0})
+  node_config = _node_config('node')
+  node_config['parent']['controller_id'] = 'machine_b'
+  assert placement.ColocatePolicy().choose(node_config, load_table) == 'machine_b'
+  node_config['parent']['controller_id'] = 'machine_unknown'
+  assert placement.ColocatePolicy().choose(node_config, load_table) == 'machine_a'
+
+
+def test_default_policy_is_local():
+  load_table = _load_table({'machine_a': 30, 'machine_b': 0})
+  policy = placement.from_system_config(messages.machine.std_system_config())
+  assert policy.choose(_node_config('node'), load_table) == 'machine_a'
@@ -74,6 +74,33 @@ class TestMultiplicativeReactive(object):
     assert 28 == capnpForT.from_bytes(net.Elapse(25)['thesum']).basicTransition
     assert 13 == capnpForT.from_bytes(net.Elapse(100)['thesum']).basicTransition
 
+  def test_recorded_transitions_at_the_same_time_are_compacted(self):
+    changing_number = recorded.RecordedUser(
+        'user',
+        start=1,
+        type=indiscrete_int,
+        time_action_pairs=[
+            (40, [('inc', 5)]),
+            (40, [('inc', -3)]),
+            (40, [('inc', 12)]),
+            (70, [('inc', 7)]),
+        ])
+
+    compiler = reactive.ReactiveCompiler(name='test_recorded_compaction')
+    thesum = program_plus(expression.Constant(2, type=types.Int32), changing_number)
+    module = compiler.compile({'thesum': thesum})
+    net = module.Net()
+
+    assert [(40, [('inc', 14)]), (70, [('inc', 7)])] == \
+        changing_number._compacted_time_action_pairs(compiler.get_concrete_type(changing_number.type))
+
+    capnpForOutput = compiler.capnp_state_builder(thesum)
+    capnpForOutput_T = compiler.capnp_transitions_builder(thesum)
+
+    assert 3 == capnpForOutput.from_bytes(net.OnOutput_thesum()['thesum']).basicState
+    assert 14 == capnpForOutput_T.from_bytes(net.Elapse(45)['thesum']).basicTransition
+    assert 7 == capnpForOutput_T.from_bytes(net.Elapse(30)['thesum']).basicTransition
+
   def test_recorded_ints(self):
     changing_number = recorded.RecordedUser(
         'user',
@@ -0,0 +1,31 @@
+import pytest
+
+from cryptography.exceptions import InvalidTag
+
+from dist_zero import session_crypto
+
+
+def test_session_cipher_roundtrip():
+  key = session_crypto.new_session_key()
+  cipher = session_crypto.session_cipher(key)
+  assert cipher is session_crypto.session_cipher(key)
+
+  plaintext = b'\x00\x01 some message \xff'
+  ciphertext = cipher.encrypt(plaintext)
+  assert len(ciphertext) == len(plaintext) + session_crypto.NONCE_BYTES + 16
+  assert cipher.decrypt(ciphertext) == plaintext
+  assert cipher.encrypt(plaintext) != ciphertext
+
+
+def test_session_cipher_rejects_other_keys():
+  ciphertext = session_crypto.session_cipher(session_crypto.new_session_key()).encrypt(b'message')
+  with pytest.raises(InvalidTag):
+    session_crypto.session_cipher(session_crypto.new_session_key()).decrypt(ciphertext)
+
+
+def test_session_cipher_cache_is_bounded():
+  cache = session_crypto.SessionCipherCache(max_size=3)
+  keys = [session_crypto.new_session_key() for i in range(5)]
+  for key in keys:
+    cache.get(key)
+  assert len(cache) == 3
@@ -0,0 +1,29 @@
+import importlib
+
+import dotenv
+import pytest
+
+from dist_zero import settings
+
+
+@pytest.fixture
+def reload_settings(monkeypatch):
+  yield lambda: importlib.reload(settings)
+  monkeypatch.undo()
+  importlib.reload(settings)
+
+
+def test_encryption_granularity_from_dotenv(tmpdir, monkeypatch, reload_settings):
+  env_file = tmpdir.join('.env')
+  env_file.write('ENCRYPT_ALL_MESSAGES=true\nENCRYPTION_GRANULARITY=datagram\n')
+  monkeypatch.setattr(dotenv, 'find_dotenv', lambda: str(env_file))
+  for name in ['ENCRYPT_ALL_MESSAGES', 'ENCRYPTION_GRANULARITY']:
+    # Set before deleting, so that undoing the monkeypatch also removes the values loaded from the dotenv file.
+    monkeypatch.setenv(name, '')
+    monkeypatch.delenv(name)
+
+  reload_settings()
+
+  assert settings.ENCRYPTION_GRANULARITY == 'datagram'
+  assert settings.encrypt_datagrams
+  assert not settings.encrypt_messages
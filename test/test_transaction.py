@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import random
+
+import pytest
+
+from dist_zero import intervals, messages, transaction
+from dist_zero.node.data.kids import DataNodeKids
+from dist_zero.node.data.monitor import Monitor
+from dist_zero.node.data.transactions.add_leaf import AddLeafParent
+from dist_zero.node.data.transactions.split_kid import SplitKid
+from dist_zero.node.node import Node
+
+logger = logging.getLogger(__name__)
+
+
+class _FakeController(object):
+  def __init__(self):
+    self.system_config = messages.machine.std_system_config()
+    self.random = random.Random(0)
+
+    self.spawned = []
+
+  def create_task(self, awaitable):
+    asyncio.get_event_loop().create_task(awaitable)
+
+  def spawn_node(self, node_config):
+    self.spawned.append(node_config)
+
+
+class _FakeNode(Node):
+  def __init__(self):
+    self.id = 'node'
+    self._controller = _FakeController()
+    super(_FakeNode, self).__init__(logger)
+
+
+class _Role(transaction.OriginatorRole):
+  '''Records when it starts, and finishes once it receives a 'done' message.'''
+
+  def __init__(self, name, resources, started):
+    self._name = name
+    self._resources = resources
+    self._started = started
+
+  @property
+  def resources(self):
+    return self._resources
+
+  async def run(self, controller):
+    self._started.append(self._name)
+    await controller.listen(type='done')
+
+
+async def _finish(node, name):
+  for role, controller in node._running_transaction_roles.values():
+    if role._name == name:
+      node.receive(messages.transaction.transaction_message(controller.transaction_id, {'type': 'done'}), None)
+      break
+  else:
+    raise RuntimeError(f"{name} is not running")
+
+  # Let the role finish, and any roles it was blocking start.
+  await asyncio.sleep(0)
+  await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_non_conflicting_roles_run_concurrently():
+  node = _FakeNode()
+  started = []
+  node.start_transaction_eventually(_Role('split_a', frozenset([transaction.kid_resource('a')]), started))
+  node.start_transaction_eventually(_Role('remove_a', frozenset([transaction.kid_resource('a')]), started))
+  node.start_transaction_eventually(_Role('add_b', frozenset([transaction.kid_resource('b')]), started))
+  node.start_transaction_eventually(_Role('all_kids', frozenset([transaction.KIDS]), started))
+  node.start_transaction_eventually(_Role('add_c', frozenset([transaction.kid_resource('c')]), started))
+  node.start_transaction_eventually(_Role('everything', None, started))
+  await asyncio.sleep(0)
+
+  # Roles wait only for the conflicting roles that are running or were enqueued before them.
+  assert started == ['split_a', 'add_b']
+
+  await _finish(node, 'add_b')
+  assert started == ['split_a', 'add_b']
+
+  await _finish(node, 'split_a')
+  assert started == ['split_a', 'add_b', 'remove_a']
+
+  for name, next_name in [('remove_a', 'all_kids'), ('all_kids', 'add_c'), ('add_c', 'everything')]:
+    await _finish(node, name)
+    assert started[-1] == next_name
+
+  await _finish(node, 'everything')
+  assert not node._running_transaction_roles
+
+
+class _CountingRole(transaction.OriginatorRole):
+  '''Like CheckLimitsTransaction, coalesces into an identical queued role by adding up its count.'''
+
+  def __init__(self, count, ran):
+    self._count = count
+    self._ran = ran
+
+  @property
+  def coalesce_key(self):
+    return 'counting'
+
+  def coalesce(self, other):
+    self._count += other._count
+
+  async def run(self, controller):
+    self._ran.append(self._count)
+
+
+@pytest.mark.asyncio
+async def test_queued_roles_coalesce():
+  node = _FakeNode()
+  started, ran = [], []
+  node.start_transaction_eventually(_Role('everything', None, started))
+  for i in range(5):
+    node.start_transaction_eventually(_CountingRole(1, ran))
+  await asyncio.sleep(0)
+  assert len(node._transaction_role_queue) == 1
+
+  await _finish(node, 'everything')
+  assert ran == [5]
+
+  # A role that has started no longer coalesces with new requests.
+  node.start_transaction_eventually(_CountingRole(1, ran))
+  await asyncio.sleep(0)
+  assert ran == [5, 1]
+
+
+class _PriorityRole(_Role):
+  '''Like MigrateNode, runs ahead of the queued roles.'''
+
+  @property
+  def has_priority(self):
+    return True
+
+
+@pytest.mark.asyncio
+async def test_priority_role_blocks_new_roles():
+  node = _FakeNode()
+  started = []
+  node.start_transaction_eventually(_Role('split_a', frozenset([transaction.kid_resource('a')]), started))
+  node.start_transaction_eventually(_Role('remove_a', frozenset([transaction.kid_resource('a')]), started))
+  node.start_transaction_eventually(_PriorityRole('migrate', None, started))
+  node.start_transaction_eventually(_Role('add_b', frozenset([transaction.kid_resource('b')]), started))
+  await asyncio.sleep(0)
+
+  # add_b conflicts with nothing that is running, but may not start before the priority role.
+  assert started == ['split_a']
+
+  await _finish(node, 'split_a')
+  assert started == ['split_a', 'migrate']
+
+  await _finish(node, 'migrate')
+  assert started == ['split_a', 'migrate', 'remove_a', 'add_b']
+
+
+class _FailingRole(transaction.OriginatorRole):
+  async def run(self, controller):
+    raise RuntimeError("Unexpected failure")
+
+
+@pytest.mark.asyncio
+async def test_failing_role_stops_blocking():
+  node = _FakeNode()
+  started = []
+  node.start_transaction_eventually(_FailingRole())
+  node.start_transaction_eventually(_Role('everything', None, started))
+  await asyncio.sleep(0)
+  await asyncio.sleep(0)
+
+  assert started == ['everything']
+
+
+def _handle(node_id):
+  return {'id': node_id, 'controller_id': 'machine', 'transport': None, 'session_key': None}
+
+
+def _summary(size):
+  return messages.data.kid_summary(size=size, n_kids=size, availability=0, messages_per_second=0, height=1)
+
+
+class _FakeDataNode(_FakeNode):
+  '''Just enough of a height 2 `DataNode` for its `Monitor` to split its kids.'''
+
+  def __init__(self):
+    super(_FakeDataNode, self).__init__()
+    self._height = 2
+    self._parent = _handle('parent')
+    self._kid_capacity_limit = 10
+    self._splits_by_load = False
+    self._updated_summary = False
+    self._dataset_program_config = {}
+    self._kids = DataNodeKids(0.0, 1.0, controller=self._controller)
+    self._monitor = Monitor(self)
+    self.sent = []
+
+  def new_handle(self, for_node_id):
+    return _handle(self.id)
+
+  def transfer_handle(self, handle, for_node_id):
+    return dict(handle)
+
+  def send(self, receiver, message):
+    self.sent.append(message)
+
+  def check_limits(self):
+    self._monitor.check_limits(0)
+
+  def _send_kid_summary(self, flush=False):
+    pass
+
+  def _kids_are_mergeable(self, left_kid_id, right_kid_id):
+    return False
+
+
+@pytest.mark.asyncio
+async def test_limit_check_during_pending_split():
+  node = _FakeDataNode()
+  node._kids.add_kid(_handle('kid_a'), interval=[0.0, 0.5], summary=_summary(9))
+  node._kids.add_kid(_handle('kid_b'), interval=[0.5, 1.0], summary=_summary(8))
+  assert node._monitor.out_of_capacity()
+
+  node.start_transaction_eventually(SplitKid('kid_a'))
+  await asyncio.sleep(0)
+  assert len(node._controller.spawned) == 1
+
+  # The kids have not changed yet, so the check asks for another split.  It must wait for the pending one.
+  node.check_limits()
+  await asyncio.sleep(0)
+  await asyncio.sleep(0)
+  assert len(node._controller.spawned) == 1
+  assert [role.__class__ for role, controller in node._transaction_role_queue] == [SplitKid]
+
+  (split, controller), = node._running_transaction_roles.values()
+  for message in [
+      messages.data.hello_parent(_handle('kid_new')),
+      messages.data.finished_absorbing(summary=_summary(4), new_interval=intervals.interval_json([0.25, 0.5])),
+      messages.data.finished_splitting(summary=_summary(5)),
+  ]:
+    node.receive(messages.transaction.transaction_message(controller.transaction_id, message), None)
+    await asyncio.sleep(0)
+  await asyncio.sleep(0)
+
+  # The first split added enough capacity, so the second one gives up without splitting.
+  assert len(node._kids) == 3
+  assert not node._monitor.out_of_capacity()
+  assert len(node._controller.spawned) == 1
+  assert not node._running_transaction_roles and not node._transaction_role_queue
+
+
+@pytest.mark.asyncio
+async def test_add_leaf_during_pending_split():
+  node = _FakeDataNode()
+  node._kids.add_kid(_handle('kid_a'), interval=[0.0, 0.5], summary=_summary(9))
+  node._kids.add_kid(_handle('kid_b'), interval=[0.5, 1.0], summary=_summary(8))
+
+  node.start_transaction_eventually(SplitKid('kid_a'))
+  await asyncio.sleep(0)
+  (split, controller), = node._running_transaction_roles.values()
+
+  # Adding a kid touches only that kid, so it need not wait for the split to finish.
+  leaf = dict(_handle('leaf'), transaction_id='add_leaf')
+  node._start_transaction_participant_eventually('add_leaf', AddLeafParent(kid=leaf, kid_summary=_summary(0)))
+  await asyncio.sleep(0)
+  await asyncio.sleep(0)
+  assert 'leaf' in node._kids
+  assert 'add_leaf' not in node._running_transaction_roles
+  assert node._running_transaction_roles[controller.transaction_id][0] is split
+
+
+@pytest.mark.asyncio
+async def test_monitor_deadline_follows_watched_pairs():
+  node = _FakeDataNode()
+  node._kids_are_mergeable = lambda left_id, right_id: True
+  assert node._monitor.ms_until_deadline(0) is None
+
+  # A change to the kids checks the limits, which starts watching the newly mergeable pair.
+  node._kids.add_kid(_handle('kid_a'), interval=[0.0, 0.5], summary=_summary(1))
+  node._kids.add_kid(_handle('kid_b'), interval=[0.5, 1.0], summary=_summary(1))
+  node.check_limits()
+  await asyncio.sleep(0)
+  assert node._monitor.ms_until_deadline(0) == Monitor.TIME_TO_WAIT_BEFORE_KID_MERGE_MS
+
+  # Until the pair is due, the node need not check its limits at all.
+  node._monitor.check_limits(500)
+  await asyncio.sleep(0)
+  assert node._monitor.ms_until_deadline(1000) == Monitor.TIME_TO_WAIT_BEFORE_KID_MERGE_MS - 1500
+  assert node._monitor.ms_until_deadline(Monitor.TIME_TO_WAIT_BEFORE_KID_MERGE_MS) == 0
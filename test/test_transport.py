@@ -0,0 +1,124 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from dist_zero import codec, errors, messages, session_crypto, transport
+
+
+def test_coalesce_respects_budget():
+  encoded_messages = [bytes([i]) * 100 for i in range(20)]
+  datagrams = transport.coalesce(encoded_messages, max_datagram_bytes=500)
+
+  assert all(len(datagram) <= 500 for datagram in datagrams)
+  assert len(datagrams) == 5
+  assert [m for datagram in datagrams for m in transport.unpack_datagram(datagram)] == encoded_messages
+
+
+def test_coalesce_oversized_message():
+  encoded_messages = [b'a' * 10, b'b' * 1000, b'c' * 10]
+  datagrams = transport.coalesce(encoded_messages, max_datagram_bytes=100)
+  assert [transport.unpack_datagram(datagram) for datagram in datagrams] == [[m] for m in encoded_messages]
+
+
+class _FakeDatagramTransport(object):
+  def __init__(self):
+    self.sent = []
+
+  def sendto(self, data, dst):
+    self.sent.append((data, dst))
+
+
+@pytest.mark.asyncio
+async def test_datagram_sender_coalesces_per_destination():
+  wire_codec = codec.BinaryCodec()
+  sender = transport.DatagramSender(wire_codec=wire_codec, max_datagram_bytes=1400)
+
+  def _message(i):
+    return messages.machine.machine_deliver_to_node(
+        node_id='node_a', message=wire_codec.encode_payload(messages.data.input_action(i)), sending_node_id='node_b')
+
+  for i in range(10):
+    sender.send(_message(i), ('host_a', 1))
+  sender.send(_message(10), ('host_b', 1))
+
+  fake = _FakeDatagramTransport()
+  sender.connection_made(fake)
+  await asyncio.sleep(0)
+
+  assert sorted(dst for data, dst in fake.sent) == [('host_a', 1), ('host_b', 1)]
+  data = next(data for data, dst in fake.sent if dst == ('host_a', 1))
+  assert [wire_codec.decode(m) for m in transport.unpack_datagram(data)] == [_message(i) for i in range(10)]
+  assert sender.n_messages == 11
+  assert sender.n_datagrams == 2
+
+
+def test_encrypted_datagrams():
+  cipher = session_crypto.session_cipher(session_crypto.new_session_key())
+  encoded_messages = [bytes([i]) * 100 for i in range(20)]
+  datagrams = transport.coalesce(encoded_messages, max_datagram_bytes=500, cipher=cipher)
+
+  assert all(len(datagram) <= 500 for datagram in datagrams)
+  assert all(encoded_messages[0] not in datagram for datagram in datagrams)
+  assert [m for datagram in datagrams for m in transport.unpack_datagram(datagram, cipher)] == encoded_messages
+
+  with pytest.raises(errors.InternalError):
+    transport.unpack_datagram(datagrams[0])
+
+
+def test_plain_datagrams_rejected_when_encryption_required():
+  cipher = session_crypto.session_cipher(session_crypto.new_session_key())
+  plain, = transport.coalesce([b'message'], max_datagram_bytes=500)
+  encrypted, = transport.coalesce([b'message'], max_datagram_bytes=500, cipher=cipher)
+
+  assert transport.unpack_datagram(encrypted, cipher, require_encryption=True) == [b'message']
+  with pytest.raises(errors.InternalError):
+    transport.unpack_datagram(plain, cipher, require_encryption=True)
+
+
+def test_api_frames_stream_large_messages():
+  message = {'type': 'get_kids', 'kids': {f'node_{i}': 'x' * 100 for i in range(2000)}}
+  frames = transport.api_frames(7, message) + transport.api_frames(8, {'type': 'small'})
+  assert len(frames) > 3
+
+  decoder = transport.ApiFrameDecoder()
+  data = b''.join(frames)
+  received = []
+  for start in range(0, len(data), 1000):
+    received.extend(decoder.feed(data[start:start + 1000]))
+
+  assert received == [(7, message), (8, {'type': 'small'})]
+
+
+def test_api_connection_pool_pipelines_requests():
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(('127.0.0.1', 0))
+  server.listen(1)
+  dst = server.getsockname()
+  n_connections = []
+
+  def _serve():
+    connection, address = server.accept()
+    n_connections.append(1)
+    decoder = transport.ApiFrameDecoder()
+    with connection:
+      while True:
+        data = connection.recv(4096)
+        if not data:
+          return
+        for request_id, message in decoder.feed(data):
+          response = {'status': 'ok', 'data': message['value'] * 2}
+          connection.sendall(b''.join(transport.api_frames(request_id, response)))
+
+  thread = threading.Thread(target=_serve, daemon=True)
+  thread.start()
+
+  api_pool = transport.ApiConnectionPool()
+  assert transport.send_tcp_many([{'value': i} for i in range(100)], dst, api_pool=api_pool) == list(range(0, 200, 2))
+  assert transport.send_tcp({'value': 'a'}, dst, api_pool=api_pool) == 'aa'
+  assert len(n_connections) == 1
+
+  api_pool.close()
+  thread.join(timeout=1)
+  server.close()
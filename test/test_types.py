@@ -1,10 +1,11 @@
 import math
 import os
+import random
 import tempfile
 
 import pytest
 
-from dist_zero import types, cgen
+from dist_zero import types, cgen, concrete_types
 from dist_zero.reactive.compiler import ReactiveCompiler
 
 TwoByThree = types.Product([
@@ -56,3 +57,63 @@ def test_type_cardinalities():
       ('middle', types.Two),
       ('right', types.One),
   ]))
+
+
+def test_compact_basic_transitions():
+  int8 = concrete_types.ConcreteBasicType(types.Int8)
+  assert [[('inc', 6)]] == int8.compact_transitions([[('inc', 1)], [('inc', 2), ('inc', 3)]])
+  # Compaction wraps around just like the c code that applies the transitions.
+  assert [[('inc', -128)]] == int8.compact_transitions([[('inc', 127)], [('inc', 1)]])
+
+  uncompactable = concrete_types.ConcreteBasicType(
+      types.BasicType(
+          'Int32',
+          c_state_type=cgen.Int32,
+          capnp_transition_type='Int32',
+          c_transition_type=cgen.Int32,
+          apply_transition=types.apply_plus,
+          nil_transition_c_expression=cgen.Zero))
+  assert [[('inc', 1)], [('inc', 2)]] == uncompactable.compact_transitions([[('inc', 1)], [('inc', 2)]])
+
+
+def _truncate(value, bits, signed):
+  '''Truncate an integer to a width, as c does when it assigns the integer to a variable of that width.'''
+  value %= 1 << bits
+  return value - (1 << bits) if signed and value >= 1 << (bits - 1) else value
+
+
+def _apply(basic_type, bits, signed, state, python_transitions):
+  '''Apply python transitions to a state just as the c code does.'''
+  for python_transition in python_transitions:
+    inc = _truncate(sum(val for key, val in python_transition), bits, signed)
+    state = _truncate(basic_type._apply_transition(inc, state), bits, signed)
+  return state
+
+
+@pytest.mark.parametrize('basic_type,bits,signed', [
+    (types.Int8, 8, True),
+    (types.UInt8, 8, False),
+    (types.Int16, 16, True),
+    (types.UInt32, 32, False),
+    (types.Int64, 64, True),
+])
+def test_compacted_transitions_match_uncompacted(basic_type, bits, signed):
+  concrete = concrete_types.ConcreteBasicType(basic_type)
+  modulus = 1 << bits
+  least = -(1 << (bits - 1)) if signed else 0
+  rand = random.Random(bits)
+
+  def random_value():
+    # Values at the ends of the range make most runs wrap around.
+    return rand.choice([least, least + modulus - 1, rand.randrange(least, least + modulus)])
+
+  for trial in range(200):
+    python_transitions = [[('inc', random_value()) for i in range(rand.randint(1, 2))]
+                          for j in range(rand.randint(0, 20))]
+    state = random_value()
+
+    compacted = concrete.compact_transitions(python_transitions)
+    assert len(compacted) <= 1
+    assert all(least <= val < least + modulus for python_transition in compacted for key, val in python_transition)
+    assert _apply(basic_type, bits, signed, state, compacted) == \
+        _apply(basic_type, bits, signed, state, python_transitions)